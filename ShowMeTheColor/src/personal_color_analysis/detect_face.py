@@ -1,24 +1,31 @@
 # coding: utf-8
 # import the necessary packages
 import os # 파일 상단에 이 줄을 추가합니다.
+import threading
 from imutils import face_utils
 import numpy as np
 import dlib
 import cv2
 # import matplotlib.pyplot as plt # 현재 코드에서 사용되지 않으므로 주석 처리 가능
 
-class DetectFace:
-    def __init__(self, image_path): # 매개변수 이름을 image_path로 변경하여 명확성 향상
+class FaceLandmarkEngine:
+    """
+    dlib 얼굴 검출기(HOG)와 68점 랜드마크 예측기를 한 번만 로드해 여러 요청에서 재사용합니다.
+    shape_predictor_68_face_landmarks.dat 로딩은 수백 ms가 걸리므로 요청마다 만들지 않습니다.
+    """
+    def __init__(self, dat_file_path=None):
         # initialize dlib's face detector (HOG-based)
         # and then create the facial landmark predictor
         self.detector = dlib.get_frontal_face_detector()
 
-        # 현재 파일(detect_face.py)이 있는 디렉토리의 절대 경로를 얻습니다.
-        current_file_dir = os.path.dirname(os.path.abspath(__file__))
+        if dat_file_path is None:
+            # 현재 파일(detect_face.py)이 있는 디렉토리의 절대 경로를 얻습니다.
+            current_file_dir = os.path.dirname(os.path.abspath(__file__))
 
-        # current_file_dir (personal_color_analysis)에서부터 dat 파일까지의 상대 경로를 계산합니다.
-        # personal_color_analysis/ -> src/ (../) -> ShowMeTheColor/ (../) -> res/ (res/) -> dat_file
-        dat_file_path = os.path.join(current_file_dir, '../../res/shape_predictor_68_face_landmarks.dat')
+            # current_file_dir (personal_color_analysis)에서부터 dat 파일까지의 상대 경로를 계산합니다.
+            # personal_color_analysis/ -> src/ (../) -> ShowMeTheColor/ (../) -> res/ (res/) -> dat_file
+            dat_file_path = os.path.join(current_file_dir, '../../res/shape_predictor_68_face_landmarks.dat')
+        self.dat_file_path = dat_file_path
 
         # 최종적으로 생성된 경로를 사용하여 파일을 엽니다.
 
@@ -33,8 +40,58 @@ class DetectFace:
             # 여기서 프로그램을 종료하거나, 적절한 예외 처리를 할 수 있습니다.
             raise  # 혹은 return 이나 다른 방식으로 __init__ 실패를 알림
 
+    def detect_face_box(self, image):
+        """
+        랜드마크 없이 얼굴 검출만 수행해 첫 번째 얼굴의 (x, y, w, h)를 반환합니다. 못 찾으면 None.
+        image: 파일 경로 또는 BGR 이미지(np.ndarray). DetectFace(face_box=...)와 같은 좌표 형식입니다.
+        """
+        img = image if isinstance(image, np.ndarray) else cv2.imread(image)
+        if img is None:
+            return None
+        rects = self.detector(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), 1)
+        if len(rects) == 0:
+            return None
+        rect = rects[0]
+        return (max(0, rect.left()), max(0, rect.top()), rect.width(), rect.height())
+
+    def memory_bytes(self):
+        # 예측기 메모리는 대부분 .dat 파일 크기와 같습니다.
+        try:
+            return os.path.getsize(self.dat_file_path)
+        except OSError:
+            return 0
+
+
+_default_engine = None
+_default_engine_lock = threading.Lock()
+
+def get_default_engine():
+    """엔진을 따로 넘기지 않은 호출(CLI 등)에서 사용할 프로세스 공용 엔진을 반환합니다."""
+    global _default_engine
+    if _default_engine is None:
+        with _default_engine_lock:
+            if _default_engine is None:
+                _default_engine = FaceLandmarkEngine()
+    return _default_engine
+
+
+class DetectFace:
+    def __init__(self, image_path, engine=None, face_box=None): # 매개변수 이름을 image_path로 변경하여 명확성 향상
+        # 미리 로드된 엔진(FaceLandmarkEngine)을 재사용합니다.
+        if engine is None:
+            engine = get_default_engine()
+        self.detector = engine.detector
+        self.predictor = engine.predictor
+        # 같은 요청에서 이미 찾은 얼굴 좌표 (x, y, w, h)가 있으면 얼굴 검출을 건너뜁니다.
+        # 검출 후에는 사용한 얼굴 좌표가 여기에 기록됩니다.
+        self.face_box = face_box
+
         # face detection part
-        self.img = cv2.imread(image_path)
+        # image_path에는 파일 경로 또는 이미 디코딩된 BGR 이미지(np.ndarray)를 넘길 수 있습니다.
+        if isinstance(image_path, np.ndarray):
+            self.img = image_path
+        else:
+            self.img = cv2.imread(image_path)
         if self.img is None: # 이미지 로드 실패 시 처리
             print(f"Error: 이미지를 로드할 수 없습니다. 경로를 확인하세요: {image_path}")
             # 얼굴 부위 변수들을 빈 값으로 초기화하고 반환할 수 있도록 __init__에서 값 반환 X
@@ -68,7 +125,11 @@ class DetectFace:
             return
 
         gray_img = cv2.cvtColor(self.img, cv2.COLOR_BGR2GRAY)
-        rects = self.detector(gray_img, 1)
+        if self.face_box is not None:
+            x, y, w, h = self.face_box
+            rects = [dlib.rectangle(int(x), int(y), int(x + w), int(y + h))]
+        else:
+            rects = self.detector(gray_img, 1)
 
         # !!! 중요: 얼굴 검출 실패 시 처리 !!!
         if len(rects) == 0:
@@ -79,6 +140,7 @@ class DetectFace:
 
         # 첫 번째 검출된 얼굴 사용 (여러 얼굴이 있을 경우, 필요에 따라 로직 수정 가능)
         rect = rects[0]
+        self.face_box = (max(0, rect.left()), max(0, rect.top()), rect.width(), rect.height())
 
         face_parts = [[],[],[],[],[],[],[]] # 길이 7의 리스트로 초기화 (FACIAL_LANDMARKS_IDXS 항목 수에 맞게)
         num_face_landmark_groups = len(face_utils.FACIAL_LANDMARKS_IDXS)
@@ -180,7 +242,9 @@ class DetectFace:
         if w == 0 or h == 0:
             return np.array([])
 
-        crop = self.img[y:y+h, x:x+w]
+        # 마스킹이 원본(self.img)에 칠해지지 않도록 복사본을 사용합니다.
+        # (디코딩된 이미지를 피부 분석과 공유하는 경우 원본이 바뀌면 안 됨)
+        crop = self.img[y:y+h, x:x+w].copy()
         
         # crop이 성공적으로 되었는지 확인 (간혹 boundingRect 결과로 crop이 안될 수 있음)
         if crop.size == 0:
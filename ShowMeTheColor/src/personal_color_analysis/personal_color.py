@@ -4,16 +4,38 @@ import numpy as np
 # 변경 (상대경로 import)
 from . import tone_analysis
 
-from personal_color_analysis.detect_face import DetectFace # 사용자가 제공한 detect_face.py를 사용한다고 가정
+from personal_color_analysis.detect_face import DetectFace, get_default_engine # 사용자가 제공한 detect_face.py를 사용한다고 가정
 from personal_color_analysis.color_extract import DominantColors
 from colormath.color_objects import LabColor, sRGBColor, HSVColor
 from colormath.color_conversions import convert_color
 
-def analysis(imgpath):
+class PersonalColorAnalyzer:
+    """미리 로드된 FaceLandmarkEngine을 묶어 두고 analysis()를 호출하는 얇은 래퍼입니다."""
+    def __init__(self, engine=None):
+        self.engine = engine
+
+    def analysis(self, image, face_cache=None):
+        return analysis(image, self.engine, face_cache)
+
+    def detect_face_box(self, image):
+        """얼굴 좌표만 먼저 구합니다. (퍼스널 컬러와 피부 분석을 병렬로 돌리기 전에 좌표를 공유할 때 사용)"""
+        engine = self.engine if self.engine is not None else get_default_engine()
+        return engine.detect_face_box(image)
+
+
+def analysis(imgpath, engine=None, face_cache=None):
     #######################################
     #           Face detection            #
     #######################################
-    df = DetectFace(imgpath)
+    # imgpath: 이미지 파일 경로 또는 디코딩된 BGR 이미지(np.ndarray)
+    # engine: 미리 로드된 FaceLandmarkEngine (None이면 모듈 공용 엔진 사용)
+    # face_cache: 요청 단위 얼굴 좌표 캐시(SkinAnalysis.aimodel.FaceBoxCache). 찾은 좌표를 피부 분석과 공유합니다.
+    cached_box = face_cache.face_box if face_cache is not None and face_cache.resolved else None
+    df = DetectFace(imgpath, engine, face_box=cached_box)
+    if face_cache is not None and not face_cache.resolved:
+        face_cache.store(df.face_box if df.face_detected else None)
+    if isinstance(imgpath, np.ndarray):
+        imgpath = "<메모리 이미지>" # 로그 출력용 이름
     if not df.face_detected: # DetectFace에서 얼굴 감지/랜드마크 추출에 실패했는지 확인
         print(f"오류: {imgpath} 이미지에서 얼굴 특징을 추출할 수 없어 퍼스널 컬러 분석을 진행할 수 없습니다.")
         return # 분석 중단
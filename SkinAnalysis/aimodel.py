@@ -4,11 +4,14 @@ from torchvision import transforms
 from torchvision.models import efficientnet_b0, EfficientNet_B0_Weights
 from PIL import Image
 import numpy as np
-import pandas as pd
 import os
+import hashlib
 import joblib
 import logging
-from typing import List, Dict, Any
+import threading
+import time
+import warnings
+from typing import List, Dict, Any, Optional, Tuple
 # import io # 이제 S3 직접 로딩 안 하므로 필요 없음
 # import boto3 # 이제 S3 직접 로딩 안 하므로 필요 없음
 
@@ -16,9 +19,11 @@ logger = logging.getLogger(__name__)
 
 # --- 1. 피부 측정값 예측 모델 (Torch) 정의 ---
 class ImageToMeasurementModel(nn.Module):
-    def __init__(self, num_output_measurements):
+    def __init__(self, num_output_measurements, pretrained: bool = True):
         super().__init__()
-        weights = EfficientNet_B0_Weights.IMAGENET1K_V1
+        # 추론 시에는 학습된 state_dict가 곧바로 덮어쓰므로 ImageNet 가중치를 받을 필요가 없습니다.
+        # (pretrained=False 이면 네트워크 접근 없이 빈 구조만 생성)
+        weights = EfficientNet_B0_Weights.IMAGENET1K_V1 if pretrained else None
         self.backbone = efficientnet_b0(weights=weights)
         num_ftrs = self.backbone.classifier[1].in_features
         self.backbone.classifier = nn.Identity()
@@ -28,9 +33,12 @@ class ImageToMeasurementModel(nn.Module):
             nn.Dropout(0.3),
             nn.Linear(512, num_output_measurements)
         )
-    def forward(self, x):
-        x = self.backbone(x)
-        x = self.regression_head(x)
+    def forward(self, x, return_embedding: bool = False):
+        # return_embedding=True 이면 회귀 헤드 이전의 1280차원 풀링 특징(임베딩)도 함께 반환합니다.
+        features = self.backbone(x)
+        x = self.regression_head(features)
+        if return_embedding:
+            return x, features
         return x
     def freeze_backbone(self):
         for param in self.backbone.parameters():
@@ -40,19 +48,46 @@ class ImageToMeasurementModel(nn.Module):
             param.requires_grad = True
 
 # --- 2. 피부 분석을 위한 메인 클래스 정의 ---
+class FaceBoxCache:
+    """
+    요청 하나 동안 얼굴 바운딩 박스 (x, y, w, h)를 보관합니다.
+    퍼스널 컬러 분석(dlib)에서 찾은 좌표를 피부 분석의 얼굴 크롭이 재사용하여, 얼굴 검출을 한 번만 수행합니다.
+    """
+    def __init__(self, face_box=None):
+        self.face_box = face_box
+        self.resolved = face_box is not None
+
+    def store(self, face_box):
+        self.face_box = face_box
+        self.resolved = True
+
+
 class SkinAnalyzer:
     def __init__(self,
                  model_save_path: str = "image_to_measurement_model.pth",
                  target_scaler_save_path: str = "target_measurement_scaler.joblib",
                  skin_type_model_filename: str = 'best_skin_type_model_v3_measurements_only.joblib',
                  label_encoder_filename: str = 'label_encoder_v3_measurements_only.joblib',
-                 device: str = None):
+                 device: str = None,
+                 warmup: bool = True,
+                 input_size: int = 256,
+                 face_crop: bool = False,
+                 face_crop_margin: float = 0.2,
+                 load_artifacts: bool = True,
+                 model_version: str = None,
+                 mmap_weights: bool = True):
         
         # 현재 파일(aimodel.py)이 위치한 디렉토리의 절대 경로를 얻어 모델 파일 경로의 기준점으로 삼습니다.
         self.base_dir = os.path.dirname(os.path.abspath(__file__)) 
 
-        self.IMG_HEIGHT = 256
-        self.IMG_WIDTH = 256
+        # 모델 입력 해상도. 학습은 256으로 했으며, 224/192 등으로 낮출 때는
+        # evaluate_input_size()로 측정값 오차를 먼저 확인하세요.
+        self.IMG_HEIGHT = input_size
+        self.IMG_WIDTH = input_size
+        # 얼굴 영역만 잘라서 추론할지 여부와, 바운딩 박스 주변에 남길 여백 비율
+        self.face_crop = face_crop
+        self.face_crop_margin = face_crop_margin
+        self._face_cascade = None
         self.DEVICE = torch.device(device if device else ("cuda" if torch.cuda.is_available() else "cpu"))
 
         self.SELECTED_MEASUREMENT_COLS = [
@@ -73,34 +108,110 @@ class SkinAnalyzer:
 
         self.model_to_predict = None
         self.target_scaler = None
-        self.skin_type_model_pipeline = None
-        self.label_encoder = None
+        # 가중치를 mmap으로 읽을지 여부. 매핑된 파일을 제자리에서 덮어쓰면(cp) 추론 중 SIGBUS가 날 수 있으므로
+        # 모델 파일을 교체하는 배포에서는 끄거나, 새 파일에 쓴 뒤 rename으로 교체해야 합니다.
+        self.mmap_weights = mmap_weights
+        # mmap으로 매핑해 그대로 사용 중인 모델 파일의 (st_dev, st_ino). 매핑하지 않았으면 None
+        self.mmapped_file: Optional[Tuple[int, int]] = None
+        # 피부 타입 파이프라인과 레이블 인코더는 첫 사용 시점에 로드합니다 (지연 로딩).
+        self._skin_type_model_pipeline = None
+        self._label_encoder = None
+        self._skin_type_models_loaded = False
+        self._feature_order = None # 파이프라인 컬럼 순서가 다를 때 사용할 열 인덱스
+        self._skin_type_lock = threading.Lock()
+
+        # 로드 단계별 소요 시간(초). 로그와 모니터링에서 확인할 수 있습니다.
+        self.load_timings: Dict[str, float] = {}
 
         # S3 클라이언트 초기화 코드 제거 (SkinAnalyzer가 S3 직접 접근 안 함)
         # self.s3_client = boto3.client(...)
 
-        self._load_models() # 객체 생성 시 모델들을 로드
+        if load_artifacts:
+            self._load_models() # 객체 생성 시 모델들을 로드
+        else:
+            # 학습 산출물 없이 만드는 경우 (from_components 참고): 지연 로딩도 시도하지 않습니다.
+            self._skin_type_models_loaded = True
+
+        # tb_analysis.analysis_model에 기록되는 모델 버전. 지정하지 않으면 모델 파일 내용으로 만듭니다.
+        self.model_version = model_version or (self._artifact_version() if load_artifacts else "SkinAnalyzer (in-memory)")
 
         # 검증 데이터용 이미지 변환 (학습 때와 동일한 val_transform 사용)
-        normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-        self.val_transform = transforms.Compose([
-            transforms.Resize((self.IMG_HEIGHT, self.IMG_WIDTH)),
-            transforms.ToTensor(),
-            normalize
-        ])
+        self.val_transform = self._build_transform(self.IMG_HEIGHT, self.IMG_WIDTH)
+
+        if warmup:
+            self.warmup()
+        self._log_load_timings()
+
+    @classmethod
+    def from_components(cls, model: nn.Module, target_scaler=None, skin_type_model_pipeline=None, label_encoder=None,
+                        device: str = None, input_size: int = 256, face_crop: bool = False) -> "SkinAnalyzer":
+        """
+        .pth / joblib 파일 없이 이미 만들어진 모델 객체들로 SkinAnalyzer를 구성합니다.
+        (벤치마크처럼 임의 가중치 모델과 대체 파이프라인으로 성능만 측정할 때 사용)
+        """
+        analyzer = cls(device=device, warmup=False, input_size=input_size, face_crop=face_crop, load_artifacts=False)
+        analyzer.model_to_predict = model.to(analyzer.DEVICE).eval()
+        analyzer.target_scaler = target_scaler
+        if skin_type_model_pipeline is not None and not analyzer._validate_feature_order(skin_type_model_pipeline):
+            raise ValueError("피부 타입 예측 모델의 입력 컬럼이 SELECTED_MEASUREMENT_COLS와 일치하지 않습니다.")
+        analyzer._skin_type_model_pipeline = skin_type_model_pipeline
+        analyzer._label_encoder = label_encoder
+        return analyzer
+
+    @property
+    def skin_type_model_pipeline(self):
+        self._ensure_skin_type_models()
+        return self._skin_type_model_pipeline
+
+    @property
+    def label_encoder(self):
+        self._ensure_skin_type_models()
+        return self._label_encoder
+
+    def _load_state_dict(self):
+        """
+        state_dict를 메모리 매핑(mmap)으로 읽습니다.
+        CPU에서는 assign=True로 매핑된 텐서를 그대로 사용하여 복사를 피합니다.
+        mmap_weights가 꺼져 있으면 파일 전체를 메모리로 읽습니다.
+        """
+        if not self.mmap_weights:
+            return torch.load(self.model_save_path, map_location=self.DEVICE), False
+        try:
+            state_dict = torch.load(self.model_save_path, map_location=self.DEVICE, mmap=True, weights_only=True)
+            return state_dict, True
+        except TypeError:
+            # mmap/weights_only 인자를 지원하지 않는 구버전 torch
+            logger.info("현재 torch 버전이 mmap 로딩을 지원하지 않아 일반 로딩으로 진행합니다.")
+            return torch.load(self.model_save_path, map_location=self.DEVICE), False
 
     def _load_models(self):
         """
-        초기화 시 모든 필요한 모델과 스케일러를 로드합니다.
+        초기화 시 측정값 예측 모델과 타겟 스케일러를 로드합니다.
+        피부 타입 파이프라인과 레이블 인코더는 _ensure_skin_type_models()에서 지연 로드됩니다.
         """
         logger.info(f"Loading ImageToMeasurementModel from: {self.model_save_path}")
         try:
-            self.model_to_predict = ImageToMeasurementModel(num_output_measurements=self.NUM_TARGET_MEASUREMENTS)
             if not os.path.exists(self.model_save_path):
                 raise FileNotFoundError(f"모델 파일({self.model_save_path})을 찾을 수 없습니다.")
-            self.model_to_predict.load_state_dict(torch.load(self.model_save_path, map_location=self.DEVICE))
+
+            started = time.perf_counter()
+            self.model_to_predict = ImageToMeasurementModel(num_output_measurements=self.NUM_TARGET_MEASUREMENTS, pretrained=False)
+            self.load_timings["build_model"] = time.perf_counter() - started
+
+            started = time.perf_counter()
+            state_dict, mmapped = self._load_state_dict()
+            self.load_timings["read_state_dict"] = time.perf_counter() - started
+
+            started = time.perf_counter()
+            if mmapped and self.DEVICE.type == "cpu":
+                self.model_to_predict.load_state_dict(state_dict, assign=True)
+                model_stat = os.stat(self.model_save_path)
+                self.mmapped_file = (model_stat.st_dev, model_stat.st_ino)
+            else:
+                self.model_to_predict.load_state_dict(state_dict)
             self.model_to_predict.to(self.DEVICE)
             self.model_to_predict.eval()
+            self.load_timings["apply_state_dict"] = time.perf_counter() - started
             logger.info(f"모델 로드 완료: {self.model_save_path}")
         except FileNotFoundError as e:
             logger.error(f"오류: {e}")
@@ -111,38 +222,217 @@ class SkinAnalyzer:
 
         logger.info(f"Loading Target Scaler from: {self.target_scaler_save_path}")
         if os.path.exists(self.target_scaler_save_path):
+            started = time.perf_counter()
             self.target_scaler = joblib.load(self.target_scaler_save_path)
+            self.load_timings["target_scaler"] = time.perf_counter() - started
             logger.info(f"타겟 스케일러 로드 완료: {self.target_scaler_save_path}")
         else:
             logger.warning(f"경고: 타겟 스케일러 파일({self.target_scaler_save_path})을 찾을 수 없습니다. 원래 스케일 변환 불가.")
 
-        logger.info(f"Loading Skin Type Prediction Model and Label Encoder from: {self.skin_type_model_filename} and {self.label_encoder_filename}")
-        try:
-            if not os.path.exists(self.skin_type_model_filename):
-                raise FileNotFoundError(f"피부 타입 예측 모델 파일({self.skin_type_model_filename})을 찾을 수 없습니다.")
-            self.skin_type_model_pipeline = joblib.load(self.skin_type_model_filename)
-            logger.info(f"'{self.skin_type_model_filename}'에서 피부 타입 예측 모델(파이프라인) 로드 완료.")
-            
-            if not os.path.exists(self.label_encoder_filename):
-                raise FileNotFoundError(f"레이블 인코더 파일({self.label_encoder_filename})을 찾을 수 없습니다.")
-            self.label_encoder = joblib.load(self.label_encoder_filename)
-            logger.info(f"'{self.label_encoder_filename}'에서 레이블 인코더 로드 완료.")
-            
-        except FileNotFoundError as fnfe:
-            logger.error(f"오류: 필요한 모델 또는 인코더 파일({fnfe.filename})을 찾을 수 없습니다. 피부 타입 예측 모델 학습 및 저장 스크립트를 먼저 실행했는지 확인하세요.")
-            self.skin_type_model_pipeline = None
-            self.label_encoder = None
-        except Exception as e:
-            logger.error(f"피부 타입 예측 모델 또는 객체 로드 중 오류 발생: {e}", exc_info=True)
-            self.skin_type_model_pipeline = None
-            self.label_encoder = None
+    def _ensure_skin_type_models(self):
+        """
+        피부 타입 예측 파이프라인과 레이블 인코더를 최초 1회만 로드합니다.
+        실패한 경우에도 다시 시도하지 않으며 두 값 모두 None으로 남습니다.
+        """
+        if self._skin_type_models_loaded:
+            return
+        with self._skin_type_lock:
+            if self._skin_type_models_loaded:
+                return
+            logger.info(f"Loading Skin Type Prediction Model and Label Encoder from: {self.skin_type_model_filename} and {self.label_encoder_filename}")
+            try:
+                if not os.path.exists(self.skin_type_model_filename):
+                    raise FileNotFoundError(f"피부 타입 예측 모델 파일({self.skin_type_model_filename})을 찾을 수 없습니다.")
+                started = time.perf_counter()
+                pipeline = joblib.load(self.skin_type_model_filename)
+                self.load_timings["skin_type_model"] = time.perf_counter() - started
+                if not self._validate_feature_order(pipeline):
+                    raise ValueError("피부 타입 예측 모델의 입력 컬럼이 SELECTED_MEASUREMENT_COLS와 일치하지 않습니다.")
+                self._skin_type_model_pipeline = pipeline
+                logger.info(f"'{self.skin_type_model_filename}'에서 피부 타입 예측 모델(파이프라인) 로드 완료.")
+
+                if not os.path.exists(self.label_encoder_filename):
+                    raise FileNotFoundError(f"레이블 인코더 파일({self.label_encoder_filename})을 찾을 수 없습니다.")
+                started = time.perf_counter()
+                self._label_encoder = joblib.load(self.label_encoder_filename)
+                self.load_timings["label_encoder"] = time.perf_counter() - started
+                logger.info(f"'{self.label_encoder_filename}'에서 레이블 인코더 로드 완료.")
+
+            except FileNotFoundError as fnfe:
+                logger.error(f"오류: 필요한 모델 또는 인코더 파일({fnfe.filename})을 찾을 수 없습니다. 피부 타입 예측 모델 학습 및 저장 스크립트를 먼저 실행했는지 확인하세요.")
+                self._skin_type_model_pipeline = None
+                self._label_encoder = None
+            except Exception as e:
+                logger.error(f"피부 타입 예측 모델 또는 객체 로드 중 오류 발생: {e}", exc_info=True)
+                self._skin_type_model_pipeline = None
+                self._label_encoder = None
+            finally:
+                self._skin_type_models_loaded = True
+
+    def _validate_feature_order(self, pipeline) -> bool:
+        """
+        파이프라인이 학습된 컬럼 순서(feature_names_in_)와 SELECTED_MEASUREMENT_COLS를 로드 시점에 한 번 비교합니다.
+        순서만 다르면 입력 배열의 열 순서를 맞추는 인덱스를 만들어 두고, 컬럼 구성이 다르면 False를 반환합니다.
+        """
+        feature_names = getattr(pipeline, "feature_names_in_", None)
+        if feature_names is None:
+            # DataFrame 없이 학습된 파이프라인: 열 개수만 확인합니다.
+            n_features = getattr(pipeline, "n_features_in_", self.NUM_TARGET_MEASUREMENTS)
+            if n_features != self.NUM_TARGET_MEASUREMENTS:
+                logger.error(f"피부 타입 예측 모델의 입력 특성 수({n_features})가 측정값 수({self.NUM_TARGET_MEASUREMENTS})와 다릅니다.")
+                return False
+            self._feature_order = None
+            return True
+
+        feature_names = list(feature_names)
+        if feature_names == self.SELECTED_MEASUREMENT_COLS:
+            self._feature_order = None
+            return True
+        if sorted(feature_names) != sorted(self.SELECTED_MEASUREMENT_COLS):
+            logger.error(f"피부 타입 예측 모델의 입력 컬럼이 측정값 컬럼과 다릅니다: {feature_names}")
+            return False
+        logger.warning("피부 타입 예측 모델의 컬럼 순서가 달라 입력 배열의 열 순서를 재정렬합니다.")
+        self._feature_order = np.array([self.SELECTED_MEASUREMENT_COLS.index(name) for name in feature_names])
+        return True
+
+    def classify_measurements(self, measurements: np.ndarray) -> List[str]:
+        """
+        측정값 배열로 피부 타입을 예측합니다. pandas DataFrame을 거치지 않고 2차원 float 배열을 바로 넘깁니다.
+        measurements: (15,) 한 명 또는 (N, 15) 여러 명. 열 순서는 SELECTED_MEASUREMENT_COLS와 같아야 합니다.
+        반환값은 사람마다 하나씩의 피부 타입 문자열 리스트입니다.
+        """
+        pipeline = self.skin_type_model_pipeline
+        label_encoder = self.label_encoder
+        if pipeline is None or label_encoder is None:
+            raise RuntimeError("피부 타입 예측 모델 또는 레이블 인코더가 로드되지 않았습니다.")
+
+        matrix = np.asarray(measurements, dtype=np.float64)
+        if matrix.ndim == 1:
+            matrix = matrix.reshape(1, -1)
+        if matrix.ndim != 2 or matrix.shape[1] != self.NUM_TARGET_MEASUREMENTS:
+            raise ValueError(f"측정값 배열의 형태가 올바르지 않습니다: {matrix.shape} (기대값: (N, {self.NUM_TARGET_MEASUREMENTS}))")
+        if self._feature_order is not None:
+            matrix = matrix[:, self._feature_order]
+
+        with warnings.catch_warnings():
+            # 파이프라인은 DataFrame으로 학습되었지만 열 순서를 검증한 numpy 배열을 넘기므로
+            # sklearn의 "feature names" 경고는 이 호출에서만 무시합니다.
+            warnings.filterwarnings("ignore", message="X does not have valid feature names", category=UserWarning)
+            numerical_predictions = pipeline.predict(matrix)
+        return [str(label) for label in label_encoder.inverse_transform(numerical_predictions)]
+
+    def warmup(self, runs: int = 1):
+        """
+        더미 입력으로 순전파를 실행해 첫 요청의 지연(커널 선택, 메모리 할당 등)을 미리 치릅니다.
+        """
+        if self.model_to_predict is None:
+            return
+        started = time.perf_counter()
+        dummy_batch = torch.zeros((1, 3, self.IMG_HEIGHT, self.IMG_WIDTH), device=self.DEVICE)
+        with torch.no_grad():
+            for _ in range(runs):
+                self.model_to_predict(dummy_batch)
+        self.load_timings["warmup"] = time.perf_counter() - started
+
+    def memory_bytes(self) -> int:
+        """
+        로드된 모델이 차지하는 메모리(바이트)를 대략 계산합니다.
+        torch 모델은 파라미터/버퍼 크기, joblib 객체는 파일 크기로 추정합니다.
+        """
+        total = 0
+        if self.model_to_predict is not None:
+            for tensor in list(self.model_to_predict.parameters()) + list(self.model_to_predict.buffers()):
+                total += tensor.numel() * tensor.element_size()
+        loaded_files = [(self.target_scaler, self.target_scaler_save_path),
+                        (self._skin_type_model_pipeline, self.skin_type_model_filename),
+                        (self._label_encoder, self.label_encoder_filename)]
+        for obj, path in loaded_files:
+            if obj is not None and os.path.exists(path):
+                total += os.path.getsize(path)
+        return total
+
+    def _artifact_version(self) -> str:
+        """
+        측정값 모델(.pth)과 피부 타입 파이프라인 파일 내용의 해시, 전처리 설정으로 버전 문자열을 만듭니다.
+        파일이나 SKIN_INPUT_SIZE / SKIN_FACE_CROP 설정을 바꾸면 버전이 바뀌므로 어떤 분석이 어느 모델로 만들어졌는지 추적할 수 있습니다.
+        """
+        digest = hashlib.sha256()
+        for path in (self.model_save_path, self.skin_type_model_filename):
+            if not os.path.exists(path):
+                digest.update(b"missing")
+                continue
+            with open(path, "rb") as artifact:
+                for chunk in iter(lambda: artifact.read(1024 * 1024), b""):
+                    digest.update(chunk)
+        # 같은 가중치라도 전처리(입력 해상도, 얼굴 크롭)가 다르면 결과가 달라지므로 버전에 포함합니다.
+        preprocessing = f"{self.IMG_HEIGHT}px" + (f" crop{self.face_crop_margin:g}" if self.face_crop else "")
+        return f"SkinAnalyzer {digest.hexdigest()[:12]} {preprocessing}"
+
+    def is_ready(self) -> bool:
+        """측정값 모델, 스케일러, 피부 타입 파이프라인, 레이블 인코더가 모두 로드되었는지 확인합니다."""
+        return all(obj is not None for obj in (self.model_to_predict, self.target_scaler,
+                                               self.skin_type_model_pipeline, self.label_encoder))
+
+    def _log_load_timings(self):
+        breakdown = ", ".join(f"{step}={seconds * 1000:.1f}ms" for step, seconds in self.load_timings.items())
+        logger.info(f"SkinAnalyzer 로드 시간 내역: {breakdown} (합계 {sum(self.load_timings.values()) * 1000:.1f}ms)")
+
+    @staticmethod
+    def _build_transform(height: int, width: int):
+        normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+        return transforms.Compose([
+            transforms.Resize((height, width)),
+            transforms.ToTensor(),
+            normalize
+        ])
 
     def _preprocess_image(self, image: Image.Image):
         """이미지를 모델 입력에 맞게 전처리합니다."""
         return self.val_transform(image)
 
+    def _detect_face_box(self, image: Image.Image):
+        """
+        face_box를 넘겨받지 못했을 때 사용하는 가벼운 얼굴 검출기(OpenCV Haar cascade)입니다.
+        축소한 흑백 이미지에서 가장 큰 얼굴을 찾아 원본 좌표 (x, y, w, h)로 돌려줍니다. 못 찾으면 None.
+        """
+        import cv2
+        if self._face_cascade is None:
+            self._face_cascade = cv2.CascadeClassifier(os.path.join(cv2.data.haarcascades, "haarcascade_frontalface_default.xml"))
+        gray = np.asarray(image.convert('L'))
+        scale = min(1.0, 320.0 / max(gray.shape))
+        if scale < 1.0:
+            gray = cv2.resize(gray, (int(gray.shape[1] * scale), int(gray.shape[0] * scale)), interpolation=cv2.INTER_AREA)
+        faces = self._face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5)
+        if len(faces) == 0:
+            return None
+        x, y, w, h = max(faces, key=lambda face: face[2] * face[3])
+        return (int(x / scale), int(y / scale), int(w / scale), int(h / scale))
+
+    def _crop_to_face(self, image: Image.Image, face_cache=None) -> Image.Image:
+        """
+        얼굴 바운딩 박스(여백 포함)로 이미지를 자릅니다. 얼굴을 찾지 못하면 원본을 그대로 사용합니다.
+        face_cache(FaceBoxCache)에 이미 좌표가 있으면 검출을 다시 하지 않습니다.
+        """
+        if face_cache is not None and face_cache.resolved:
+            face_box = face_cache.face_box
+        else:
+            face_box = self._detect_face_box(image)
+            if face_cache is not None:
+                face_cache.store(face_box)
+        if face_box is None:
+            logger.info("얼굴 영역을 찾지 못해 전체 이미지로 피부 분석을 수행합니다.")
+            return image
+
+        x, y, w, h = face_box
+        margin_x, margin_y = int(w * self.face_crop_margin), int(h * self.face_crop_margin)
+        left, top = max(0, x - margin_x), max(0, y - margin_y)
+        right, bottom = min(image.width, x + w + margin_x), min(image.height, y + h + margin_y)
+        if right <= left or bottom <= top:
+            return image
+        return image.crop((left, top, right, bottom))
+
     # 이 메서드는 로컬 파일 경로를 받아서 피부 측정값을 예측합니다.
-    def predict_measurements_from_local_path(self, image_path: str) -> np.ndarray:
+    def predict_measurements_from_local_path(self, image_path: str, face_cache=None, return_embedding: bool = False):
         """
         단일 로컬 이미지 경로를 받아 피부 측정값을 예측합니다.
         반환값은 원래 스케일로 변환된 numpy 배열입니다.
@@ -156,37 +446,180 @@ class SkinAnalyzer:
             logger.error(f"이미지를 여는 중 문제 발생 ({image_path}): {e}")
             raise ValueError(f"이미지 파일 '{image_path}'을(를) 읽을 수 없습니다.")
 
+        return self.predict_measurements_from_image(input_image_pil, face_cache, return_embedding)
+
+    def predict_measurements_from_image(self, input_image_pil: Image.Image, face_cache=None, return_embedding: bool = False):
+        """
+        이미 디코딩된 PIL 이미지(RGB)를 받아 피부 측정값을 예측합니다.
+        return_embedding=True 이면 (측정값, 1280차원 임베딩) 튜플을 반환합니다.
+        """
+        if self.model_to_predict is None:
+            raise RuntimeError("이미지 측정값 예측 모델이 로드되지 않았습니다.")
+
+        if self.face_crop:
+            input_image_pil = self._crop_to_face(input_image_pil, face_cache)
         input_tensor = self._preprocess_image(input_image_pil) # _preprocess_image 재활용
         input_batch = input_tensor.unsqueeze(0).to(self.DEVICE)
 
+        embedding = None
         with torch.no_grad():
-            scaled_predictions = self.model_to_predict(input_batch)
+            if return_embedding:
+                scaled_predictions, features = self.model_to_predict(input_batch, return_embedding=True)
+                embedding = features.cpu().numpy().flatten()
+            else:
+                scaled_predictions = self.model_to_predict(input_batch)
         scaled_predictions_np = scaled_predictions.cpu().numpy().flatten()
 
         if self.target_scaler:
-            original_scale_predictions = self.target_scaler.inverse_transform(scaled_predictions_np.reshape(1, -1)).flatten()
-            return original_scale_predictions
+            measurements = self.target_scaler.inverse_transform(scaled_predictions_np.reshape(1, -1)).flatten()
         else:
             logger.warning("타겟 스케일러가 없어 스케일링된 측정값을 반환합니다.")
-            return scaled_predictions_np
+            measurements = scaled_predictions_np
+        if return_embedding:
+            return measurements, embedding
+        return measurements
 
     # 이 메서드가 FastAPI 엔드포인트에서 호출될 메인 함수입니다.
     # 이제 로컬 파일 경로(temp_filepath)를 받습니다.
-    def analyze_skin_from_local_path(self, local_image_path: str) -> Dict[str, Any]:
+    def analyze_skin_from_local_path(self, local_image_path: str, face_cache=None, return_embedding: bool = False) -> Dict[str, Any]:
         """
         단일 로컬 이미지 경로를 받아 피부 분석을 수행합니다.
+        face_cache: 같은 요청의 퍼스널 컬러 분석에서 찾은 얼굴 좌표(FaceBoxCache). face_crop=True일 때만 사용됩니다.
+        return_embedding: True 이면 결과에 "embedding"(np.ndarray, 1280차원)을 포함합니다. JSON 응답에 넣기 전에 빼야 합니다.
+        """
+        logger.info(f"로컬 이미지 처리 중: {local_image_path}")
+        return self._analyze_skin(lambda: self.predict_measurements_from_local_path(local_image_path, face_cache, return_embedding),
+                                  os.path.basename(local_image_path), return_embedding)
+
+    def analyze_skin_from_image(self, image: Image.Image, source_name: str = "메모리 이미지", face_cache=None,
+                                return_embedding: bool = False) -> Dict[str, Any]:
+        """
+        이미 디코딩된 PIL 이미지를 받아 피부 분석을 수행합니다. (모델 서버 등 파일이 없는 경로에서 사용)
+        """
+        return self._analyze_skin(lambda: self.predict_measurements_from_image(image.convert('RGB'), face_cache, return_embedding),
+                                  source_name, return_embedding)
+
+    def predict_measurements_batch(self, images: List[Image.Image], face_caches: List[Any] = None, return_embedding: bool = False):
         """
+        여러 PIL 이미지를 한 번의 순전파로 예측합니다. 반환값은 원래 스케일의 (N, 15) 배열입니다.
+        face_caches: 이미지마다 하나씩의 FaceBoxCache (face_crop=True일 때만 사용)
+        return_embedding=True 이면 (측정값, (N, 1280) 임베딩) 튜플을 반환합니다.
+        """
+        if self.model_to_predict is None:
+            raise RuntimeError("이미지 측정값 예측 모델이 로드되지 않았습니다.")
+        if not images:
+            empty = np.zeros((0, self.NUM_TARGET_MEASUREMENTS))
+            return (empty, np.zeros((0, 0), dtype=np.float32)) if return_embedding else empty
+
+        tensors = []
+        for i, image in enumerate(images):
+            image = image.convert('RGB')
+            if self.face_crop:
+                image = self._crop_to_face(image, face_caches[i] if face_caches else None)
+            tensors.append(self._preprocess_image(image))
+        input_batch = torch.stack(tensors).to(self.DEVICE)
+
+        embeddings = None
+        with torch.no_grad():
+            if return_embedding:
+                scaled_predictions, features = self.model_to_predict(input_batch, return_embedding=True)
+                embeddings = features.cpu().numpy()
+            else:
+                scaled_predictions = self.model_to_predict(input_batch)
+        scaled_predictions_np = scaled_predictions.cpu().numpy()
+        if self.target_scaler:
+            measurements = self.target_scaler.inverse_transform(scaled_predictions_np)
+        else:
+            logger.warning("타겟 스케일러가 없어 스케일링된 측정값을 반환합니다.")
+            measurements = scaled_predictions_np
+        if return_embedding:
+            return measurements, embeddings
+        return measurements
+
+    def analyze_skin_batch(self, images: List[Image.Image], face_caches: List[Any] = None,
+                           return_embedding: bool = False) -> List[Dict[str, Any]]:
+        """
+        여러 이미지를 배치로 분석합니다. (재분석 작업, 여러 장 업로드 등)
+        이미지마다 analyze_skin_from_image()와 같은 형식의 결과 dict를 순서대로 반환합니다.
+        """
+        if not self.is_ready():
+            return [{"error": "피부 분석 모델이 완전히 로드되지 않았습니다. 서버 로그를 확인하세요."} for _ in images]
+
+        embeddings = None
+        if return_embedding:
+            predictions, embeddings = self.predict_measurements_batch(images, face_caches, return_embedding=True)
+        else:
+            predictions = self.predict_measurements_batch(images, face_caches)
+        rounded_predictions = np.round(predictions, 2)
+        skin_types = self.classify_measurements(rounded_predictions) if len(rounded_predictions) else []
+        results = [
+            {
+                "average_measurements": {col_name: float(row[i]) for i, col_name in enumerate(self.SELECTED_MEASUREMENT_COLS)},
+                "predicted_skin_type": skin_type,
+                "measurement_columns": self.SELECTED_MEASUREMENT_COLS
+            }
+            for row, skin_type in zip(rounded_predictions, skin_types)
+        ]
+        if embeddings is not None:
+            for result, embedding in zip(results, embeddings):
+                result["embedding"] = embedding
+        return results
+
+    def evaluate_input_size(self, image_paths: List[str], input_size: int, reference_size: int = 256) -> Dict[str, Any]:
+        """
+        같은 이미지들을 reference_size와 input_size로 각각 추론해 측정값 차이(평균 절대 오차)를 계산합니다.
+        입력 해상도를 낮추기 전에 정확도 손실이 허용 범위인지 확인하는 용도입니다.
+        """
+        if self.model_to_predict is None:
+            raise RuntimeError("이미지 측정값 예측 모델이 로드되지 않았습니다.")
+
+        reference_transform = self._build_transform(reference_size, reference_size)
+        candidate_transform = self._build_transform(input_size, input_size)
+        reference_rows, candidate_rows = [], []
+        for image_path in image_paths:
+            image = Image.open(image_path).convert('RGB')
+            if self.face_crop:
+                image = self._crop_to_face(image)
+            with torch.no_grad():
+                reference_out = self.model_to_predict(reference_transform(image).unsqueeze(0).to(self.DEVICE)).cpu().numpy()
+                candidate_out = self.model_to_predict(candidate_transform(image).unsqueeze(0).to(self.DEVICE)).cpu().numpy()
+            if self.target_scaler:
+                reference_out = self.target_scaler.inverse_transform(reference_out)
+                candidate_out = self.target_scaler.inverse_transform(candidate_out)
+            reference_rows.append(reference_out.flatten())
+            candidate_rows.append(candidate_out.flatten())
+
+        if not reference_rows:
+            raise ValueError("검증할 이미지가 없습니다.")
+        reference = np.array(reference_rows)
+        candidate = np.array(candidate_rows)
+        abs_error = np.abs(candidate - reference)
+        # 컬럼마다 스케일이 다르므로 기준 측정값의 표준편차 대비 오차도 함께 제공합니다.
+        spread = reference.std(axis=0)
+        spread[spread == 0] = 1.0
+        mae_per_column = abs_error.mean(axis=0)
+        return {
+            "input_size": input_size,
+            "reference_size": reference_size,
+            "num_images": len(reference_rows),
+            "mae": {col: float(mae_per_column[i]) for i, col in enumerate(self.SELECTED_MEASUREMENT_COLS)},
+            "normalized_mae": float((mae_per_column / spread).mean()),
+        }
+
+    def _analyze_skin(self, predict, source_name: str, return_embedding: bool = False) -> Dict[str, Any]:
         if not all([self.model_to_predict, self.target_scaler, self.skin_type_model_pipeline, self.label_encoder]):
             logger.error("피부 분석 모델이 완전히 로드되지 않아 분석을 수행할 수 없습니다.")
             return {"error": "피부 분석 모델이 완전히 로드되지 않았습니다. 서버 로그를 확인하세요."}
         
         all_measurements = []
-        logger.info(f"로컬 이미지 처리 중: {local_image_path}")
+        embedding = None
         try:
-            measurements = self.predict_measurements_from_local_path(local_image_path)
+            measurements = predict()
+            if return_embedding:
+                measurements, embedding = measurements
             all_measurements.append(measurements)
         except (ValueError, RuntimeError) as e:
-            logger.warning(f"로컬 이미지 '{local_image_path}' 처리 중 오류 발생: {e}. 분석을 중단합니다.")
+            logger.warning(f"로컬 이미지 '{source_name}' 처리 중 오류 발생: {e}. 분석을 중단합니다.")
             return {"error": f"로컬 이미지 분석 실패: {str(e)}"}
 
         if not all_measurements:
@@ -196,25 +629,20 @@ class SkinAnalyzer:
         # 단일 이미지이므로 평균 계산은 단순화됩니다.
         average_predictions = np.array(all_measurements).flatten()
         
-        # 이렇게 수정합니다:
-        avg_pred_dict = {self.SELECTED_MEASUREMENT_COLS[i]: float(round(average_predictions[i], 2)) for i in range(len(self.SELECTED_MEASUREMENT_COLS))}
-        # avg_pred_dict = {self.SELECTED_MEASUREMENT_COLS[i]: round(average_predictions[i], 2) for i in range(len(self.SELECTED_MEASUREMENT_COLS))}
-        avg_pred_df = pd.DataFrame([avg_pred_dict])
+        rounded_predictions = np.round(average_predictions, 2)
+        avg_pred_dict = {col_name: float(rounded_predictions[i]) for i, col_name in enumerate(self.SELECTED_MEASUREMENT_COLS)}
 
-        logger.info(f"\n--- 로컬 이미지({os.path.basename(local_image_path)})에 대한 종합 예측 결과 ---")
+        logger.info(f"\n--- 로컬 이미지({source_name})에 대한 종합 예측 결과 ---")
         for col_name, value in avg_pred_dict.items():
             logger.info(f"{col_name}: {value:.2f}")
         
         predicted_skin_type = "예측 불가"
         if self.skin_type_model_pipeline and self.label_encoder:
             try:
-                input_for_prediction = avg_pred_df[self.SELECTED_MEASUREMENT_COLS]
-                numerical_predictions = self.skin_type_model_pipeline.predict(input_for_prediction)
-                text_predictions = self.label_encoder.inverse_transform(numerical_predictions)
-                predicted_skin_type = text_predictions[0]
+                predicted_skin_type = self.classify_measurements(rounded_predictions)[0]
                 
                 logger.info(f"\n--- 최종 피부 타입 예측 결과 ---")
-                logger.info(f"예측 피부타입: {predicted_skin_type} (인코딩된 값: {numerical_predictions[0]})")
+                logger.info(f"예측 피부타입: {predicted_skin_type}")
                 
             except Exception as e:
                 logger.error(f"피부 타입 예측 중 오류 발생: {e}", exc_info=True)
@@ -222,8 +650,11 @@ class SkinAnalyzer:
         else:
             logger.warning("피부 타입 예측 모델 또는 레이블 인코더 로드에 실패하여 피부 타입 예측을 수행할 수 없습니다.")
         
-        return {
+        result = {
             "average_measurements": avg_pred_dict,
             "predicted_skin_type": predicted_skin_type,
             "measurement_columns": self.SELECTED_MEASUREMENT_COLS
-        }
\ No newline at end of file
+        }
+        if return_embedding:
+            result["embedding"] = embedding
+        return result
\ No newline at end of file
@@ -0,0 +1,248 @@
+# benchmark.py
+# 학습된 .pth / joblib 파일 없이 SkinAnalyzer 추론 성능을 측정하는 벤치마크입니다.
+#
+# - ImageToMeasurementModel은 임의 가중치로, 타겟 스케일러/피부 타입 파이프라인/레이블 인코더는
+#   난수 데이터로 학습한 대체(stub) sklearn 객체로 만듭니다. 정확도가 아니라 속도만 봅니다.
+# - 배치 크기, 입력 해상도, torch 스레드 수, 실행 백엔드 조합을 모두 돌면서
+#   전처리 / 순전파 / 후처리 시간, 초당 이미지 수, 최대 메모리를 기록합니다.
+# - 결과는 조합마다 JSON 한 줄(JSON Lines)로 출력하므로 실행 간 비교가 쉽습니다.
+#
+# 실행 예:
+#   python -m SkinAnalysis.benchmark --batch-sizes 1,8 --input-sizes 256,224 --threads 1,4 --backends eager,torchscript
+#   python -m SkinAnalysis.benchmark --images ./samples --output bench.jsonl
+
+import argparse
+import datetime
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import torch
+from PIL import Image
+
+from SkinAnalysis.aimodel import ImageToMeasurementModel, SkinAnalyzer
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ("eager", "channels_last", "torchscript", "compile")
+_STUB_SKIN_TYPES = ["건성", "중성", "지성", "복합성"]
+
+
+# --- 대체 모델 구성 ---
+def build_stub_analyzer(input_size: int, device: Optional[str] = None, seed: int = 0) -> SkinAnalyzer:
+    """임의 가중치 모델과 난수 데이터로 학습한 sklearn 객체로 SkinAnalyzer를 만듭니다."""
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.pipeline import make_pipeline
+    from sklearn.preprocessing import LabelEncoder, StandardScaler
+
+    torch.manual_seed(seed)
+    rng = np.random.default_rng(seed)
+    num_measurements = 15
+    model = ImageToMeasurementModel(num_output_measurements=num_measurements, pretrained=False)
+
+    fake_measurements = rng.normal(size=(200, num_measurements))
+    target_scaler = StandardScaler().fit(fake_measurements)
+    label_encoder = LabelEncoder().fit(_STUB_SKIN_TYPES)
+    fake_labels = rng.integers(0, len(_STUB_SKIN_TYPES), size=len(fake_measurements))
+    pipeline = make_pipeline(StandardScaler(), LogisticRegression(max_iter=200)).fit(fake_measurements, fake_labels)
+
+    return SkinAnalyzer.from_components(model, target_scaler, pipeline, label_encoder, device=device, input_size=input_size)
+
+
+def prepare_backend(model: torch.nn.Module, backend: str, example: torch.Tensor):
+    """
+    측정할 실행 백엔드로 모델을 변환합니다. 반환값은 (호출 가능한 모델, channels_last 입력 여부)입니다.
+    """
+    if backend == "eager":
+        return model, False
+    if backend == "channels_last":
+        return model.to(memory_format=torch.channels_last), True
+    if backend == "torchscript":
+        with torch.no_grad():
+            traced = torch.jit.trace(model, example)
+        return torch.jit.optimize_for_inference(torch.jit.freeze(traced.eval())), False
+    if backend == "compile":
+        if not hasattr(torch, "compile"):
+            raise RuntimeError("현재 torch 버전은 torch.compile을 지원하지 않습니다.")
+        return torch.compile(model), False
+    raise ValueError(f"알 수 없는 백엔드입니다: {backend} (지원: {', '.join(BACKENDS)})")
+
+
+# --- 입력 이미지 ---
+def load_images(image_dir: Optional[str], count: int, image_size: int, seed: int = 0) -> List[Image.Image]:
+    """image_dir가 있으면 그 안의 이미지를, 없으면 image_size 크기의 난수 이미지를 count개 만듭니다."""
+    if image_dir:
+        names = sorted(name for name in os.listdir(image_dir) if name.lower().endswith((".jpg", ".jpeg", ".png")))
+        if not names:
+            raise ValueError(f"'{image_dir}'에 이미지 파일이 없습니다.")
+        images = [Image.open(os.path.join(image_dir, name)).convert("RGB") for name in names]
+        return [images[i % len(images)] for i in range(count)]
+    rng = np.random.default_rng(seed)
+    return [Image.fromarray(rng.integers(0, 256, size=(image_size, image_size, 3), dtype=np.uint8)) for _ in range(count)]
+
+
+# --- 측정 ---
+def _sync(device: torch.device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def _peak_rss_bytes() -> int:
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS는 바이트, 리눅스는 KB 단위
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def run_config(config: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    한 조합(batch_size, input_size, threads, backend)을 측정합니다.
+    iterations번 반복한 단계별 시간의 평균/p50/p95(ms)와 처리량, 최대 메모리를 반환합니다.
+    """
+    torch.set_num_threads(config["threads"])
+    analyzer = build_stub_analyzer(config["input_size"], device=config.get("device"))
+    device = analyzer.DEVICE
+    batch_size = config["batch_size"]
+    images = load_images(config.get("images"), batch_size, config["image_size"])
+
+    example = torch.zeros((batch_size, 3, config["input_size"], config["input_size"]), device=device)
+    model, channels_last = prepare_backend(analyzer.model_to_predict, config["backend"], example)
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats()
+
+    def run_once():
+        started = time.perf_counter()
+        batch = torch.stack([analyzer._preprocess_image(image) for image in images]).to(device)
+        if channels_last:
+            batch = batch.contiguous(memory_format=torch.channels_last)
+        _sync(device)
+        preprocessed = time.perf_counter()
+
+        with torch.no_grad():
+            scaled = model(batch)
+        _sync(device)
+        forwarded = time.perf_counter()
+
+        measurements = analyzer.target_scaler.inverse_transform(scaled.cpu().numpy())
+        analyzer.classify_measurements(np.round(measurements, 2))
+        finished = time.perf_counter()
+        return preprocessed - started, forwarded - preprocessed, finished - forwarded
+
+    for _ in range(config["warmup"]):
+        run_once()
+
+    stages = {"preprocess": [], "forward": [], "postprocess": []}
+    for _ in range(config["iterations"]):
+        preprocess, forward, postprocess = run_once()
+        stages["preprocess"].append(preprocess)
+        stages["forward"].append(forward)
+        stages["postprocess"].append(postprocess)
+
+    totals = np.sum([stages[name] for name in stages], axis=0)
+    timings_ms = {}
+    for name, values in list(stages.items()) + [("total", totals)]:
+        values_ms = np.asarray(values) * 1000
+        timings_ms[name] = {
+            "mean": float(values_ms.mean()),
+            "p50": float(np.percentile(values_ms, 50)),
+            "p95": float(np.percentile(values_ms, 95)),
+        }
+
+    result = {
+        "timings_ms": timings_ms,
+        "images_per_sec": float(batch_size * len(totals) / totals.sum()),
+        "peak_rss_bytes": _peak_rss_bytes(),
+    }
+    if device.type == "cuda":
+        result["peak_cuda_bytes"] = int(torch.cuda.max_memory_allocated())
+    return result
+
+
+def _run_config_isolated(config: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    조합마다 새 프로세스(spawn)에서 측정합니다. 최대 RSS는 프로세스 단위로만 알 수 있으므로
+    이전 조합의 메모리 사용량이 섞이지 않게 하려면 분리해서 실행해야 합니다.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(1) as pool:
+        return pool.apply(run_config, (config,))
+
+
+def _environment() -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "cuda": torch.cuda.get_device_name(0) if torch.cuda.is_available() else None,
+    }
+
+
+def _int_list(value: str) -> List[int]:
+    return [int(item) for item in value.split(",") if item.strip()]
+
+
+def _str_list(value: str) -> List[str]:
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="학습 산출물 없이 SkinAnalyzer 추론 성능을 측정합니다.")
+    parser.add_argument("--batch-sizes", type=_int_list, default=[1, 4, 8], help="배치 크기 목록 (쉼표 구분)")
+    parser.add_argument("--input-sizes", type=_int_list, default=[256, 224, 192], help="모델 입력 해상도 목록")
+    parser.add_argument("--threads", type=_int_list, default=[1, os.cpu_count() or 1], help="torch 스레드 수 목록")
+    parser.add_argument("--backends", type=_str_list, default=["eager", "channels_last", "torchscript"],
+                        help=f"실행 백엔드 목록 ({', '.join(BACKENDS)})")
+    parser.add_argument("--iterations", type=int, default=20, help="조합당 측정 반복 횟수")
+    parser.add_argument("--warmup", type=int, default=3, help="측정 전 warm-up 반복 횟수")
+    parser.add_argument("--image-size", type=int, default=640, help="난수 입력 이미지의 한 변 크기 (--images 미지정 시)")
+    parser.add_argument("--images", default=None, help="실제 이미지를 사용할 디렉터리")
+    parser.add_argument("--device", default=None, help="cpu / cuda (기본: 자동 선택)")
+    parser.add_argument("--no-isolate", action="store_true", help="모든 조합을 한 프로세스에서 실행 (빠르지만 최대 메모리가 누적됨)")
+    parser.add_argument("--output", default=None, help="결과를 이어 쓸 JSON Lines 파일 (기본: 표준 출력)")
+    parser.add_argument("--label", default=None, help="실행을 구분할 이름 (예: 브랜치명)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    run_info = {
+        "run_id": datetime.datetime.now().strftime("%Y%m%dT%H%M%S"),
+        "label": args.label,
+        "environment": _environment(),
+    }
+    output = open(args.output, "a", encoding="utf-8") if args.output else sys.stdout
+    try:
+        for batch_size, input_size, threads, backend in itertools.product(args.batch_sizes, args.input_sizes, args.threads, args.backends):
+            config = {
+                "batch_size": batch_size, "input_size": input_size, "threads": threads, "backend": backend,
+                "iterations": args.iterations, "warmup": args.warmup, "image_size": args.image_size,
+                "images": args.images, "device": args.device,
+            }
+            record = dict(run_info, config=config)
+            try:
+                record["result"] = run_config(config) if args.no_isolate else _run_config_isolated(config)
+            except Exception as e:
+                logger.error(f"벤치마크 조합 실패 {config}: {e}", exc_info=True)
+                record["error"] = str(e)
+            output.write(json.dumps(record, ensure_ascii=False) + "\n")
+            output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,375 @@
+# embedding_index.py
+# SkinAnalyzer가 만든 1280차원 피부 임베딩을 저장하고, "비슷한 피부" / "가장 가까운 기준 프로필"을 찾는 모듈입니다.
+#
+# - EmbeddingStore: L2 정규화한 임베딩을 float16으로 파일 끝에 이어 붙여 저장합니다 (analysis_idx 파일과 한 쌍).
+#   읽을 때는 np.memmap으로 열어 전체를 메모리에 올리지 않습니다.
+#   analysis_idx -> 행 번호 표를 메모리에 두고, 다른 프로세스(uvicorn 워커, 모델 서버)가 이어 붙인 행만 파일 끝에서 더 읽습니다.
+#   그래서 get은 해당 행만 읽습니다.
+#   여러 프로세스가 같은 파일에 쓰므로 추가/조회는 잠금 파일(fcntl.flock)을 잡고 하며, 행 번호는 그때의 파일 크기로 정합니다.
+# - SkinEmbeddingIndex: 정규화된 벡터의 내적(코사인 유사도)으로 검색합니다.
+#   기본은 브루트포스 행렬곱(청크 단위), 데이터가 많으면 IVF(k-means 군집 + nprobe 탐색) 모드를 쓸 수 있습니다.
+import fcntl
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_DIM = 1280
+_VECTORS_FILENAME = "embeddings.f16"
+_IDS_FILENAME = "ids.i64"
+_LOCK_FILENAME = "embeddings.lock"
+# 인덱스 생성 이후 추가된 벡터가 이만큼 쌓이면 저장소에서 인덱스를 다시 만듭니다. 0 이하면 다시 만들지 않습니다.
+SKIN_EMBEDDING_MERGE_PENDING = int(os.environ.get("SKIN_EMBEDDING_MERGE_PENDING", "1024"))
+_REFERENCE_FILENAME = "reference_profiles.npz"
+
+
+def normalize_embedding(embedding: np.ndarray) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32).reshape(-1)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+class EmbeddingStore:
+    def __init__(self, directory: str, dim: int = EMBEDDING_DIM):
+        self.directory = directory
+        self.dim = dim
+        self.vectors_path = os.path.join(directory, _VECTORS_FILENAME)
+        self.ids_path = os.path.join(directory, _IDS_FILENAME)
+        self.lock_path = os.path.join(directory, _LOCK_FILENAME)
+        self._lock = threading.Lock() # 같은 프로세스의 스레드끼리 (파일 잠금은 프로세스끼리)
+        os.makedirs(directory, exist_ok=True)
+        # analysis_idx -> 마지막으로 저장된 행 번호, 그리고 이 표에 반영된 행 수
+        self._rows: Dict[int, int] = {}
+        self._count = 0
+
+    @property
+    def _row_bytes(self) -> int:
+        return self.dim * np.dtype(np.float16).itemsize
+
+    @contextmanager
+    def _file_lock(self, exclusive: bool):
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _file_rows(self) -> int:
+        """id와 벡터가 모두 저장된 행 수 (파일 잠금을 잡은 상태에서 호출)"""
+        id_rows = os.path.getsize(self.ids_path) // np.dtype(np.int64).itemsize if os.path.exists(self.ids_path) else 0
+        vector_rows = os.path.getsize(self.vectors_path) // self._row_bytes if os.path.exists(self.vectors_path) else 0
+        return min(id_rows, vector_rows)
+
+    def _read_ids(self) -> np.ndarray:
+        """id 파일에서 벡터가 함께 저장된 행까지의 analysis_idx 배열을 읽습니다. (파일 잠금을 잡은 상태에서 호출)"""
+        count = self._file_rows()
+        if count == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.fromfile(self.ids_path, dtype=np.int64, count=count)
+
+    def _refresh_rows(self):
+        """마지막으로 읽은 뒤 (다른 프로세스가) 이어 붙인 행만 읽어 id -> 행 번호 표에 반영합니다. (두 잠금을 잡은 상태에서 호출)"""
+        count = self._file_rows()
+        if count < self._count:
+            # 파일이 교체/초기화된 경우 처음부터 다시 읽습니다.
+            self._rows, self._count = {}, 0
+        if count > self._count:
+            new_ids = np.fromfile(self.ids_path, dtype=np.int64, count=count - self._count,
+                                  offset=self._count * np.dtype(np.int64).itemsize)
+            for offset, analysis_idx in enumerate(new_ids):
+                self._rows[int(analysis_idx)] = self._count + offset # 같은 id면 마지막 행이 남음
+            self._count = count
+
+    def _truncate_partial_rows(self, rows: int):
+        """이전 추가가 중간에 실패해 남은 짝 없는 벡터/id(또는 잘린 바이트)를 잘라 두 파일의 행을 맞춥니다."""
+        for path, row_bytes in ((self.vectors_path, self._row_bytes), (self.ids_path, np.dtype(np.int64).itemsize)):
+            if os.path.exists(path) and os.path.getsize(path) != rows * row_bytes:
+                logger.warning(f"임베딩 파일의 불완전한 행을 잘라냅니다: {path} ({os.path.getsize(path)} -> {rows * row_bytes} bytes)")
+                os.truncate(path, rows * row_bytes)
+
+    def add(self, analysis_idx: int, embedding: np.ndarray):
+        """임베딩 한 개를 정규화해 float16으로 파일 끝에 추가합니다. 같은 analysis_idx가 다시 오면 나중 값이 우선합니다."""
+        vector = normalize_embedding(embedding).astype(np.float16)
+        if vector.shape[0] != self.dim:
+            raise ValueError(f"임베딩 차원이 올바르지 않습니다: {vector.shape[0]} (기대값: {self.dim})")
+        with self._lock, self._file_lock(exclusive=True):
+            row = self._file_rows()
+            self._truncate_partial_rows(row)
+            self._refresh_rows()
+            # 벡터를 먼저 쓰고 id를 나중에 씁니다. 중간에 실패해 남은 벡터는 다음 추가 때 위에서 잘라냅니다.
+            with open(self.vectors_path, "ab") as vectors_file:
+                vectors_file.write(vector.tobytes())
+            with open(self.ids_path, "ab") as ids_file:
+                ids_file.write(np.array([analysis_idx], dtype=np.int64).tobytes())
+            self._rows[int(analysis_idx)] = row
+            self._count = row + 1
+
+    def load(self) -> Tuple[np.ndarray, np.ndarray]:
+        """(ids, vectors)를 반환합니다. vectors는 읽기 전용 memmap(float16, (N, dim))입니다."""
+        with self._lock, self._file_lock(exclusive=False):
+            ids = self._read_ids()
+            if len(ids) == 0:
+                return np.zeros(0, dtype=np.int64), np.zeros((0, self.dim), dtype=np.float16)
+            vectors = np.memmap(self.vectors_path, dtype=np.float16, mode="r", shape=(len(ids), self.dim))
+
+        # 같은 analysis_idx가 여러 번 저장된 경우 마지막 행만 남깁니다.
+        _, last_positions = np.unique(ids[::-1], return_index=True)
+        if len(last_positions) != len(ids):
+            keep = np.sort(len(ids) - 1 - last_positions)
+            return ids[keep], vectors[keep]
+        return ids, vectors
+
+    def get(self, analysis_idx: int) -> Optional[np.ndarray]:
+        """analysis_idx의 마지막으로 저장된 임베딩. 파일에서 그 행만 읽습니다."""
+        with self._lock, self._file_lock(exclusive=False):
+            self._refresh_rows()
+            row = self._rows.get(int(analysis_idx))
+            if row is None:
+                return None
+            vector = np.fromfile(self.vectors_path, dtype=np.float16, count=self.dim, offset=row * self._row_bytes)
+        return vector.astype(np.float32)
+
+
+class SkinEmbeddingIndex:
+    def __init__(self, ids: np.ndarray, vectors: np.ndarray, labels: Optional[Sequence[str]] = None,
+                 mode: str = "brute", nlist: int = 256, nprobe: int = 8, chunk_size: int = 65536):
+        """
+        ids: analysis_idx 배열, vectors: 정규화된 (N, dim) 배열(float16 memmap 가능)
+        labels: 기준 프로필처럼 각 벡터에 이름이 있을 때 사용
+        mode: "brute"(정확) 또는 "ivf"(근사, 대량 데이터용)
+        """
+        self.mode = mode
+        self.nprobe = nprobe
+        self.chunk_size = chunk_size
+        self.labels = list(labels) if labels is not None else None
+        self._ids = np.asarray(ids, dtype=np.int64)
+        self._vectors = vectors
+        # 인덱스 생성 이후 추가된 벡터 (검색 시 함께 훑습니다)
+        self._pending_ids: List[int] = []
+        self._pending_vectors: List[np.ndarray] = []
+        self._lock = threading.Lock()
+
+        self._centroids = None
+        self._lists: List[np.ndarray] = []
+        if mode == "ivf" and len(self._ids) > nlist:
+            self._build_ivf(nlist)
+        elif mode == "ivf":
+            self.mode = "brute" # 데이터가 적으면 IVF가 의미 없으므로 브루트포스로 대체
+
+    @classmethod
+    def from_store(cls, store: EmbeddingStore, **kwargs) -> "SkinEmbeddingIndex":
+        ids, vectors = store.load()
+        return cls(ids, vectors, **kwargs)
+
+    def __len__(self):
+        return len(self._ids) + len(self._pending_ids)
+
+    def add(self, analysis_idx: int, embedding: np.ndarray):
+        with self._lock:
+            self._pending_ids.append(int(analysis_idx))
+            self._pending_vectors.append(normalize_embedding(embedding).astype(np.float16))
+
+    def _build_ivf(self, nlist: int, iterations: int = 10, sample_size: int = 50000, seed: int = 0):
+        """샘플에 k-means를 돌려 nlist개의 중심을 만들고 각 벡터를 가장 가까운 중심의 목록에 넣습니다."""
+        rng = np.random.default_rng(seed)
+        sample_rows = rng.choice(len(self._ids), size=min(sample_size, len(self._ids)), replace=False)
+        sample = np.asarray(self._vectors[np.sort(sample_rows)], dtype=np.float32)
+        centroids = sample[rng.choice(len(sample), size=nlist, replace=False)]
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            for c in range(nlist):
+                members = sample[assignment == c]
+                if len(members):
+                    centroids[c] = normalize_embedding(members.mean(axis=0))
+        self._centroids = centroids
+
+        assignments = np.empty(len(self._ids), dtype=np.int32)
+        for start in range(0, len(self._ids), self.chunk_size):
+            chunk = np.asarray(self._vectors[start:start + self.chunk_size], dtype=np.float32)
+            assignments[start:start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+        order = np.argsort(assignments, kind="stable")
+        boundaries = np.searchsorted(assignments[order], np.arange(nlist + 1))
+        self._lists = [order[boundaries[c]:boundaries[c + 1]] for c in range(nlist)]
+        logger.info(f"IVF 인덱스 생성 완료: 벡터 {len(self._ids)}개, 군집 {nlist}개")
+
+    def _candidate_rows(self, query: np.ndarray) -> Optional[np.ndarray]:
+        if self.mode != "ivf" or self._centroids is None:
+            return None
+        nearest = np.argsort(-(self._centroids @ query))[:self.nprobe]
+        return np.sort(np.concatenate([self._lists[c] for c in nearest]))
+
+    def search(self, embedding: np.ndarray, k: int = 10, exclude_ids: Sequence[int] = ()) -> List[Dict]:
+        """코사인 유사도가 높은 순서로 최대 k개의 {"analysis_idx", "score"(, "label")}를 반환합니다."""
+        query = normalize_embedding(embedding)
+        exclude = set(int(i) for i in exclude_ids)
+        with self._lock:
+            pending_ids = list(self._pending_ids)
+            pending_vectors = list(self._pending_vectors)
+        # 같은 analysis_idx가 다시 추가되면(재분석 등) 가장 나중 벡터의 위치만 결과에 남깁니다.
+        # (인덱스 쪽 행은 from_store에서 이미 중복이 제거되어 있습니다)
+        latest = {analysis_idx: len(self._ids) + row for row, analysis_idx in enumerate(pending_ids)}
+        # 밀려난 인덱스 행이 상위 후보 자리를 차지할 수 있으므로 그만큼 더 뽑습니다.
+        want = k + len(exclude) + len(latest)
+        best_scores: List[np.ndarray] = []
+        best_positions: List[np.ndarray] = []
+
+        candidate_rows = self._candidate_rows(query)
+        if candidate_rows is None:
+            for start in range(0, len(self._ids), self.chunk_size):
+                chunk = np.asarray(self._vectors[start:start + self.chunk_size], dtype=np.float32)
+                scores = chunk @ query
+                top = _top_k(scores, want)
+                best_scores.append(scores[top])
+                best_positions.append(top + start)
+        else:
+            for start in range(0, len(candidate_rows), self.chunk_size):
+                rows = candidate_rows[start:start + self.chunk_size]
+                scores = np.asarray(self._vectors[rows], dtype=np.float32) @ query
+                top = _top_k(scores, want)
+                best_scores.append(scores[top])
+                best_positions.append(rows[top])
+
+        if pending_vectors:
+            scores = np.stack(pending_vectors).astype(np.float32) @ query
+            best_scores.append(scores)
+            best_positions.append(np.arange(len(pending_ids)) + len(self._ids))
+
+        if not best_scores:
+            return []
+        scores = np.concatenate(best_scores)
+        positions = np.concatenate(best_positions)
+        all_ids = np.concatenate([self._ids, np.array(pending_ids, dtype=np.int64)])
+
+        results = []
+        for i in np.argsort(-scores):
+            analysis_idx = int(all_ids[positions[i]])
+            if analysis_idx in exclude or latest.get(analysis_idx, positions[i]) != positions[i]:
+                continue
+            item = {"analysis_idx": analysis_idx, "score": float(scores[i])}
+            if self.labels is not None and positions[i] < len(self.labels):
+                item["label"] = self.labels[positions[i]]
+            results.append(item)
+            if len(results) >= k:
+                break
+        return results
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    if len(scores) <= k:
+        return np.arange(len(scores))
+    return np.argpartition(-scores, k)[:k]
+
+
+# --- 기준 프로필 ---
+def build_reference_profiles(ids: np.ndarray, vectors: np.ndarray, labels_by_id: Dict[int, str]) -> Tuple[List[str], np.ndarray]:
+    """
+    analysis_idx → 레이블(예: 피부 타입) 매핑으로 레이블별 평균 임베딩(정규화)을 만듭니다.
+    """
+    sums: Dict[str, np.ndarray] = {}
+    for row, analysis_idx in enumerate(ids):
+        label = labels_by_id.get(int(analysis_idx))
+        if label is None:
+            continue
+        vector = np.asarray(vectors[row], dtype=np.float32)
+        sums[label] = sums[label] + vector if label in sums else vector.copy()
+    labels = sorted(sums)
+    profiles = np.stack([normalize_embedding(sums[label]) for label in labels]) if labels else np.zeros((0, vectors.shape[1]), dtype=np.float32)
+    return labels, profiles.astype(np.float16)
+
+
+def save_reference_profiles(directory: str, labels: List[str], profiles: np.ndarray):
+    np.savez(os.path.join(directory, _REFERENCE_FILENAME), labels=np.array(labels), profiles=profiles)
+
+
+def load_reference_index(directory: str) -> Optional[SkinEmbeddingIndex]:
+    path = os.path.join(directory, _REFERENCE_FILENAME)
+    if not os.path.exists(path):
+        return None
+    data = np.load(path)
+    labels = [str(label) for label in data["labels"]]
+    # 기준 프로필은 analysis_idx가 없으므로 행 번호를 id로 사용합니다.
+    return SkinEmbeddingIndex(np.arange(len(labels)), data["profiles"], labels=labels)
+
+
+class SkinEmbeddingCatalog:
+    """
+    저장소(EmbeddingStore) + 사용자 인덱스 + 기준 프로필 인덱스를 한데 묶어 레지스트리에 등록하는 객체입니다.
+    새 분석이 저장되면 파일과 인메모리 인덱스에 함께 추가되므로 재시작 없이 검색에 반영됩니다.
+    추가분이 merge_pending개 쌓이면 저장소에서 인덱스를 다시 만들어 검색 비용이 추가분만큼 계속 늘지 않게 합니다.
+    (이때 다른 프로세스가 저장한 임베딩도 함께 반영됩니다)
+    """
+    def __init__(self, directory: str, mode: str = "brute", nprobe: int = 8,
+                 merge_pending: int = SKIN_EMBEDDING_MERGE_PENDING):
+        self.mode = mode
+        self.nprobe = nprobe
+        self.merge_pending = merge_pending
+        self._lock = threading.Lock() # add와 인덱스 교체 사이
+        self._merging = threading.Lock()
+        self.store = EmbeddingStore(directory)
+        self.index = SkinEmbeddingIndex.from_store(self.store, mode=mode, nprobe=nprobe)
+        self.reference_index = load_reference_index(directory)
+        logger.info(f"피부 임베딩 인덱스 로드 완료: {len(self.index)}개 (mode={self.index.mode}), "
+                    f"기준 프로필 {len(self.reference_index) if self.reference_index is not None else 0}개")
+
+    def add(self, analysis_idx: int, embedding: np.ndarray):
+        self.store.add(analysis_idx, embedding)
+        with self._lock:
+            self.index.add(analysis_idx, embedding)
+            pending = len(self.index._pending_ids)
+        if 0 < self.merge_pending <= pending:
+            self._merge_pending()
+
+    def _merge_pending(self):
+        """저장소에서 인덱스를 다시 만들어 교체합니다. (이미 다른 스레드가 다시 만드는 중이면 넘어갑니다)"""
+        if not self._merging.acquire(blocking=False):
+            return
+        try:
+            with self._lock:
+                old_index = self.index
+                snapshot = len(old_index._pending_ids)
+            # 추가분은 저장소에 먼저 쓰므로 snapshot 이전 추가분은 모두 새 인덱스에 들어갑니다.
+            index = SkinEmbeddingIndex.from_store(self.store, mode=self.mode, nprobe=self.nprobe)
+            with self._lock:
+                # 다시 만드는 동안 들어온 추가분은 옮겨 둡니다. (새 인덱스에 이미 있어도 search가 중복을 걸러냅니다)
+                with old_index._lock:
+                    index._pending_ids.extend(old_index._pending_ids[snapshot:])
+                    index._pending_vectors.extend(old_index._pending_vectors[snapshot:])
+                self.index = index
+            logger.info(f"피부 임베딩 인덱스를 다시 만들었습니다: {len(index)}개 (mode={index.mode})")
+        except Exception as e:
+            logger.error(f"피부 임베딩 인덱스 재생성 실패: {e}. 기존 인덱스를 계속 사용합니다.", exc_info=True)
+        finally:
+            self._merging.release()
+
+    def similar_to(self, analysis_idx: int, k: int = 10) -> Optional[List[Dict]]:
+        """저장된 분석과 비슷한 분석 목록. 해당 분석의 임베딩이 없으면 None."""
+        embedding = self.store.get(analysis_idx)
+        if embedding is None:
+            return None
+        return self.index.search(embedding, k=k, exclude_ids=[analysis_idx])
+
+    def closest_reference(self, analysis_idx: int, k: int = 1) -> Optional[List[Dict]]:
+        embedding = self.store.get(analysis_idx)
+        if embedding is None or self.reference_index is None:
+            return None
+        return [{"label": item["label"], "score": item["score"]} for item in self.reference_index.search(embedding, k=k)]
+
+    def rebuild_reference_profiles(self, labels_by_id: Dict[int, str]) -> List[str]:
+        """analysis_idx → 피부 타입 매핑으로 기준 프로필을 다시 만들어 저장하고 바로 반영합니다."""
+        ids, vectors = self.store.load()
+        labels, profiles = build_reference_profiles(ids, vectors, labels_by_id)
+        save_reference_profiles(self.store.directory, labels, profiles)
+        self.reference_index = load_reference_index(self.store.directory)
+        return labels
+
+    def memory_bytes(self) -> int:
+        # 벡터 본체는 memmap이라 페이지 캐시에 있고, 여기서는 인메모리 부분(추가분, IVF 목록)만 셉니다.
+        pending = sum(vector.nbytes for vector in self.index._pending_vectors)
+        lists = sum(rows.nbytes for rows in self.index._lists)
+        return int(self.index._ids.nbytes + pending + lists)
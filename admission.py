@@ -0,0 +1,176 @@
+# admission.py
+# 분석 엔드포인트용 입장 제어(admission control)입니다.
+#
+# - 동시에 실행되는 분석 수를 max_concurrent로 제한합니다.
+# - 자리가 없으면 최대 max_queue개 요청까지 queue_timeout초 동안 대기시킵니다.
+# - 대기열이 가득 차면 즉시 429, 대기 시간이 지나면 503을 Retry-After 헤더와 함께 반환합니다.
+# 제어는 워커 프로세스 단위입니다. (uvicorn 워커가 N개면 전체 동시 분석 수는 최대 N * max_concurrent)
+# - 시간 예산을 넘겨 버려진(abandon) 추론 스레드가 있으면, 응답을 보낸 뒤에도 그 스레드가 끝날 때까지 자리를 잡고 있습니다.
+#   (deadlines.run_thread_stage -> hold_slot_until) 그래서 버려진 작업까지 포함해 동시 분석 수가 max_concurrent를 넘지 않습니다.
+# - 비동기 분석 작업(jobs.py)도 같은 자리를 씁니다. 작업은 이미 큐에 들어와 있으므로 거절하지 않고 자리가 날 때까지 기다립니다.
+import asyncio
+import logging
+import math
+import os
+import time
+from concurrent.futures import Future
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Optional
+
+from fastapi import HTTPException
+
+logger = logging.getLogger(__name__)
+
+
+class _SlotLease:
+    """
+    slot() 하나의 점유 상태. 요청이 끝나도(close) 붙잡힌 스레드 작업(hold)이 남아 있으면
+    마지막 작업이 끝날 때 자리를 반납합니다. 이벤트 루프에서만 상태를 바꿉니다.
+    """
+    def __init__(self, release: Callable[[], None], parent: Optional["_SlotLease"] = None):
+        self._release = release
+        # 바깥 lease(작업 관리자의 정리 lease 등). 붙잡은 스레드 작업은 바깥 lease도 함께 붙잡습니다.
+        self._parent = parent
+        self._holds = 0
+        self._closed = False
+        self._released = False
+
+    def hold_until(self, future: Future):
+        if self._parent is not None:
+            self._parent.hold_until(future)
+        if self._released:
+            return
+        self._holds += 1
+        loop = asyncio.get_running_loop()
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(self._drop))
+
+    def _drop(self):
+        self._holds -= 1
+        self._maybe_release()
+
+    def close(self):
+        self._closed = True
+        self._maybe_release()
+
+    def _maybe_release(self):
+        if self._closed and self._holds == 0 and not self._released:
+            self._released = True
+            self._release()
+
+
+_current_lease: ContextVar[Optional[_SlotLease]] = ContextVar("analysis_slot_lease", default=None)
+
+
+def hold_slot_until(future: Future) -> bool:
+    """현재 요청이 점유한 분석 자리(또는 bind_lease로 둔 lease)를 스레드 작업(future)이 끝날 때까지 유지합니다. 없으면 False."""
+    lease = _current_lease.get()
+    if lease is None:
+        return False
+    lease.hold_until(future)
+    return True
+
+
+def bind_lease(release: Callable[[], None]) -> _SlotLease:
+    """
+    analysis_admission 밖에서(작업 관리자 등) 쓰는 lease를 현재 context에 둡니다. 이후 만든 작업/스레드 단계가
+    hold_slot_until로 붙잡은 스레드가 모두 끝나고 close()가 호출되면 release를 한 번 호출합니다.
+    """
+    lease = _SlotLease(release)
+    _current_lease.set(lease)
+    return lease
+
+
+class AdmissionController:
+    def __init__(self, name: str, max_concurrent: int, max_queue: int, queue_timeout: float):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self.active = 0
+        self.waiting = 0
+        self.lingering = 0 # 요청은 끝났지만 버려진 스레드 작업 때문에 아직 반납되지 않은 자리
+        # 누적 카운터
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+        # 분석 1건 처리 시간의 지수 이동 평균(초). Retry-After 추정에 사용합니다.
+        self._avg_service_seconds = 1.0
+
+    def _retry_after(self) -> int:
+        """대기열이 빠지는 데 걸릴 시간을 대략 추정합니다. (최소 1초)"""
+        backlog = self.waiting + self.active
+        return max(1, math.ceil(backlog / self.max_concurrent * self._avg_service_seconds))
+
+    def _reject(self, status_code: int, detail: str):
+        raise HTTPException(status_code=status_code, detail=detail, headers={"Retry-After": str(self._retry_after())})
+
+    @asynccontextmanager
+    async def slot(self, wait: bool = False):
+        """
+        분석 한 건을 실행할 자리를 얻습니다. 얻지 못하면 HTTPException(429/503)을 발생시킵니다.
+        wait: 대기열 상한/대기 시간 없이 자리가 날 때까지 기다립니다. (이미 큐에 들어온 비동기 작업용)
+        """
+        if not wait and self._semaphore.locked() and self.waiting >= self.max_queue:
+            self.rejected_queue_full += 1
+            logger.warning(f"[{self.name}] 대기열이 가득 차 요청을 거절합니다. (실행 {self.active}, 대기 {self.waiting})")
+            self._reject(429, "분석 요청이 많아 잠시 후 다시 시도해 주세요.")
+
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=None if wait else self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected_timeout += 1
+            logger.warning(f"[{self.name}] 대기 시간({self.queue_timeout}초) 초과로 요청을 거절합니다.")
+            self._reject(503, "분석 서버가 혼잡합니다. 잠시 후 다시 시도해 주세요.")
+        finally:
+            self.waiting -= 1
+
+        self.active += 1
+        self.admitted += 1
+        started = time.monotonic()
+        lease = _SlotLease(self._release_lingering, parent=_current_lease.get())
+        # 같은 요청 안의 작업/스레드가 hold_slot_until로 이 자리를 찾을 수 있도록 contextvar에 둡니다.
+        _current_lease.set(lease)
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self.lingering += 1
+            self._avg_service_seconds = 0.8 * self._avg_service_seconds + 0.2 * (time.monotonic() - started)
+            lease.close()
+
+    def _release_lingering(self):
+        self.lingering -= 1
+        self._semaphore.release()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "queue_timeout": self.queue_timeout,
+            "active": self.active,
+            "lingering": self.lingering,
+            "queue_depth": self.waiting,
+            "admitted": self.admitted,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_timeout": self.rejected_timeout,
+            "avg_service_seconds": round(self._avg_service_seconds, 3),
+        }
+
+
+# 분석 엔드포인트 공용 인스턴스 (database.py의 database와 같은 방식으로 공유)
+analysis_admission = AdmissionController(
+    "analysis",
+    max_concurrent=int(os.environ.get("ANALYSIS_MAX_CONCURRENT", str(max(1, (os.cpu_count() or 2) // 2)))),
+    max_queue=int(os.environ.get("ANALYSIS_MAX_QUEUE", "8")),
+    queue_timeout=float(os.environ.get("ANALYSIS_QUEUE_TIMEOUT", "5")),
+)
+
+
+# --- FastAPI 의존성 ---
+# 라우트 데코레이터에 dependencies=[Depends(admit_analysis)]로 붙이면 핸들러 실행 동안 자리를 점유합니다.
+async def admit_analysis():
+    async with analysis_admission.slot():
+        yield
@@ -0,0 +1,227 @@
+# advice_cache.py
+# 피부 조언(/chatbot/skin_advice) Gemini 응답 캐시입니다.
+#
+# - 피부 조언 프롬프트는 요청 값(피부 타입)만으로 만들어지므로, 같은 프롬프트면 같은 조언을 재사용해도 됩니다.
+#   키는 (모델 이름 + 완성된 프롬프트)의 SHA-256이라, 프롬프트에 퍼스널 컬러 등 입력이 추가되거나 문구가 바뀌면
+#   자연히 다른 키가 됩니다.
+# - 메모리: TTL + 크기 제한 LRU. 이벤트 루프에서만 접근하므로 잠금은 두지 않습니다.
+# - 같은 키의 동시 요청은 하나만 Gemini를 호출하고 나머지는 그 결과를 함께 받습니다. (single-flight, 워커 프로세스 단위)
+#   호출은 요청과 분리된 별도 작업(create_task)에서 실행하고 모든 요청이 shield로 기다리므로,
+#   처음 호출한 요청의 연결이 끊겨도 함께 기다리던 요청은 결과를 받습니다.
+# - 디스크(선택): SKIN_ADVICE_CACHE_DIR을 지정하면 키별 JSON 파일로도 저장해 재시작 후에도 재사용합니다.
+#   만료된 파일은 읽을 때 지우고, 저장할 때 SKIN_ADVICE_CACHE_SWEEP_INTERVAL(초)마다 한 번씩 디렉터리를 정리합니다.
+#   (만료된 파일 삭제 후에도 SKIN_ADVICE_CACHE_DISK_MAX개를 넘으면 오래된 파일부터 삭제)
+# - 실패 응답(예외, 할당량 초과 안내 문구)은 캐시하지 않습니다.
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SKIN_ADVICE_CACHE_TTL = float(os.environ.get("SKIN_ADVICE_CACHE_TTL", str(24 * 3600)))
+SKIN_ADVICE_CACHE_SIZE = int(os.environ.get("SKIN_ADVICE_CACHE_SIZE", "256"))
+SKIN_ADVICE_CACHE_DIR = os.environ.get("SKIN_ADVICE_CACHE_DIR") or None
+SKIN_ADVICE_CACHE_DISK_MAX = int(os.environ.get("SKIN_ADVICE_CACHE_DISK_MAX", "4096"))
+SKIN_ADVICE_CACHE_SWEEP_INTERVAL = float(os.environ.get("SKIN_ADVICE_CACHE_SWEEP_INTERVAL", "600"))
+
+
+def advice_cache_key(model_name: str, prompt: str) -> str:
+    return hashlib.sha256(f"{model_name}\n{prompt}".encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, ttl: float = SKIN_ADVICE_CACHE_TTL, max_entries: int = SKIN_ADVICE_CACHE_SIZE,
+                 directory: Optional[str] = SKIN_ADVICE_CACHE_DIR, disk_max_files: int = SKIN_ADVICE_CACHE_DISK_MAX,
+                 sweep_interval: float = SKIN_ADVICE_CACHE_SWEEP_INTERVAL):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.directory = directory
+        self.disk_max_files = disk_max_files
+        self.sweep_interval = sweep_interval
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._inflight: Dict[str, "asyncio.Task[str]"] = {}
+        self._last_sweep = 0.0 # 첫 저장 때 한 번 정리합니다.
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.disk_evicted = 0
+
+    # --- 메모리 ---
+    def _get_memory(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _put_memory(self, key: str, value: str, expires_at: float):
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    # --- 디스크 ---
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _read_disk(self, key: str) -> Optional[Tuple[str, float]]:
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as source:
+                entry = json.load(source)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"조언 캐시 파일을 읽지 못했습니다 ({path}): {e}")
+            return None
+        if entry["expires_at"] <= time.time():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return entry["value"], entry["expires_at"]
+
+    def _write_disk(self, key: str, value: str, expires_at: float):
+        # 다른 워커가 읽다가 반쯤 쓰인 파일을 보지 않도록 임시 파일에 쓴 뒤 교체합니다.
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as target:
+                json.dump({"value": value, "expires_at": expires_at}, target, ensure_ascii=False)
+            os.replace(temp_path, self._path(key))
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def _sweep_disk(self) -> int:
+        """
+        만료된 파일(남은 임시 파일 포함)을 지우고, 그래도 disk_max_files를 넘으면 오래된 파일부터 지웁니다.
+        파일은 저장 시각 + ttl에 만료되므로 파일을 열지 않고 수정 시각으로 판단합니다.
+        """
+        now = time.time()
+        files = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file() or not entry.name.endswith((".json", ".tmp")):
+                continue
+            try:
+                files.append((entry.stat().st_mtime, entry.path))
+            except OSError:
+                continue
+        files.sort()
+        expired = [path for mtime, path in files if mtime + self.ttl <= now]
+        remaining = [path for mtime, path in files if mtime + self.ttl > now]
+        overflow = remaining[:max(0, len(remaining) - self.disk_max_files)]
+        removed = 0
+        for path in expired + overflow:
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+        return removed
+
+    # --- 공개 API ---
+    async def get(self, key: str) -> Optional[str]:
+        value = self._get_memory(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        if self.directory:
+            entry = await asyncio.to_thread(self._read_disk, key)
+            if entry is not None:
+                self.disk_hits += 1
+                self._put_memory(key, *entry)
+                return entry[0]
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, value: str):
+        expires_at = time.time() + self.ttl
+        self._put_memory(key, value, expires_at)
+        await self._put_disk(key, value, expires_at)
+
+    async def _put_disk(self, key: str, value: str, expires_at: float):
+        if not self.directory:
+            return
+        try:
+            await asyncio.to_thread(self._write_disk, key, value, expires_at)
+        except Exception as e:
+            logger.warning(f"조언 캐시 파일 저장 실패 ({key[:12]}…): {e}")
+        if time.time() - self._last_sweep >= self.sweep_interval:
+            self._last_sweep = time.time()
+            try:
+                self.disk_evicted += await asyncio.to_thread(self._sweep_disk)
+            except Exception as e:
+                logger.warning(f"조언 캐시 디렉터리 정리 실패 ({self.directory}): {e}")
+
+    def inflight(self, key: str) -> "Optional[asyncio.Task[str]]":
+        """같은 키로 진행 중인 upstream 호출이 있으면 그 작업. 결과는 asyncio.shield로 기다려야 합니다."""
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        return task
+
+    def start(self, key: str, factory: Callable[[], Awaitable[str]]) -> "asyncio.Task[str]":
+        """
+        factory를 요청과 분리된 작업으로 실행하고 진행 중으로 등록합니다. 빈 문자열이 아닌 결과만 캐시합니다.
+        호출한 요청이 취소되어도 작업은 끝까지 실행되므로 결과는 asyncio.shield로 기다립니다.
+        """
+        task = asyncio.create_task(self._create(key, factory))
+        self._inflight[key] = task
+        # 기다리는 요청이 모두 사라진 뒤 실패해도 "never retrieved" 경고가 나지 않도록
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return task
+
+    async def _create(self, key: str, factory: Callable[[], Awaitable[str]]) -> str:
+        try:
+            value = await factory()
+            if value:
+                # 진행 중 표시를 지우기 전에 메모리에 넣어, 그 사이에 들어온 요청이 upstream을 다시 호출하지 않게 합니다.
+                expires_at = time.time() + self.ttl
+                self._put_memory(key, value, expires_at)
+        finally:
+            self._inflight.pop(key, None)
+        if value:
+            await self._put_disk(key, value, expires_at)
+        return value
+
+    async def get_or_create(self, key: str, factory: Callable[[], Awaitable[str]]) -> str:
+        value = await self.get(key)
+        if value is not None:
+            return value
+        task = self.inflight(key) or self.start(key, factory)
+        # 이 요청이 취소되어도 공유 작업은 취소되지 않도록 shield
+        return await asyncio.shield(task)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "disk_directory": self.directory,
+            "disk_max_files": self.disk_max_files,
+            "disk_evicted": self.disk_evicted,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "inflight": len(self._inflight),
+        }
+
+
+skin_advice_cache = ResponseCache()
@@ -1,4 +1,7 @@
+import os
+
 from databases import Database
+from tracing import span
 
 # 데이터베이스 연결 설정을 위한 변수들
 DB_USER = "cgi_24K_AI4_p3_1"  # MySQL 사용자
@@ -10,5 +13,41 @@ DB_NAME = "cgi_24K_AI4_p3_1"  # 데이터베이스 이름
 # MySQL 연결 URI 포맷 (databases 라이브러리용)
 DATABASE_URL = f"mysql+aiomysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 
+
+
+class TracedDatabase(Database):
+    """쿼리마다 요청 추적(tracing.py)에 db.* 구간을 기록하는 Database"""
+    async def execute(self, query, values=None):
+        with span("db.execute"):
+            return await super().execute(query, values)
+
+    async def execute_many(self, query, values):
+        with span("db.execute_many"):
+            return await super().execute_many(query, values)
+
+    async def fetch_all(self, query, values=None):
+        with span("db.fetch_all"):
+            return await super().fetch_all(query, values)
+
+    async def fetch_one(self, query, values=None):
+        with span("db.fetch_one"):
+            return await super().fetch_one(query, values)
+
+    async def fetch_val(self, query, values=None, column=0):
+        with span("db.fetch_val"):
+            return await super().fetch_val(query, values, column)
+
+
+# DB 지연 제한 (드라이버 설정)
+# - connect_timeout: 연결 수립 대기(초)
+# - innodb_lock_wait_timeout: 잠금 대기(초). 잠금에 걸린 쓰기는 서버가 오류로 끝내므로 연결 상태와 커밋 여부가 분명합니다.
+# aiomysql은 쿼리 읽기 타임아웃을 제공하지 않으므로, 진행 중인 쿼리를 asyncio에서 취소하는 대신 이 두 값으로 제한합니다.
+DB_CONNECT_TIMEOUT = int(os.environ.get("DB_CONNECT_TIMEOUT", "5"))
+DB_LOCK_WAIT_TIMEOUT = int(os.environ.get("DB_LOCK_WAIT_TIMEOUT", "5"))
+
 # 비동기 데이터베이스 객체 생성
-database = Database(DATABASE_URL)
\ No newline at end of file
+database = TracedDatabase(
+    DATABASE_URL,
+    connect_timeout=DB_CONNECT_TIMEOUT,
+    init_command=f"SET SESSION innodb_lock_wait_timeout = {DB_LOCK_WAIT_TIMEOUT}",
+)
\ No newline at end of file
@@ -0,0 +1,138 @@
+# deadlines.py
+# 분석 파이프라인 단계별 시간 예산입니다.
+#
+# - 단계: decode(원본 디코딩), face_detection(얼굴 검출), dominant_color(퍼스널 컬러 대표색/KMeans),
+#         skin_inference(피부 모델 추론), storage(원본 저장)
+# - 예산은 STAGE_BUDGET_<단계 대문자> 환경 변수(초)로 바꿀 수 있고, 0 이하면 제한하지 않습니다.
+# - 예산을 넘긴 단계는 StageTimeout을 발생시키고, 호출한 쪽은 그 단계 결과 대신 timed_out 표시를 응답에 넣습니다.
+# - 스레드에서 도는 작업(디코딩, dlib, KMeans, torch, boto3 업로드)은 중간에 멈출 수 없으므로 결과를 버리고(abandon)
+#   응답을 먼저 보냅니다. 버려진 스레드는 끝까지 실행됩니다.
+#   - 추론 단계는 전용 스레드 풀(STAGE_EXECUTOR_WORKERS)에서 실행해, 버려진 작업이 기본 스레드 풀(asyncio.to_thread)을
+#     막지 않게 합니다. 또 요청의 분석 자리(admission)를 그 스레드가 끝날 때까지 유지해 동시 추론 수 상한을 지킵니다.
+#     요청/작업이 취소된 경우(연결 끊김, 서버 종료)에도 같습니다. (작업 관리자는 이 방식으로 임시 파일 정리를 미룹니다)
+#   - 스토리지 업로드는 버려진 뒤에도 객체가 늦게 저장될 수 있습니다. 키가 내용 주소이므로 같은 이미지의 다음 업로드가
+#     그 객체를 재사용합니다.
+# - DB 기록에는 시간 예산을 두지 않습니다. 진행 중인 aiomysql 쿼리를 취소하면 읽지 않은 패킷이 남은 연결이 풀로 돌아가고,
+#   이미 커밋된 행을 모르는 채로 응답하게 되기 때문입니다. DB 지연은 database.py의 드라이버 설정
+#   (connect_timeout, innodb_lock_wait_timeout)으로 제한합니다.
+import asyncio
+import contextvars
+import functools
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from admission import hold_slot_until
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_BUDGETS = {
+    "decode": 2.0,
+    "face_detection": 3.0,
+    "dominant_color": 6.0,
+    "skin_inference": 6.0,
+    "storage": 15.0,
+}
+# 전용 스레드 풀에서 실행되는 단계 (run_thread_stage)
+_THREAD_STAGES = ("decode", "face_detection", "dominant_color", "skin_inference")
+
+_stage_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("STAGE_EXECUTOR_WORKERS", str(min(32, (os.cpu_count() or 1) + 4)))),
+    thread_name_prefix="analysis-stage",
+)
+
+
+def _load_budgets() -> Dict[str, Optional[float]]:
+    budgets = {}
+    for stage, default in _DEFAULT_BUDGETS.items():
+        value = float(os.environ.get(f"STAGE_BUDGET_{stage.upper()}", str(default)))
+        budgets[stage] = value if value > 0 else None
+    return budgets
+
+
+STAGE_BUDGETS = _load_budgets()
+_stage_stats: Dict[str, Dict[str, int]] = {
+    stage: {"runs": 0, "timeouts": 0, "abandoned_running": 0} for stage in STAGE_BUDGETS
+}
+
+
+class StageTimeout(Exception):
+    def __init__(self, stage: str, budget: float):
+        super().__init__(f"{stage} 단계가 시간 예산({budget}초)을 넘었습니다.")
+        self.stage = stage
+        self.budget = budget
+
+
+def timed_out_marker(stage: str) -> Dict[str, Any]:
+    """응답에서 시간 초과된 단계 결과 자리에 넣는 표시"""
+    return {"timed_out": True, "stage": stage, "budget_seconds": STAGE_BUDGETS.get(stage)}
+
+
+async def run_stage(stage: str, awaitable: Awaitable):
+    """
+    awaitable을 단계 예산 안에서 기다립니다. 넘기면 StageTimeout을 발생시킵니다.
+    (스토리지처럼 다른 스레드 풀에 맡긴 작업은 기다림만 멈추고, 작업 자체는 그 풀에서 끝까지 실행됩니다.)
+    """
+    budget = STAGE_BUDGETS.get(stage)
+    _stage_stats[stage]["runs"] += 1
+    if budget is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, timeout=budget)
+    except asyncio.TimeoutError:
+        _stage_stats[stage]["timeouts"] += 1
+        logger.warning(f"{stage} 단계가 시간 예산({budget}초)을 넘어 기다리지 않고 부분 결과로 응답합니다.")
+        raise StageTimeout(stage, budget) from None
+
+
+async def run_thread_stage(stage: str, func: Callable, *args):
+    """
+    func(*args)를 전용 스레드 풀에서 단계 예산 안에 실행합니다. 넘기면 StageTimeout을 발생시키고,
+    스레드는 끝까지 실행되지만 결과는 버립니다. 그동안 요청의 분석 자리는 반납되지 않습니다.
+    """
+    budget = STAGE_BUDGETS.get(stage)
+    stats = _stage_stats[stage]
+    stats["runs"] += 1
+    # asyncio.to_thread처럼 contextvar(요청 추적 등)를 스레드로 넘깁니다.
+    call = functools.partial(contextvars.copy_context().run, func, *args)
+    thread_future = _stage_executor.submit(call)
+    try:
+        # shield: 시간 초과로 기다림을 멈춰도 thread_future는 취소 표시되지 않고 완료 콜백이 스레드 종료 시점에 불립니다.
+        return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(thread_future)), timeout=budget)
+    except asyncio.TimeoutError:
+        stats["timeouts"] += 1
+        held = _abandon(stats, thread_future)
+        logger.warning(
+            f"{stage} 단계가 시간 예산({budget}초)을 넘어 결과를 버리고 부분 결과로 응답합니다."
+            + (" (스레드가 끝날 때까지 분석 자리를 유지)" if held else "")
+        )
+        raise StageTimeout(stage, budget) from None
+    except asyncio.CancelledError:
+        # 기다리던 요청/작업이 취소되어도 스레드는 끝까지 실행되므로 같은 방식으로 자리를 유지합니다.
+        _abandon(stats, thread_future)
+        raise
+
+
+def _abandon(stats: Dict[str, int], thread_future) -> bool:
+    """결과를 버린 스레드 작업을 집계하고, 끝날 때까지 현재 요청의 분석 자리를 유지합니다."""
+    stats["abandoned_running"] += 1
+    loop = asyncio.get_running_loop()
+
+    def _decrement():
+        stats["abandoned_running"] -= 1
+    thread_future.add_done_callback(lambda _: loop.call_soon_threadsafe(_decrement))
+    return hold_slot_until(thread_future)
+
+
+def stage_snapshot() -> Dict[str, Any]:
+    return {
+        stage: {
+            "budget_seconds": STAGE_BUDGETS[stage],
+            "runs": stats["runs"],
+            "timeouts": stats["timeouts"],
+            # 버려졌지만 아직 스레드에서 실행 중인 작업 수
+            "abandoned_running": stats["abandoned_running"] if stage in _THREAD_STAGES else 0,
+        }
+        for stage, stats in _stage_stats.items()
+    }
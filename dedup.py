@@ -0,0 +1,201 @@
+# dedup.py
+# 같은 이미지(바이트 단위로 동일)가 다시 올라왔을 때 저장된 객체와 분석 결과를 재사용하기 위한 도우미입니다.
+#
+# - 업로드할 때 계산한 SHA-256(upload_stream.SpooledUpload.sha256)을 tb_analysis.content_hash에 기록합니다.
+# - 객체 키는 내용 주소(images/sha256/<앞 2자리>/<해시><확장자>)로 만들어 같은 바이트는 한 번만 저장합니다.
+# - 같은 해시 + 같은 모델 버전(analysis_model)의 분석이 있으면 다시 추론하지 않습니다.
+#   ANALYSIS_DEDUP_SCOPE: global(기본, 다른 사용자 분석도 재사용) | user(같은 사용자 분석만) | off
+# - 동시에 들어온 같은 이미지(모바일 재시도 등)는 해시별 잠금으로 한 요청만 분석하고 나머지는 그 결과를 재사용합니다.
+#   (잠금은 워커 프로세스 단위)
+#
+# 스키마 변경: 배포 단계에서 한 번 `python -m dedup --migrate`로 아래 ALTER를 실행합니다.
+#   서버 시작 시 ensure_content_hash_column()은 컬럼이 있는지만 확인하고, 없으면 시작을 중단합니다.
+#   (ANALYSIS_SCHEMA_AUTO_MIGRATE=1 이면 시작 시 직접 추가합니다. 여러 워커가 동시에 추가해도 먼저 추가된 컬럼을 확인하고 넘어갑니다.)
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from database import database
+
+logger = logging.getLogger(__name__)
+
+DEDUP_SCOPES = ("global", "user", "off")
+DEDUP_SCOPE = os.environ.get("ANALYSIS_DEDUP_SCOPE", "global").lower()
+if DEDUP_SCOPE not in DEDUP_SCOPES:
+    raise ValueError(f"알 수 없는 ANALYSIS_DEDUP_SCOPE: {DEDUP_SCOPE} (지원: {', '.join(DEDUP_SCOPES)})")
+
+
+CONTENT_HASH_MIGRATION = """
+ALTER TABLE tb_analysis ADD COLUMN content_hash CHAR(64) NULL,
+    ADD INDEX idx_tb_analysis_content_hash (content_hash, analysis_model)
+"""
+
+
+async def _content_hash_column_exists() -> bool:
+    return bool(await database.fetch_val(
+        """
+        SELECT COUNT(*) FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'tb_analysis' AND COLUMN_NAME = 'content_hash'
+        """
+    ))
+
+
+async def ensure_content_hash_column(migrate: Optional[bool] = None):
+    """
+    tb_analysis.content_hash 컬럼을 확인하고, migrate(기본: ANALYSIS_SCHEMA_AUTO_MIGRATE)이면 없을 때 추가합니다.
+    모든 분석 INSERT가 이 컬럼을 쓰므로, 없는 채로 시작하면 분석 API가 전부 500이 됩니다. 그래서 추가할 수 없으면 시작을 중단합니다.
+    """
+    if await _content_hash_column_exists():
+        return
+    if migrate is None:
+        migrate = os.environ.get("ANALYSIS_SCHEMA_AUTO_MIGRATE", "0").lower() in ("1", "true", "yes")
+    if not migrate:
+        raise RuntimeError(
+            "tb_analysis.content_hash 컬럼이 없습니다. `python -m dedup --migrate` 또는 다음을 실행한 뒤 서버를 시작하세요:"
+            + CONTENT_HASH_MIGRATION
+        )
+    logger.warning("tb_analysis.content_hash 컬럼이 없어 추가합니다.")
+    try:
+        await database.execute(CONTENT_HASH_MIGRATION)
+    except Exception as e:
+        # 다른 워커가 먼저 추가한 경우("Duplicate column name")에는 컬럼이 생겼으므로 그대로 진행합니다.
+        if await _content_hash_column_exists():
+            logger.info(f"tb_analysis.content_hash 컬럼은 다른 프로세스가 먼저 추가했습니다. ({e})")
+            return
+        raise RuntimeError(
+            f"tb_analysis.content_hash 컬럼을 추가하지 못했습니다 ({e}). 다음을 직접 실행하세요:" + CONTENT_HASH_MIGRATION
+        ) from e
+
+
+def file_sha256(path: str, chunk_size: int = 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as source:
+        for chunk in iter(lambda: source.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def content_object_key(content_hash: str, extension: str) -> str:
+    return f"images/sha256/{content_hash[:2]}/{content_hash}{extension}"
+
+
+async def find_existing_analysis(content_hash: str, analysis_model: Optional[str], user_id: str, scope: str = DEDUP_SCOPE):
+    """
+    재사용할 수 있는 기존 분석 행을 찾습니다. 같은 사용자의 행을 우선하며, 없으면 None.
+    analysis_model(모델 버전)을 모르면 어떤 모델로 만든 결과인지 맞춰 볼 수 없으므로 재사용하지 않습니다.
+    실패한 분석 행은 재사용하지 않습니다. (이전 버전이 실패 행에도 content_hash를 남겼으므로 조회에서도 거릅니다.)
+    """
+    if scope == "off" or not analysis_model:
+        return None
+    sql = """
+    SELECT analysis_idx, user_id, file_path, skin_tone, personal_color, analysis_result, created_at
+    FROM tb_analysis
+    WHERE content_hash = :content_hash AND analysis_model = :analysis_model
+      AND personal_color <> 'N/A'
+      AND skin_tone NOT LIKE :failed AND skin_tone NOT LIKE :errored AND skin_tone NOT LIKE :unexpected
+      AND skin_tone <> :timed_out
+    """
+    values = {
+        "content_hash": content_hash, "analysis_model": analysis_model, "user_id": user_id,
+        # routes/upload.py의 _run_skin_analysis / _skin_timed_out_result가 남기는 실패 표시
+        "failed": "%분석 실패%", "errored": "%분석 오류%", "unexpected": "%예상치 못한 오류%", "timed_out": "분석 시간 초과",
+    }
+    if scope == "user":
+        sql += " AND user_id = :user_id"
+    sql += " ORDER BY (user_id = :user_id) DESC, analysis_idx DESC LIMIT 1"
+    return await database.fetch_one(sql, values=values)
+
+
+async def record_reused_analysis(existing, user_id: str, content_hash: str, skin_embeddings=None) -> Dict[str, Any]:
+    """
+    기존 분석 행으로 응답을 만듭니다. 다른 사용자의 행이면 이 사용자 기록으로 새 행을 복사해 넣습니다.
+    (분석 이력은 사용자별로 조회되므로 행은 필요하지만, 추론과 업로드는 다시 하지 않습니다.)
+    """
+    analysis_idx = existing["analysis_idx"]
+    created_at = existing["created_at"]
+    if existing["user_id"] != user_id:
+        sql_copy = """
+        INSERT INTO tb_analysis (user_id, analysis_model, file_path, skin_tone, personal_color, analysis_result, created_at, content_hash)
+        SELECT :user_id, analysis_model, file_path, skin_tone, personal_color, analysis_result, NOW(), content_hash
+        FROM tb_analysis WHERE analysis_idx = :analysis_idx
+        """
+        source_idx = analysis_idx
+        analysis_idx = await database.execute(sql_copy, values={"user_id": user_id, "analysis_idx": source_idx})
+        created_at = None
+        # "비슷한 피부" 검색에도 새 행이 잡히도록 임베딩을 복사합니다.
+        if skin_embeddings is not None and analysis_idx:
+            try:
+                embedding = await asyncio.to_thread(skin_embeddings.store.get, source_idx)
+                if embedding is not None:
+                    await asyncio.to_thread(skin_embeddings.add, analysis_idx, embedding)
+            except Exception as e:
+                logger.error(f"피부 임베딩 복사 실패 (analysis_idx={source_idx} -> {analysis_idx}): {e}", exc_info=True)
+    logger.info(f"Reused analysis for content {content_hash[:12]}… (analysis_idx={analysis_idx}, user={user_id})")
+
+    skin_analysis_results = existing["analysis_result"]
+    if isinstance(skin_analysis_results, (str, bytes)):
+        skin_analysis_results = json.loads(skin_analysis_results)
+    return {
+        "success": True,
+        "message": "Image uploaded and analyzed successfully.",
+        "s3_url": existing["file_path"],
+        "created_at": (created_at or datetime.now()).isoformat(),
+        "personal_color_tone": existing["personal_color"],
+        "skin_analysis": skin_analysis_results,
+        "user_id": user_id,
+        "analysis_idx": analysis_idx,
+        "deduplicated": True,
+    }
+
+
+class KeyedLocks:
+    """키별 asyncio.Lock. 기다리는 요청이 없어지면 잠금을 정리합니다."""
+    def __init__(self):
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._waiters: Dict[str, int] = {}
+
+    @asynccontextmanager
+    async def hold(self, key: str):
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._waiters[key] -= 1
+            if self._waiters[key] == 0:
+                del self._waiters[key]
+                del self._locks[key]
+
+
+content_locks = KeyedLocks()
+
+
+def dedup_lock_key(content_hash: str, user_id: str, scope: Optional[str] = None) -> str:
+    scope = scope or DEDUP_SCOPE
+    return f"{content_hash}:{user_id}" if scope == "user" else content_hash
+
+
+async def _migrate():
+    await database.connect()
+    try:
+        await ensure_content_hash_column(migrate=True)
+    finally:
+        await database.disconnect()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="중복 업로드 재사용(content_hash) 스키마 관리")
+    parser.add_argument("--migrate", action="store_true", help="tb_analysis.content_hash 컬럼/인덱스가 없으면 추가합니다.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if not args.migrate:
+        parser.error("--migrate를 지정하세요.")
+    asyncio.run(_migrate())
+    print("tb_analysis.content_hash 컬럼 확인 완료")
@@ -0,0 +1,204 @@
+# derivatives.py
+# 분석한 원본 이미지에서 목록/이력 화면용 작은 파생 이미지(썸네일, 미리보기)를 만들어 원본 옆에 저장합니다.
+#
+# - 키는 원본 키에서 정해집니다: images/sha256/ab/<hash>.jpg -> images/sha256/ab/<hash>.thumb.webp, <hash>.preview.jpg
+#   그래서 DB에 따로 기록하지 않고 tb_analysis.file_path만으로 파생 이미지 키를 계산할 수 있습니다.
+# - 응답에는 실제로 저장된 파생 이미지만, 서명된 URL(presigned_get_urls, 서명 캐시 사용)로 넣습니다.
+#   버킷이 비공개여도 열리고, 아직 채우지 않은(backfill 전) 행은 파생 이미지 없이 내려갑니다.
+#   저장 여부는 스토리지에 확인하고, 저장된 것으로 확인된 키는 워커 안에 기억합니다. (내용 주소 키라 한 번 저장되면 그대로)
+# - 분석 때 이미 디코딩한 PIL 이미지를 받아 만들므로 원본을 다시 읽거나 디코딩하지 않습니다.
+# - 기존 행은 `python -m derivatives --backfill`로 채웁니다.
+import argparse
+import asyncio
+import io
+import logging
+import os
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image, features
+
+logger = logging.getLogger(__name__)
+
+# 이름 -> (긴 변 최대 픽셀, 형식, 품질)
+DERIVATIVE_SPECS: Dict[str, Tuple[int, str, int]] = {
+    "thumb": (int(os.environ.get("THUMBNAIL_MAX_SIDE", "160")), "WEBP", 75),
+    "preview": (int(os.environ.get("PREVIEW_MAX_SIDE", "640")), "JPEG", 82),
+}
+DERIVATIVE_URL_EXPIRES = int(os.environ.get("DERIVATIVE_URL_EXPIRES", "3600"))
+DERIVATIVE_KNOWN_KEYS = int(os.environ.get("DERIVATIVE_KNOWN_KEYS", "20000"))
+_EXTENSIONS = {"WEBP": ".webp", "JPEG": ".jpg"}
+_CONTENT_TYPES = {"WEBP": "image/webp", "JPEG": "image/jpeg"}
+
+
+def _output_format(requested: str) -> str:
+    # Pillow가 libwebp 없이 빌드된 경우 JPEG로 대신합니다. (키도 .jpg가 되므로 조회와 일관됨)
+    if requested == "WEBP" and not features.check("webp"):
+        return "JPEG"
+    return requested
+
+
+def derivative_key(original_key: str, name: str) -> str:
+    stem = os.path.splitext(original_key)[0]
+    return f"{stem}.{name}{_EXTENSIONS[_output_format(DERIVATIVE_SPECS[name][1])]}"
+
+
+# 저장된 것으로 확인된 파생 이미지 키 (LRU). 없다고 확인된 키는 backfill로 생길 수 있으므로 기억하지 않습니다.
+_known_stored: "OrderedDict[str, None]" = OrderedDict()
+
+
+def _remember_stored(keys):
+    for key in keys:
+        _known_stored[key] = None
+        _known_stored.move_to_end(key)
+    while len(_known_stored) > DERIVATIVE_KNOWN_KEYS:
+        _known_stored.popitem(last=False)
+
+
+async def _stored_keys(storage, keys: List[str]) -> set:
+    unknown = [key for key in dict.fromkeys(keys) if key not in _known_stored]
+    found = await asyncio.gather(*(storage.exists(key) for key in unknown), return_exceptions=True)
+    _remember_stored(key for key, exists in zip(unknown, found) if exists is True)
+    return {key for key in keys if key in _known_stored}
+
+
+async def sign_derivatives(storage, keys: Dict[str, str], expires_in: int = DERIVATIVE_URL_EXPIRES) -> Dict[str, str]:
+    """이름 -> 파생 이미지 키를 이름 -> 서명된 URL로 바꿉니다."""
+    if not keys or storage is None:
+        return {}
+    urls = await storage.presigned_get_urls(list(keys.values()), expires_in=expires_in)
+    return {name: urls[key] for name, key in keys.items()}
+
+
+async def derivative_urls_many(storage, file_paths: List[Optional[str]],
+                               expires_in: int = DERIVATIVE_URL_EXPIRES) -> List[Dict[str, str]]:
+    """
+    tb_analysis.file_path(원본 URL)마다 저장된 파생 이미지의 서명된 URL들을 반환합니다.
+    저장 여부 확인과 서명은 모든 행을 모아 한 번에 합니다. 실패하면 파생 이미지 없이 반환합니다.
+    """
+    if storage is None:
+        return [{} for _ in file_paths]
+    candidates = [
+        {name: derivative_key(storage.key_from_url(file_path), name) for name in DERIVATIVE_SPECS} if file_path else {}
+        for file_path in file_paths
+    ]
+    try:
+        stored = await _stored_keys(storage, [key for keys in candidates for key in keys.values()])
+        urls = await storage.presigned_get_urls(list(stored), expires_in=expires_in) if stored else {}
+    except Exception as e:
+        logger.warning(f"파생 이미지 URL 서명 실패: {e}")
+        return [{} for _ in file_paths]
+    return [{name: urls[key] for name, key in keys.items() if key in stored} for keys in candidates]
+
+
+async def derivative_urls(storage, file_path: Optional[str], expires_in: int = DERIVATIVE_URL_EXPIRES) -> Dict[str, str]:
+    """tb_analysis.file_path(원본 URL) 하나의 저장된 파생 이미지 URL들"""
+    return (await derivative_urls_many(storage, [file_path], expires_in))[0]
+
+
+def render_derivatives(image: Image.Image) -> Dict[str, Tuple[bytes, str]]:
+    """RGB PIL 이미지로 파생 이미지들을 인코딩합니다. 반환값: 이름 -> (바이트, content type)"""
+    rendered = {}
+    # 큰 크기부터 줄여 가며 다음 크기의 입력으로 재사용합니다.
+    source = image
+    for name, (max_side, requested_format, quality) in sorted(DERIVATIVE_SPECS.items(), key=lambda item: -item[1][0]):
+        output_format = _output_format(requested_format)
+        resized = source.copy()
+        resized.thumbnail((max_side, max_side), Image.LANCZOS, reducing_gap=2.0)
+        buffer = io.BytesIO()
+        save_options = {"quality": quality}
+        if output_format == "JPEG":
+            save_options.update(optimize=True, progressive=True)
+        else:
+            save_options["method"] = 4
+        resized.save(buffer, format=output_format, **save_options)
+        rendered[name] = (buffer.getvalue(), _CONTENT_TYPES[output_format])
+        source = resized
+    return rendered
+
+
+async def store_derivatives(storage, original_key: str, image: Image.Image) -> Dict[str, str]:
+    """
+    파생 이미지를 만들어 원본 옆에 동시에 올리고 이름 -> 저장한 키를 반환합니다. (응답용 URL은 sign_derivatives로 서명)
+    파생 이미지는 부가 기능이므로 실패해도 예외를 올리지 않고 빈 dict를 반환합니다.
+    """
+    try:
+        rendered = await asyncio.to_thread(render_derivatives, image)
+        keys = {name: derivative_key(original_key, name) for name in rendered}
+        await asyncio.gather(*(
+            storage.put(keys[name], payload, content_type) for name, (payload, content_type) in rendered.items()
+        ))
+        _remember_stored(keys.values())
+        return keys
+    except Exception as e:
+        logger.error(f"파생 이미지 생성/저장 실패 ({original_key}): {e}", exc_info=True)
+        return {}
+
+
+# --- 기존 행 채우기 ---
+async def backfill(concurrency: int, page_size: int, overwrite: bool):
+    from database import database
+    from storage import build_storage
+
+    storage = build_storage(concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+    done = skipped = failed = 0
+
+    async def process(file_path: str):
+        nonlocal done, skipped, failed
+        async with semaphore:
+            original_key = storage.key_from_url(file_path)
+            try:
+                if not overwrite and all([
+                    await storage.exists(derivative_key(original_key, name)) for name in DERIVATIVE_SPECS
+                ]):
+                    skipped += 1
+                    return
+                payload = await storage.get(original_key)
+                image = await asyncio.to_thread(lambda: Image.open(io.BytesIO(payload)).convert('RGB'))
+                if await store_derivatives(storage, original_key, image):
+                    done += 1
+                else:
+                    failed += 1
+            except Exception as e:
+                logger.warning(f"{file_path} 파생 이미지 생성 실패: {e}")
+                failed += 1
+
+    await database.connect()
+    try:
+        last_idx = 0
+        while True:
+            # 같은 이미지(내용 주소 키)를 여러 행이 가리킬 수 있으므로 페이지 안에서 중복을 제거합니다.
+            rows = await database.fetch_all(
+                "SELECT analysis_idx, file_path FROM tb_analysis WHERE analysis_idx > :last_idx ORDER BY analysis_idx LIMIT :page_size",
+                values={"last_idx": last_idx, "page_size": page_size}
+            )
+            if not rows:
+                break
+            await asyncio.gather(*(process(file_path) for file_path in {row["file_path"] for row in rows if row["file_path"]}))
+            last_idx = rows[-1]["analysis_idx"]
+            logger.info(f"analysis_idx ~{last_idx}: 생성 {done}, 건너뜀 {skipped}, 실패 {failed}")
+    finally:
+        storage.close()
+        await database.disconnect()
+    logger.info(f"파생 이미지 채우기 완료: 생성 {done}, 건너뜀 {skipped}, 실패 {failed}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="tb_analysis의 기존 이미지에 썸네일/미리보기를 만들어 저장합니다.")
+    parser.add_argument("--backfill", action="store_true", help="tb_analysis 전체를 훑어 없는 파생 이미지를 만듭니다")
+    parser.add_argument("--concurrency", type=int, default=8, help="동시에 처리할 이미지 수")
+    parser.add_argument("--page-size", type=int, default=200, help="한 번에 읽을 행 수")
+    parser.add_argument("--overwrite", action="store_true", help="이미 있는 파생 이미지도 다시 만듭니다")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    from dotenv import load_dotenv
+    load_dotenv()
+    if not args.backfill:
+        parser.error("--backfill 을 지정하세요.")
+    asyncio.run(backfill(args.concurrency, args.page_size, args.overwrite))
+
+
+if __name__ == '__main__':
+    main()
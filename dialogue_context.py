@@ -0,0 +1,151 @@
+# dialogue_context.py
+# 사용자별 최근 대화(tb_chatbot) 버퍼입니다. /chatbot/dialogue가 프롬프트를 만들 때마다 DB를 조회하지 않도록 합니다.
+#
+# - 쓰기 통과(write-through): 메시지를 tb_chatbot에 INSERT한 직후 append로 버퍼에도 넣습니다.
+# - 사용자별로 최근 DIALOGUE_CONTEXT_TURNS개만 보관(ring buffer)하고, 사용자 수는 DIALOGUE_CONTEXT_USERS로 제한해
+#   가장 오래 안 쓴 사용자부터 버립니다(LRU).
+# - 버퍼에 없는 사용자는 DB에서 한 번 읽어 채웁니다. 같은 사용자의 동시 조회는 진행 중인 읽기 작업 하나를 함께 기다립니다.
+#   읽는 도중 같은 사용자의 새 메시지가 들어오면 읽은 결과가 그 메시지를 빠뜨렸을 수 있으므로 버퍼에 넣지 않습니다.
+#   (다음 조회 때 다시 읽음)
+# - 버퍼는 워커 프로세스마다 따로입니다. 같은 사용자의 요청이 다른 워커로 가면 이 워커의 버퍼에는 그 대화가 없으므로,
+#   버퍼마다 반영한 마지막 chatbot_idx(watermark)를 두고, 조회할 때 그보다 큰 chatbot_idx만 DB에서 확인합니다.
+#   (user_id 인덱스만 읽는 가벼운 조회) 이 워커가 append하지 않은 행이 있으면 DB에서 다시 읽습니다.
+# - 이벤트 루프에서만 접근하므로 잠금은 두지 않습니다.
+import asyncio
+import logging
+import os
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
+
+from database import database
+
+logger = logging.getLogger(__name__)
+
+DIALOGUE_CONTEXT_TURNS = int(os.environ.get("DIALOGUE_CONTEXT_TURNS", "10"))
+DIALOGUE_CONTEXT_USERS = int(os.environ.get("DIALOGUE_CONTEXT_USERS", "1000"))
+
+# (chatbot_role, chatbot_text)
+Turn = Tuple[str, str]
+
+
+class _UserTurns:
+    def __init__(self, turns: List[Turn], watermark: int, maxlen: int):
+        self.turns: Deque[Turn] = deque(turns, maxlen=maxlen)
+        # 이 버퍼가 반영한 DB의 마지막 chatbot_idx, 그 이후 이 워커가 append한 chatbot_idx
+        self.watermark = watermark
+        self.appended: Set[int] = set()
+
+
+class DialogueContextBuffer:
+    def __init__(self, turns: int = DIALOGUE_CONTEXT_TURNS, max_users: int = DIALOGUE_CONTEXT_USERS):
+        self.turns = turns
+        self.max_users = max_users
+        self._users: "OrderedDict[str, _UserTurns]" = OrderedDict()
+        # DB에서 읽는 중인 사용자 -> 읽기 작업. 요청이 취소되어도 함께 기다리는 요청에 영향이 없도록 별도 작업으로 실행합니다.
+        self._loading: Dict[str, "asyncio.Task[List[Turn]]"] = {}
+        # 읽는 동안 새 메시지가 들어온 사용자
+        self._dirty: Set[str] = set()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0 # 다른 워커가 저장한 메시지가 있어 다시 읽은 횟수
+
+    async def _load(self, user_id: str, limit: int) -> Tuple[List[Turn], int]:
+        """최근 limit개의 대화(오래된 메시지가 먼저)와 그중 가장 큰 chatbot_idx를 반환합니다."""
+        rows = await database.fetch_all(
+            """
+            SELECT chatbot_idx, chatbot_role, chatbot_text
+            FROM tb_chatbot
+            WHERE user_id = :user_id
+            ORDER BY created_at DESC, chatbot_idx DESC
+            LIMIT :limit
+            """,
+            {"user_id": user_id, "limit": limit}
+        )
+        watermark = max((row["chatbot_idx"] for row in rows), default=0)
+        return [(row["chatbot_role"], row["chatbot_text"]) for row in reversed(rows)], watermark
+
+    async def _is_current(self, user_id: str, entry: _UserTurns) -> bool:
+        """버퍼 이후 DB에 저장된 메시지가 모두 이 워커가 append한 것이면 True."""
+        rows = await database.fetch_all(
+            "SELECT chatbot_idx FROM tb_chatbot WHERE user_id = :user_id AND chatbot_idx > :watermark",
+            {"user_id": user_id, "watermark": entry.watermark}
+        )
+        new_ids = {row["chatbot_idx"] for row in rows}
+        if not new_ids <= entry.appended:
+            return False
+        if new_ids:
+            entry.watermark = max(new_ids)
+            entry.appended = {chatbot_idx for chatbot_idx in entry.appended if chatbot_idx > entry.watermark}
+        return True
+
+    async def recent(self, user_id: str, limit: int) -> List[Turn]:
+        """최근 limit개의 대화를 오래된 순서로 반환합니다. 버퍼에 없거나 다른 워커가 쓴 메시지가 있으면 DB에서 읽어 채웁니다."""
+        entry = self._users.get(user_id)
+        if entry is not None and limit <= self.turns:
+            self._users.move_to_end(user_id)
+            if await self._is_current(user_id, entry):
+                self.hits += 1
+                return list(entry.turns)[-limit:] if limit > 0 else []
+            self.stale += 1
+            if self._users.get(user_id) is entry:
+                del self._users[user_id]
+        self.misses += 1
+        if limit > self.turns or self.max_users <= 0:
+            # 버퍼보다 많이 요청하면 버퍼를 거치지 않고 읽습니다.
+            turns, _ = await self._load(user_id, limit)
+            return turns
+
+        task = self._loading.get(user_id)
+        if task is None:
+            self._dirty.discard(user_id)
+            task = asyncio.create_task(self._fill(user_id))
+            self._loading[user_id] = task
+        loaded = await asyncio.shield(task)
+        return loaded[-limit:] if limit > 0 else []
+
+    async def _fill(self, user_id: str) -> List[Turn]:
+        try:
+            loaded, watermark = await self._load(user_id, self.turns)
+        finally:
+            del self._loading[user_id]
+        if user_id in self._dirty:
+            self._dirty.discard(user_id)
+            return loaded
+        self._users[user_id] = _UserTurns(loaded, watermark, self.turns)
+        self._users.move_to_end(user_id)
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+        return loaded
+
+    def append(self, user_id: str, chatbot_role: str, chatbot_text: str, chatbot_idx: Optional[int] = None):
+        """
+        tb_chatbot에 저장한 메시지(chatbot_idx: INSERT로 받은 키)를 버퍼에도 넣습니다.
+        버퍼에 없는 사용자는 다음 조회 때 DB에서 읽습니다.
+        """
+        if user_id in self._loading:
+            self._dirty.add(user_id)
+        entry = self._users.get(user_id)
+        if entry is None:
+            return
+        if not chatbot_idx:
+            # 어떤 행인지 모르면 watermark와 맞춰 볼 수 없으므로 다음 조회 때 다시 읽습니다.
+            del self._users[user_id]
+            return
+        if chatbot_idx <= entry.watermark:
+            return # INSERT 이후 다시 읽은 버퍼에 이미 들어 있음
+        entry.turns.append((chatbot_role, chatbot_text))
+        entry.appended.add(chatbot_idx)
+        self._users.move_to_end(user_id)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "users": len(self._users),
+            "max_users": self.max_users,
+            "turns_per_user": self.turns,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale_reloads": self.stale,
+        }
+
+
+dialogue_context = DialogueContextBuffer()
@@ -0,0 +1,304 @@
+# jobs.py
+# 오래 걸리는 분석을 HTTP 요청과 분리해 실행하는 작업(job) 관리자입니다.
+#
+# - submit()은 작업을 큐에 넣고 작업 ID를 바로 돌려줍니다. 워커 풀이 큐에서 꺼내 등록된 핸들러를 실행합니다.
+# - 클라이언트는 GET /jobs/{id}로 상태를 조회하거나 GET /jobs/{id}/events(SSE)로 완료를 구독합니다.
+# - 큐 백엔드는 JobQueue 인터페이스로 교체할 수 있습니다. (JOB_QUEUE_BACKEND, 기본값 memory)
+#   작업 상태와 업로드 임시 파일은 워커 프로세스에 있으므로, 프로세스 밖 큐를 붙이려면 payload에 스토리지 키처럼
+#   다른 프로세스에서도 읽을 수 있는 값만 넣어야 합니다.
+# - 끝난 작업은 JOB_RESULT_TTL초 동안 보관한 뒤 정리합니다.
+# - payload 정리(임시 파일 삭제)는 핸들러와, 핸들러가 버린 추론 스레드(deadlines.run_thread_stage)가 모두 끝난 뒤에 합니다.
+#   서버 종료 시에도 취소된 작업의 스레드를 최대 JOB_SHUTDOWN_GRACE초 기다린 뒤 정리합니다.
+import asyncio
+import functools
+import logging
+import os
+import time
+import uuid
+from abc import ABC, abstractmethod
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Set
+
+from fastapi import HTTPException
+
+from admission import bind_lease
+
+logger = logging.getLogger(__name__)
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+_FINISHED = (JOB_SUCCEEDED, JOB_FAILED)
+
+
+class Job:
+    def __init__(self, kind: str, payload: Dict[str, Any]):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.payload = payload
+        self.status = JOB_QUEUED
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        # SSE 구독자별 알림 큐
+        self.subscribers: List[asyncio.Queue] = []
+
+    @property
+    def finished(self) -> bool:
+        return self.status in _FINISHED
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+# --- 큐 백엔드 ---
+class JobQueue(ABC):
+    """작업 ID를 주고받는 큐 인터페이스. put은 가득 차면 asyncio.QueueFull을 발생시켜야 합니다."""
+    @abstractmethod
+    async def put(self, job_id: str):
+        ...
+
+    @abstractmethod
+    async def get(self) -> str:
+        ...
+
+    @abstractmethod
+    def qsize(self) -> int:
+        ...
+
+
+class InMemoryJobQueue(JobQueue):
+    def __init__(self, max_size: int):
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_size)
+
+    async def put(self, job_id: str):
+        self._queue.put_nowait(job_id)
+
+    async def get(self) -> str:
+        return await self._queue.get()
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+
+QUEUE_BACKENDS: Dict[str, Callable[[int], JobQueue]] = {
+    "memory": InMemoryJobQueue,
+}
+
+
+def build_job_queue(max_size: int) -> JobQueue:
+    backend = os.environ.get("JOB_QUEUE_BACKEND", "memory").lower()
+    if backend not in QUEUE_BACKENDS:
+        raise ValueError(f"알 수 없는 JOB_QUEUE_BACKEND: {backend} (지원: {', '.join(QUEUE_BACKENDS)})")
+    return QUEUE_BACKENDS[backend](max_size)
+
+
+# --- 작업 관리자 ---
+JobHandler = Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]]
+JobCleanup = Callable[[Dict[str, Any]], None]
+
+
+class JobManager:
+    def __init__(self, name: str, workers: int, max_queue: int, result_ttl: float, shutdown_grace: float = 30.0):
+        self.name = name
+        self.workers = workers
+        self.max_queue = max_queue
+        self.result_ttl = result_ttl
+        self.shutdown_grace = shutdown_grace
+        self._queue: Optional[JobQueue] = None
+        self._jobs: Dict[str, Job] = {}
+        self._handlers: Dict[str, JobHandler] = {}
+        self._cleanups: Dict[str, JobCleanup] = {}
+        self._worker_tasks: List[asyncio.Task] = []
+        # 시작했지만 아직 payload를 정리하지 않은 작업 ID와, 모두 정리되면 설정되는 이벤트
+        self._uncleaned: Set[str] = set()
+        self._all_cleaned: Optional[asyncio.Event] = None
+        # 누적 카운터
+        self.submitted = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.rejected_queue_full = 0
+
+    def register_handler(self, kind: str, handler: JobHandler, cleanup: Optional[JobCleanup] = None):
+        """
+        kind 작업을 실행할 비동기 핸들러를 등록합니다. 핸들러의 반환값(JSON 직렬화 가능)이 작업 결과가 됩니다.
+        cleanup은 작업이 끝나거나 실행되지 못하고 버려질 때 payload 정리(임시 파일 삭제 등)를 위해 호출됩니다.
+        """
+        self._handlers[kind] = handler
+        if cleanup is not None:
+            self._cleanups[kind] = cleanup
+
+    def start(self):
+        """이벤트 루프 안(lifespan)에서 호출해야 합니다."""
+        if self._worker_tasks:
+            return
+        self._queue = build_job_queue(self.max_queue)
+        self._all_cleaned = asyncio.Event()
+        self._all_cleaned.set()
+        self._worker_tasks = [asyncio.create_task(self._worker(index)) for index in range(self.workers)]
+        logger.info(f"[{self.name}] 작업 워커 {self.workers}개 시작")
+
+    async def stop(self):
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+        # 실행되지 못한 작업은 실패로 표시하고 payload를 정리합니다.
+        for job in self._jobs.values():
+            if not job.finished:
+                self._finish(job, error="서버가 종료되어 작업이 취소되었습니다.")
+                self._cleanup(job)
+        # 취소된 작업의 추론 스레드가 아직 임시 파일을 읽고 있을 수 있으므로, 그 스레드들이 끝나 정리될 때까지 기다립니다.
+        if self._all_cleaned is not None and not self._all_cleaned.is_set():
+            try:
+                await asyncio.wait_for(self._all_cleaned.wait(), timeout=self.shutdown_grace)
+            except asyncio.TimeoutError:
+                logger.warning(f"[{self.name}] 추론 스레드가 {self.shutdown_grace}초 안에 끝나지 않아 "
+                               f"작업 {len(self._uncleaned)}개의 payload를 정리하지 못했습니다.")
+        logger.info(f"[{self.name}] 작업 워커 종료")
+
+    async def submit(self, kind: str, payload: Dict[str, Any]) -> Job:
+        """
+        작업을 큐에 넣습니다. 큐가 가득 차면 429 HTTPException을 발생시키며, 이때 payload 정리는 호출한 쪽 책임입니다.
+        """
+        if kind not in self._handlers:
+            raise ValueError(f"등록되지 않은 작업 종류: {kind}")
+        if self._queue is None:
+            raise HTTPException(status_code=503, detail="작업 큐가 준비되지 않았습니다.")
+        self._prune()
+        job = Job(kind, payload)
+        try:
+            await self._queue.put(job.id)
+        except asyncio.QueueFull:
+            self.rejected_queue_full += 1
+            logger.warning(f"[{self.name}] 작업 큐가 가득 차 요청을 거절합니다. (대기 {self._queue.qsize()})")
+            raise HTTPException(status_code=429, detail="분석 요청이 많아 잠시 후 다시 시도해 주세요.",
+                                headers={"Retry-After": "5"})
+        self._jobs[job.id] = job
+        self.submitted += 1
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    async def events(self, job_id: str, keepalive: float = 15.0) -> AsyncIterator[Optional[Dict[str, Any]]]:
+        """
+        작업 상태가 바뀔 때마다 to_dict()를 내보내고, 끝나면 종료합니다.
+        keepalive초 동안 변화가 없으면 None을 내보냅니다. (SSE 연결 유지용)
+        """
+        job = self._jobs.get(job_id)
+        if job is None:
+            return
+        updates: asyncio.Queue = asyncio.Queue()
+        job.subscribers.append(updates)
+        try:
+            state = job.to_dict()
+            yield state
+            while state["status"] not in _FINISHED:
+                try:
+                    state = await asyncio.wait_for(updates.get(), timeout=keepalive)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                yield state
+        finally:
+            job.subscribers.remove(updates)
+
+    async def _worker(self, index: int):
+        while True:
+            job_id = await self._queue.get()
+            job = self._jobs.get(job_id)
+            if job is None or job.finished:
+                continue
+            job.status = JOB_RUNNING
+            job.started_at = time.time()
+            self._publish(job)
+            # 핸들러가 버린 스레드 단계가 hold_slot_until로 이 lease를 붙잡으므로, 정리는 그 스레드들이 끝난 뒤 실행됩니다.
+            self._uncleaned.add(job.id)
+            self._all_cleaned.clear()
+            lease = bind_lease(functools.partial(self._cleanup, job))
+            try:
+                result = await self._handlers[job.kind](job.payload)
+            except asyncio.CancelledError:
+                self._finish(job, error="서버가 종료되어 작업이 취소되었습니다.")
+                raise
+            except HTTPException as e:
+                self._finish(job, error=str(e.detail))
+            except Exception as e:
+                logger.error(f"[{self.name}] 작업 {job.id}({job.kind}) 실패: {e}", exc_info=True)
+                self._finish(job, error="작업 처리 중 오류가 발생했습니다.")
+            else:
+                self._finish(job, result=result)
+            finally:
+                lease.close()
+
+    def _finish(self, job: Job, result: Optional[Dict[str, Any]] = None, error: Optional[str] = None):
+        job.status = JOB_FAILED if error is not None else JOB_SUCCEEDED
+        job.result = result
+        job.error = error
+        job.finished_at = time.time()
+        if error is not None:
+            self.failed += 1
+        else:
+            self.succeeded += 1
+        self._publish(job)
+
+    def _cleanup(self, job: Job):
+        cleanup = self._cleanups.get(job.kind)
+        if cleanup is not None:
+            try:
+                cleanup(job.payload)
+            except Exception as e:
+                logger.warning(f"[{self.name}] 작업 {job.id} payload 정리 실패: {e}")
+        self._uncleaned.discard(job.id)
+        if not self._uncleaned and self._all_cleaned is not None:
+            self._all_cleaned.set()
+
+    def _publish(self, job: Job):
+        state = job.to_dict()
+        for updates in job.subscribers:
+            updates.put_nowait(state)
+
+    def _prune(self):
+        cutoff = time.time() - self.result_ttl
+        expired = [job_id for job_id, job in self._jobs.items() if job.finished and job.finished_at < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def snapshot(self) -> Dict[str, Any]:
+        statuses: Dict[str, int] = {}
+        for job in self._jobs.values():
+            statuses[job.status] = statuses.get(job.status, 0) + 1
+        return {
+            "workers": len(self._worker_tasks),
+            "max_queue": self.max_queue,
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "jobs": statuses,
+            "submitted": self.submitted,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "rejected_queue_full": self.rejected_queue_full,
+        }
+
+
+# 분석 작업 공용 인스턴스 (admission.py의 analysis_admission과 같은 방식으로 공유)
+# 워커 수는 큐에서 동시에 꺼내는 작업 수입니다. 실제 분석은 핸들러가 analysis_admission 자리를 얻은 뒤 실행하므로
+# 동기 요청과 합친 동시 분석 수는 ANALYSIS_MAX_CONCURRENT로 제한됩니다.
+analysis_jobs = JobManager(
+    "analysis",
+    workers=int(os.environ.get("ANALYSIS_JOB_WORKERS", str(max(1, (os.cpu_count() or 2) // 2)))),
+    max_queue=int(os.environ.get("ANALYSIS_JOB_MAX_QUEUE", "64")),
+    result_ttl=float(os.environ.get("JOB_RESULT_TTL", "600")),
+    shutdown_grace=float(os.environ.get("JOB_SHUTDOWN_GRACE", "30")),
+)
@@ -1,12 +1,21 @@
 from fastapi import FastAPI, HTTPException ,Request
 from routes.user import router as user_router  # routes 폴더에서 user.py의 router 가져오기
-from routes.upload import router as upload_router  # routes 폴더에서 user.py의 router 가져오기
+from routes.upload import router as upload_router, local_files_router, MAX_BATCH_IMAGES  # routes 폴더에서 user.py의 router 가져오기
 from routes.chatbot import router as chatbot_router  # routes 폴더에서 user.py의 router 가져오기
 from routes.analysis import router as analysis_router  # routes 폴더에서 user.py의 router 가져오기
 from routes.analysis import router as analysis_router  # routes 폴더에서 user.py의 router 가져오기
+from routes.admin import router as admin_router  # 모델 레지스트리 상태 조회 등 관리용 라우터
+from routes.jobs import router as jobs_router  # 비동기 분석 작업 상태 조회 (폴링/SSE)
 from database import database  # database.py에서 인스턴스를 가져오기
+from model_registry import registry  # 워커 공용 모델 레지스트리
+from jobs import analysis_jobs  # 비동기 분석 작업 워커 풀
+from dedup import ensure_content_hash_column  # tb_analysis.content_hash 스키마 확인/추가
 from sqlalchemy import text
 from fastapi.middleware.cors import CORSMiddleware
+from upload_stream import UploadSizeLimitMiddleware  # 너무 큰 업로드를 본문 파싱 전에 거절
+from tracing import TracingMiddleware  # 요청별 구간 추적 (Server-Timing 헤더, 요청 로그)
+from contextlib import asynccontextmanager
+import asyncio
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -19,36 +28,58 @@ import logging
 # 기본 로깅 레벨을 WARNING으로 설정
 # logging.basicConfig(level=logging.DEBUG)
 logging.basicConfig(level=logging.WARNING)
+# 요청마다 남기는 구조화 로그 한 줄(tracing.py)은 INFO로 출력합니다. REQUEST_LOG_LEVEL=WARNING 이면 끔
+logging.getLogger("request").setLevel(os.environ.get("REQUEST_LOG_LEVEL", "INFO"))
 
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    print("Server startup - Initializing resources")
+    await database.connect()
+    print("DB연결완료")
+    # 분석 INSERT가 쓰는 컬럼이 없으면 시작을 중단합니다. (요청마다 500이 나는 것보다 낫습니다. 추가는 `python -m dedup --migrate`)
+    await ensure_content_hash_column()
+    # 모델/클라이언트는 워커당 한 번만 로드하여 모든 라우터가 공유합니다.
+    await asyncio.to_thread(registry.load_all)
+    analysis_jobs.start()
+    yield
+    await analysis_jobs.stop()
+    print("DB연결해제")
+    print("Server shutdown - Cleaning up resources")
+    registry.unload_all()
+    await database.disconnect()
+
+
 # FastAPI 인스턴스 생성
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 # 라우터 등록
 app.include_router(user_router, prefix="/user")
 app.include_router(upload_router, prefix="/images")
 app.include_router(chatbot_router, prefix="/chatbot")
 app.include_router(analysis_router, prefix="/analysis")
+app.include_router(admin_router, prefix="/admin")
+app.include_router(jobs_router, prefix="/jobs")
 
+# 로컬 스토리지(STORAGE_BACKEND=local)를 쓰는 경우 저장된 이미지를 서빙합니다.
+# S3 presigned URL처럼 서명(만료 포함)을 확인한 요청만 내려줍니다. (정적 파일로 그대로 공개하지 않음)
+if os.environ.get("STORAGE_BACKEND", "s3").lower() == "local":
+    app.include_router(local_files_router, prefix=os.environ.get("LOCAL_STORAGE_BASE_URL", "/files").rstrip("/"))
+
+# CORS 미들웨어보다 먼저 등록해야 413 응답에도 CORS 헤더가 붙습니다.
+# 배치 분석은 이미지 여러 장을 한 요청으로 받으므로 요청 상한을 장 수만큼 늘립니다. (장당 상한은 spool_upload가 검사)
+app.add_middleware(UploadSizeLimitMiddleware, max_files={"/images/upload-and-analyze/batch": MAX_BATCH_IMAGES})
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # 모든 도메인 허용. 필요시 특정 도메인으로 제한.
     allow_credentials=True,
     allow_methods=["*"],  # 모든 HTTP 메서드 허용.
     allow_headers=["*"],  # 모든 헤더 허용.
+    expose_headers=["Server-Timing", "X-Trace-Id"],  # 다른 도메인의 프론트에서도 구간 시간을 볼 수 있도록
 )
+# 마지막에 등록한 미들웨어가 가장 바깥에서 실행되므로, 413/CORS 처리까지 포함해 요청 전체를 측정합니다.
+app.add_middleware(TracingMiddleware)
 
-@app.on_event("startup")
-async def startup():
-    print("Server startup - Initializing resources")
-    print("DB연결완료")
-    await database.connect()
-
-@app.on_event("shutdown")
-async def shutdown():
-    print("DB연결해제")
-    print("Server shutdown - Cleaning up resources")
-    await database.disconnect()
 
 
 build_path = os.path.join(os.path.dirname(__file__), "../build")
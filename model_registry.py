@@ -0,0 +1,435 @@
+# model_registry.py
+# 워커 프로세스당 한 번만 만드는 무거운 객체(모델, 외부 API 클라이언트)를 모아두는 레지스트리입니다.
+# main.py의 lifespan에서 초기화하고, 라우터는 Depends(use_...)로 주입받아 공유합니다.
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Any, Dict, Optional
+
+import google.generativeai as genai
+from fastapi import HTTPException
+
+# personal_color.py는 'personal_color_analysis' 패키지를 최상위 이름으로 임포트하므로 src 경로를 추가합니다.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "ShowMeTheColor", "src"))
+
+from SkinAnalysis.aimodel import SkinAnalyzer
+from SkinAnalysis.embedding_index import SkinEmbeddingCatalog
+from ShowMeTheColor.src.personal_color_analysis import personal_color
+from personal_color_analysis.detect_face import FaceLandmarkEngine
+from storage import build_storage
+from model_server import ModelServerClient, RemotePersonalColorAnalyzer, RemoteSkinAnalyzer, authkey_from_env
+
+logger = logging.getLogger(__name__)
+
+# 레지스트리 항목 이름
+SKIN_ANALYZER = "skin_analyzer"
+FACE_ENGINE = "face_engine"
+PERSONAL_COLOR = "personal_color"
+GEMINI_MODEL = "gemini_model"
+STORAGE = "storage"
+SKIN_EMBEDDINGS = "skin_embeddings"
+
+
+class ModelRegistry:
+    def __init__(self):
+        self._entries: Dict[str, Any] = {}
+        # 인스턴스(id) 단위 참조 카운트. 요청 처리 중인 객체 수를 추적합니다.
+        self._refcounts: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        # 항목별 최근 재로드 상태 (admin 엔드포인트에서 조회)
+        self._reload_status: Dict[str, Dict[str, Any]] = {}
+        self._watcher_stop = threading.Event()
+        self._watcher_thread: Optional[threading.Thread] = None
+
+    # --- 초기화 / 해제 ---
+    def load_all(self):
+        """
+        모든 항목을 로드합니다. 개별 항목 로드 실패는 로그만 남기고 None으로 등록하여
+        해당 기능을 쓰는 엔드포인트만 503/500을 반환하도록 합니다.
+        """
+        self.register(STORAGE, self._build_storage())
+        model_server_socket = os.environ.get("MODEL_SERVER_SOCKET")
+        if model_server_socket:
+            # 모델은 별도 모델 서버 프로세스(model_server.py)에 있고, 이 워커는 프록시만 가집니다.
+            # MODEL_SERVER_AUTHKEY가 없으면 RuntimeError로 시작을 중단합니다. (인증 없는 소켓에는 연결하지 않음)
+            client = ModelServerClient(model_server_socket, authkey=authkey_from_env())
+            self.register(SKIN_ANALYZER, RemoteSkinAnalyzer(client))
+            self.register(FACE_ENGINE, None)
+            self.register(PERSONAL_COLOR, RemotePersonalColorAnalyzer(client))
+            logger.info(f"모델 서버({model_server_socket})를 통해 추론을 수행합니다.")
+        else:
+            self.register(SKIN_ANALYZER, build_skin_analyzer())
+            face_engine = build_face_engine()
+            self.register(FACE_ENGINE, face_engine)
+            self.register(PERSONAL_COLOR, personal_color.PersonalColorAnalyzer(face_engine))
+        self.register(GEMINI_MODEL, self._build_gemini_model())
+        self.register(SKIN_EMBEDDINGS, build_skin_embeddings())
+
+        # 모델 파일 교체를 감지해 자동으로 재로드합니다. (uvicorn 워커가 여러 개일 때 모든 워커에 반영하는 방법)
+        watch_interval = float(os.environ.get("SKIN_MODEL_WATCH_INTERVAL", "0"))
+        if watch_interval > 0 and not model_server_socket:
+            self.start_artifact_watcher(watch_interval)
+
+    def unload_all(self):
+        self._watcher_stop.set()
+        storage = self._entries.get(STORAGE)
+        if storage is not None:
+            storage.close()
+        with self._lock:
+            busy = {name: self._refcounts.get(id(obj), 0) for name, obj in self._entries.items() if obj is not None}
+            busy = {name: count for name, count in busy.items() if count > 0}
+            if busy:
+                logger.warning(f"사용 중인 모델이 남아 있는 상태에서 레지스트리를 해제합니다: {busy}")
+            self._entries.clear()
+            self._refcounts.clear()
+
+    def register(self, name: str, obj: Any):
+        with self._lock:
+            self._entries[name] = obj
+
+    def get(self, name: str) -> Optional[Any]:
+        return self._entries.get(name)
+
+    # --- 참조 카운트 ---
+    def acquire(self, name: str) -> Optional[Any]:
+        with self._lock:
+            obj = self._entries.get(name)
+            if obj is not None:
+                self._refcounts[id(obj)] = self._refcounts.get(id(obj), 0) + 1
+            return obj
+
+    def release(self, obj: Any):
+        if obj is None:
+            return
+        with self._lock:
+            count = self._refcounts.get(id(obj), 0) - 1
+            if count > 0:
+                self._refcounts[id(obj)] = count
+            else:
+                self._refcounts.pop(id(obj), None)
+
+    def refcount(self, name: str) -> int:
+        obj = self._entries.get(name)
+        return self._refcounts.get(id(obj), 0) if obj is not None else 0
+
+    # --- 무중단 교체 (hot-swap) ---
+    def reload_skin_analyzer(self):
+        """
+        새 SkinAnalyzer를 백그라운드 스레드에서 로드하고 warm-up 한 뒤 레지스트리 항목을 교체합니다.
+        교체 전에 Depends로 주입받은 요청은 이전 인스턴스로 끝까지 처리되고, 이후 요청부터 새 인스턴스를 받습니다.
+        반환값: (현재 재로드 상태, 이번 호출로 새로 시작했는지 여부)
+        """
+        with self._lock:
+            current = self._entries.get(SKIN_ANALYZER)
+            if isinstance(current, RemoteSkinAnalyzer):
+                raise RuntimeError("모델 서버를 사용하는 중에는 API 워커에서 모델을 재로드할 수 없습니다. 모델 서버를 재시작하세요.")
+            _check_model_file_replaced(current)
+            status = self._reload_status.get(SKIN_ANALYZER)
+            if status is not None and status["state"] == "loading":
+                return dict(status), False
+            status = {"state": "loading", "started_at": time.time(), "finished_at": None, "version": None, "error": None}
+            self._reload_status[SKIN_ANALYZER] = status
+
+        threading.Thread(target=self._reload_skin_analyzer_worker, args=(status,), name="skin-analyzer-reload", daemon=True).start()
+        return dict(status), True
+
+    def _reload_skin_analyzer_worker(self, status: Dict[str, Any]):
+        logger.info("SkinAnalyzer 재로드 시작 (백그라운드)")
+        try:
+            new_analyzer = build_skin_analyzer(warmup=True)
+            # 지연 로딩 대상까지 미리 올려서 교체 직후 첫 요청이 로드 비용을 치르지 않게 합니다.
+            if new_analyzer is None or not new_analyzer.is_ready():
+                raise RuntimeError("새 SkinAnalyzer의 모델 파일을 모두 로드하지 못했습니다. 기존 모델을 계속 사용합니다.")
+        except Exception as e:
+            logger.error(f"SkinAnalyzer 재로드 실패: {e}", exc_info=True)
+            with self._lock:
+                status.update(state="failed", finished_at=time.time(), error=str(e))
+            return
+
+        with self._lock:
+            old_analyzer = self._entries.get(SKIN_ANALYZER)
+            self._entries[SKIN_ANALYZER] = new_analyzer
+            in_flight = self._refcounts.get(id(old_analyzer), 0) if old_analyzer is not None else 0
+            status.update(state="succeeded", finished_at=time.time(), version=new_analyzer.model_version)
+        # 이전 인스턴스는 처리 중인 요청이 모두 참조를 놓으면 GC가 회수합니다.
+        logger.info(f"SkinAnalyzer 교체 완료: {getattr(old_analyzer, 'model_version', None)} -> {new_analyzer.model_version} "
+                    f"(이전 인스턴스에서 처리 중인 요청 {in_flight}개)")
+
+    def reload_status(self, name: str = SKIN_ANALYZER) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            status = self._reload_status.get(name)
+            return dict(status) if status is not None else None
+
+    def start_artifact_watcher(self, interval: float):
+        """
+        SkinAnalyzer 모델 파일의 수정 시각/크기를 주기적으로 확인하고, 바뀐 뒤 한 주기 동안 그대로면 재로드합니다.
+        (복사 중인 파일을 읽지 않도록 한 번 더 확인합니다. 교체 시에는 임시 파일에 쓰고 rename 하는 것을 권장합니다.)
+        """
+        if self._watcher_thread is not None and self._watcher_thread.is_alive():
+            return
+        self._watcher_stop.clear()
+
+        def signature():
+            analyzer = self._entries.get(SKIN_ANALYZER)
+            if analyzer is None or isinstance(analyzer, RemoteSkinAnalyzer):
+                return None
+            paths = (analyzer.model_save_path, analyzer.target_scaler_save_path,
+                     analyzer.skin_type_model_filename, analyzer.label_encoder_filename)
+            # rename으로 교체하면 inode가 바뀌므로 수정 시각/크기가 같아도 감지합니다.
+            return tuple((os.stat(path).st_ino, os.stat(path).st_mtime_ns, os.stat(path).st_size) if os.path.exists(path) else None
+                         for path in paths)
+
+        def watch():
+            loaded = signature()
+            pending = None
+            while not self._watcher_stop.wait(interval):
+                try:
+                    current = signature()
+                except OSError:
+                    continue
+                if current is None or current == loaded:
+                    pending = None
+                    continue
+                if current != pending:
+                    pending = current # 변경 감지. 다음 주기에도 같으면 재로드
+                    continue
+                logger.info("SkinAnalyzer 모델 파일 변경을 감지하여 재로드합니다.")
+                try:
+                    self.reload_skin_analyzer()
+                except RuntimeError as e:
+                    logger.error(f"모델 파일 변경 감지 후 재로드 불가: {e}")
+                loaded, pending = current, None
+
+        self._watcher_thread = threading.Thread(target=watch, name="skin-analyzer-watcher", daemon=True)
+        self._watcher_thread.start()
+        logger.info(f"SkinAnalyzer 모델 파일 감시 시작 (주기 {interval}초)")
+
+    # --- 메모리 리포트 ---
+    def memory_report(self) -> Dict[str, Any]:
+        models = {}
+        for name, obj in list(self._entries.items()):
+            models[name] = {
+                "loaded": obj is not None,
+                "type": type(obj).__name__ if obj is not None else None,
+                "version": getattr(obj, "model_version", None),
+                "bytes": _estimate_bytes(obj),
+                "refcount": self._refcounts.get(id(obj), 0) if obj is not None else 0,
+            }
+        return {
+            "pid": os.getpid(),
+            "rss_bytes": _current_rss_bytes(),
+            "models": models,
+            "total_model_bytes": sum(entry["bytes"] for entry in models.values()),
+        }
+
+    # --- 항목별 생성 함수 ---
+    def _build_storage(self):
+        try:
+            return build_storage()
+        except Exception as e:
+            # 스토리지를 쓰는 엔드포인트는 use_storage에서 503을 반환합니다.
+            logger.error(f"스토리지 초기화 실패: {e}. 이미지 업로드/조회 엔드포인트를 사용할 수 없습니다.", exc_info=True)
+            return None
+
+    def _build_gemini_model(self):
+        # 중요: .env 파일에 GEMINI_API_KEY=여러분의API키 형태로 저장하고,
+        # main.py 등 애플리케이션 시작 지점에서 load_dotenv()를 호출해야 합니다.
+        gemini_api_key = os.environ.get("GEMINI_API_KEY")
+        if not gemini_api_key:
+            logger.warning("GEMINI_API_KEY 환경 변수가 .env 파일 또는 시스템에 설정되지 않았습니다. Gemini API 호출이 실패할 수 있습니다.")
+            return None
+        try:
+            genai.configure(api_key=gemini_api_key)
+            # 필요에 따라 안전 설정 조정
+            safety_settings = [
+                {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+                {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+                {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+                {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+            ]
+            model = genai.GenerativeModel(
+                model_name="gemini-1.5-flash-latest", # 또는 사용 가능한 다른 최신/적합한 모델
+                safety_settings=safety_settings,
+                generation_config=genai.types.GenerationConfig(
+                    temperature=0.7, # 답변의 다양성 조절 (0.0 ~ 1.0)
+                    # max_output_tokens=800, # 답변 최대 길이 (필요시 설정)
+                )
+            )
+            logger.info("Gemini 모델이 성공적으로 로드되었습니다.")
+            return model
+        except Exception as e:
+            logger.error(f"Gemini 모델 초기화 중 심각한 오류 발생: {e}", exc_info=True)
+            return None
+
+
+def _skin_model_mmap_enabled() -> bool:
+    """
+    SKIN_MODEL_MMAP으로 가중치 mmap 로딩을 켜고 끕니다. 지정하지 않으면 파일 감시(SKIN_MODEL_WATCH_INTERVAL)를
+    켠 배포에서는 끕니다. 감시를 켰다는 것은 모델 파일을 실행 중에 교체한다는 뜻이고,
+    매핑된 파일을 제자리에서 덮어쓰면(cp) 추론 중인 프로세스가 SIGBUS로 종료되기 때문입니다.
+    """
+    value = os.environ.get("SKIN_MODEL_MMAP")
+    if value is not None:
+        return value.lower() in ("1", "true", "yes")
+    return float(os.environ.get("SKIN_MODEL_WATCH_INTERVAL", "0")) <= 0
+
+
+def _check_model_file_replaced(analyzer):
+    """
+    현재 인스턴스가 mmap으로 쓰는 모델 파일이 rename으로 교체되지 않았으면(같은 inode) RuntimeError를 발생시킵니다.
+    같은 inode를 다시 읽으면 덮어쓰는 중인 내용을 읽거나 기존 매핑이 깨질 수 있습니다.
+    """
+    mmapped_file = getattr(analyzer, "mmapped_file", None)
+    if mmapped_file is None:
+        return
+    try:
+        model_stat = os.stat(analyzer.model_save_path)
+    except OSError as e:
+        raise RuntimeError(f"모델 파일을 확인할 수 없습니다: {e}")
+    if (model_stat.st_dev, model_stat.st_ino) == mmapped_file:
+        raise RuntimeError(
+            "현재 모델 파일을 mmap으로 사용 중이며 파일이 교체되지 않았습니다(같은 inode). "
+            "새 파일에 쓴 뒤 mv(rename)로 교체하거나, SKIN_MODEL_MMAP=0으로 실행하세요."
+        )
+
+
+def build_skin_analyzer(warmup: bool = True):
+    try:
+        # 모델 파일은 'SkinAnalysis' 폴더 안에 있다고 가정합니다.
+        analyzer = SkinAnalyzer(
+            model_save_path="image_to_measurement_model.pth",
+            target_scaler_save_path="target_measurement_scaler.joblib",
+            skin_type_model_filename="best_skin_type_model_v3_measurements_only.joblib",
+            label_encoder_filename="label_encoder_v3_measurements_only.joblib",
+            warmup=warmup,
+            # 입력 해상도(256/224/192 등)와 얼굴 영역 크롭 여부는 환경 변수로 조정합니다.
+            input_size=int(os.environ.get("SKIN_INPUT_SIZE", "256")),
+            face_crop=os.environ.get("SKIN_FACE_CROP", "false").lower() in ("1", "true", "yes"),
+            mmap_weights=_skin_model_mmap_enabled()
+        )
+        logger.info("SkinAnalyzer 인스턴스 초기화 성공.")
+        return analyzer
+    except Exception as e:
+        logger.error(f"SkinAnalyzer 인스턴스 초기화 실패: {e}. 피부 분석 서비스를 사용할 수 없습니다.", exc_info=True)
+        return None
+
+
+def build_skin_embeddings():
+    """SKIN_EMBEDDING_DIR가 설정된 경우에만 "비슷한 피부" 검색용 임베딩 인덱스를 로드합니다."""
+    directory = os.environ.get("SKIN_EMBEDDING_DIR")
+    if not directory:
+        return None
+    try:
+        return SkinEmbeddingCatalog(
+            directory,
+            mode=os.environ.get("SKIN_EMBEDDING_INDEX", "brute"), # 분석이 수십만 건 이상이면 "ivf"
+            nprobe=int(os.environ.get("SKIN_EMBEDDING_NPROBE", "8"))
+        )
+    except Exception as e:
+        logger.error(f"피부 임베딩 인덱스 로드 실패: {e}. 비슷한 피부 검색을 사용할 수 없습니다.", exc_info=True)
+        return None
+
+
+def build_face_engine():
+    try:
+        engine = FaceLandmarkEngine()
+        logger.info("얼굴 랜드마크 엔진 초기화 성공.")
+        return engine
+    except Exception as e:
+        logger.error(f"얼굴 랜드마크 엔진 초기화 실패: {e}. 퍼스널 컬러 분석 시 요청마다 로드를 시도합니다.", exc_info=True)
+        return None
+
+
+def build_local_models(warmup: bool = True):
+    """
+    현재 프로세스에 피부 분석 모델과 퍼스널 컬러 분석기를 로드합니다. (모델 서버에서도 사용)
+    """
+    skin_analyzer = build_skin_analyzer(warmup=warmup)
+    personal_color_analyzer = personal_color.PersonalColorAnalyzer(build_face_engine())
+    # 지연 로딩 대상(피부 타입 파이프라인/인코더)도 fork 이전에 올려 두어야 워커 간에 공유됩니다.
+    if skin_analyzer is not None:
+        skin_analyzer.skin_type_model_pipeline
+    return skin_analyzer, personal_color_analyzer
+
+
+def _estimate_bytes(obj: Any) -> int:
+    """항목이 차지하는 메모리를 대략적으로 계산합니다. 알 수 없는 타입은 0으로 봅니다."""
+    if obj is None:
+        return 0
+    if hasattr(obj, "memory_bytes"):
+        try:
+            return int(obj.memory_bytes())
+        except Exception:
+            return 0
+    return sys.getsizeof(obj)
+
+
+def _current_rss_bytes() -> Optional[int]:
+    """현재 프로세스의 RSS(상주 메모리)를 반환합니다. 리눅스가 아니면 최대 RSS로 대체합니다."""
+    try:
+        with open("/proc/self/statm") as statm:
+            resident_pages = int(statm.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS는 바이트, 리눅스는 KB 단위
+        return max_rss if sys.platform == "darwin" else max_rss * 1024
+    except (ImportError, AttributeError):
+        return None
+
+
+# 애플리케이션 전역 레지스트리 인스턴스 (database.py의 database와 같은 방식으로 공유)
+registry = ModelRegistry()
+
+
+# --- FastAPI 의존성 ---
+# 요청 동안 참조 카운트를 올려 두고, 응답이 끝나면 내립니다.
+async def use_skin_analyzer():
+    analyzer = registry.acquire(SKIN_ANALYZER)
+    try:
+        yield analyzer
+    finally:
+        registry.release(analyzer)
+
+async def use_face_engine():
+    engine = registry.acquire(FACE_ENGINE)
+    try:
+        yield engine
+    finally:
+        registry.release(engine)
+
+async def use_personal_color_analyzer():
+    analyzer = registry.acquire(PERSONAL_COLOR)
+    try:
+        yield analyzer
+    finally:
+        registry.release(analyzer)
+
+async def use_gemini_model():
+    model = registry.acquire(GEMINI_MODEL)
+    try:
+        yield model
+    finally:
+        registry.release(model)
+
+async def use_storage():
+    storage = registry.acquire(STORAGE)
+    if storage is None:
+        # 시작 시 스토리지 설정(S3_BUCKET_NAME 등)이 잘못되어 로드되지 않은 경우
+        raise HTTPException(status_code=503, detail="이미지 저장소를 사용할 수 없습니다. 관리자에게 문의하세요.")
+    try:
+        yield storage
+    finally:
+        registry.release(storage)
+
+async def use_skin_embeddings():
+    catalog = registry.acquire(SKIN_EMBEDDINGS)
+    try:
+        yield catalog
+    finally:
+        registry.release(catalog)
@@ -0,0 +1,287 @@
+# model_server.py
+# 선택적으로 사용하는 로컬 모델 서버 프로세스입니다.
+#
+# - 부모 프로세스가 SkinAnalyzer와 dlib 랜드마크 엔진을 먼저 로드한 뒤 fork 하므로
+#   모든 추론 워커가 가중치 메모리를 copy-on-write로 공유합니다.
+# - API 워커(uvicorn)는 Unix 소켓으로 요청을 보내고, 이미지 바이트는 피클링하지 않고
+#   공유 메모리(multiprocessing.shared_memory)에 써서 이름만 전달합니다.
+#
+# 실행 예:
+#   python -m model_server --socket /tmp/buildup-models.sock --workers 2
+# API 서버는 MODEL_SERVER_SOCKET 환경 변수가 설정되어 있으면 이 서버를 사용합니다 (model_registry.py 참고).
+# 요청은 피클로 주고받으므로 서버와 클라이언트 모두 MODEL_SERVER_AUTHKEY(공유 비밀)가 없으면 시작/연결하지 않습니다.
+# 소켓 파일은 소유자/그룹만 접근할 수 있는 권한(0660)으로 만듭니다.
+# fork를 사용하므로 리눅스/맥 전용입니다.
+
+import argparse
+import gc
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import time
+from multiprocessing import resource_tracker
+from multiprocessing.connection import Client, Listener
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Dict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# 요청 종류
+OP_SKIN = "skin"
+OP_PERSONAL_COLOR = "personal_color"
+
+
+def authkey_from_env() -> bytes:
+    authkey = os.environ.get("MODEL_SERVER_AUTHKEY")
+    if not authkey:
+        # 인증 없는 연결은 임의의 피클을 보내 코드를 실행할 수 있으므로 허용하지 않습니다.
+        raise RuntimeError("MODEL_SERVER_AUTHKEY 환경 변수가 설정되지 않았습니다. 모델 서버는 인증 키 없이 사용할 수 없습니다.")
+    return authkey.encode()
+
+
+# --- 서버 (추론 워커) ---
+def _attach_shared_memory(name: str) -> SharedMemory:
+    shm = SharedMemory(name=name)
+    # 공유 메모리의 소유자는 클라이언트입니다. 서버 쪽 resource_tracker가 종료 시 지워버리지 않도록 등록을 해제합니다.
+    try:
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except Exception:
+        pass
+    return shm
+
+
+def _decode_shared_image(shm_name: str, size: int):
+    import cv2
+    shm = _attach_shared_memory(shm_name)
+    try:
+        encoded = np.frombuffer(shm.buf, dtype=np.uint8, count=size)
+        image_bgr = cv2.imdecode(encoded, cv2.IMREAD_COLOR)
+        del encoded # 공유 메모리 버퍼 참조를 먼저 해제해야 close()가 가능합니다.
+    finally:
+        shm.close()
+    return image_bgr
+
+
+def _handle_request(request: Dict[str, Any], skin_analyzer, personal_color_analyzer) -> Dict[str, Any]:
+    import cv2
+    from PIL import Image
+    from SkinAnalysis.aimodel import FaceBoxCache
+
+    op = request.get("op")
+    if op not in (OP_SKIN, OP_PERSONAL_COLOR):
+        return {"ok": False, "error": f"알 수 없는 요청 종류입니다: {op}"}
+    image_bgr = _decode_shared_image(request["shm_name"], request["size"])
+    if image_bgr is None:
+        return {"ok": False, "error": "이미지를 디코딩할 수 없습니다."}
+
+    # 클라이언트가 이미 알고 있는 얼굴 좌표가 있으면 재사용하고, 여기서 찾은 좌표는 응답으로 돌려줍니다.
+    face_cache = FaceBoxCache(request.get("face_box"))
+    result = {}
+    # dlib 랜드마크 기준 좌표를 피부 분석이 쓰도록 퍼스널 컬러를 먼저 실행합니다.
+    if op == OP_PERSONAL_COLOR:
+        result["personal_color"] = personal_color_analyzer.analysis(image_bgr, face_cache)
+    if op == OP_SKIN:
+        if skin_analyzer is None:
+            result["skin"] = {"error": "피부 분석 모델이 모델 서버에 로드되지 않았습니다."}
+        else:
+            image_rgb = Image.fromarray(cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB))
+            result["skin"] = skin_analyzer.analyze_skin_from_image(
+                image_rgb, request.get("source_name", "모델 서버 요청"), face_cache,
+                return_embedding=request.get("return_embedding", False)
+            )
+            result["model_version"] = skin_analyzer.model_version
+    result["face_box"] = face_cache.face_box
+    return {"ok": True, "result": result}
+
+
+def _worker_main(listener: Listener, skin_analyzer, personal_color_analyzer, torch_threads: int):
+    # 부모의 종료 처리 핸들러를 물려받지 않도록 기본 동작으로 되돌립니다.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    import torch
+    torch.set_num_threads(torch_threads)
+    # OpenMP 스레드 풀은 fork 이후에 만들어야 안전하므로 warm-up은 워커마다 수행합니다.
+    if skin_analyzer is not None:
+        skin_analyzer.warmup()
+    logger.info(f"모델 서버 워커 시작 (pid={os.getpid()}, torch threads={torch_threads})")
+
+    while True:
+        try:
+            conn = listener.accept()
+        except (OSError, EOFError, multiprocessing.AuthenticationError) as e:
+            logger.warning(f"모델 서버 연결 수락 실패: {e}")
+            continue
+        with conn:
+            try:
+                request = conn.recv()
+            except EOFError:
+                continue
+            try:
+                response = _handle_request(request, skin_analyzer, personal_color_analyzer)
+            except Exception as e:
+                logger.error(f"모델 서버 요청 처리 중 오류 발생: {e}", exc_info=True)
+                response = {"ok": False, "error": str(e)}
+            try:
+                conn.send(response)
+            except (OSError, EOFError) as e:
+                logger.warning(f"모델 서버 응답 전송 실패: {e}")
+
+
+def serve(socket_path: str, num_workers: int = 2, torch_threads: int = 1):
+    """
+    모델을 로드한 뒤 num_workers 개의 추론 워커를 fork 하고, 죽은 워커는 다시 띄웁니다.
+    """
+    authkey = authkey_from_env() # 인증 키가 없으면 모델을 로드하기 전에 중단합니다.
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    # fork 이전에 모델을 로드합니다. warm-up은 워커에서 수행합니다 (_worker_main 참고).
+    from model_registry import build_local_models
+    skin_analyzer, personal_color_analyzer = build_local_models(warmup=False)
+
+    # bind 시점부터 권한이 0660이 되도록 umask를 걸고 소켓을 만듭니다. (만든 뒤 chmod 하면 그 사이에 열려 있음)
+    previous_umask = os.umask(0o117)
+    try:
+        listener = Listener(socket_path, family="AF_UNIX", authkey=authkey)
+    finally:
+        os.umask(previous_umask)
+
+    # 로드된 객체들을 GC 추적 대상에서 제외해 fork 이후 GC가 페이지를 건드려 복사가 일어나는 것을 줄입니다.
+    gc.collect()
+    gc.freeze()
+
+    ctx = multiprocessing.get_context("fork")
+    workers = []
+
+    def start_worker():
+        process = ctx.Process(target=_worker_main, args=(listener, skin_analyzer, personal_color_analyzer, torch_threads), daemon=True)
+        process.start()
+        return process
+
+    def shutdown(signum, frame):
+        logger.info("모델 서버 종료 중...")
+        for process in workers:
+            process.terminate()
+        for process in workers:
+            process.join(timeout=5)
+        listener.close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    workers.extend(start_worker() for _ in range(num_workers))
+    logger.info(f"모델 서버 시작: socket={socket_path}, workers={num_workers}")
+
+    while True:
+        time.sleep(1)
+        for index, process in enumerate(workers):
+            if not process.is_alive():
+                logger.warning(f"모델 서버 워커(pid={process.pid})가 종료되어 다시 시작합니다. (exitcode={process.exitcode})")
+                workers[index] = start_worker()
+
+
+# --- 클라이언트 (API 워커 쪽) ---
+class ModelServerClient:
+    def __init__(self, socket_path: str, authkey: bytes, timeout: float = 60.0):
+        if not authkey:
+            raise ValueError("모델 서버 인증 키(MODEL_SERVER_AUTHKEY)가 없으면 모델 서버에 연결하지 않습니다.")
+        self.socket_path = socket_path
+        self.authkey = authkey
+        self.timeout = timeout
+
+    def call(self, op: str, payload: bytes, source_name: str = "", face_cache=None, return_embedding: bool = False) -> Dict[str, Any]:
+        """이미지 바이트를 공유 메모리에 쓰고, 소켓으로는 공유 메모리 이름만 보냅니다."""
+        shm = SharedMemory(create=True, size=max(1, len(payload)))
+        try:
+            shm.buf[:len(payload)] = payload
+            with Client(self.socket_path, family="AF_UNIX", authkey=self.authkey) as conn:
+                face_box = face_cache.face_box if face_cache is not None and face_cache.resolved else None
+                conn.send({"op": op, "shm_name": shm.name, "size": len(payload), "source_name": source_name,
+                           "face_box": face_box, "return_embedding": return_embedding})
+                if not conn.poll(self.timeout):
+                    raise TimeoutError(f"모델 서버 응답이 {self.timeout}초 안에 오지 않았습니다.")
+                response = conn.recv()
+        finally:
+            shm.close()
+            shm.unlink()
+
+        if not response.get("ok"):
+            raise RuntimeError(f"모델 서버 오류: {response.get('error')}")
+        result = response["result"]
+        if face_cache is not None and not face_cache.resolved and result.get("face_box") is not None:
+            face_cache.store(tuple(result["face_box"]))
+        return result
+
+
+def _read_image_bytes(image) -> bytes:
+    """파일 경로, 바이트, 디코딩된 BGR 배열을 모두 인코딩된 바이트로 맞춥니다."""
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return bytes(image)
+    if isinstance(image, np.ndarray):
+        import cv2
+        ok, encoded = cv2.imencode(".png", image)
+        if not ok:
+            raise ValueError("이미지를 인코딩할 수 없습니다.")
+        return encoded.tobytes()
+    with open(image, "rb") as image_file:
+        return image_file.read()
+
+
+class RemoteSkinAnalyzer:
+    """SkinAnalyzer와 같은 호출 방식으로 모델 서버에 피부 분석을 위임합니다."""
+    def __init__(self, client: ModelServerClient):
+        self.client = client
+        # 모델 서버가 마지막으로 알려준 모델 버전 (첫 응답 전에는 None)
+        self.model_version = None
+
+    def analyze_skin_from_local_path(self, local_image_path: str, face_cache=None, return_embedding: bool = False) -> Dict[str, Any]:
+        try:
+            payload = _read_image_bytes(local_image_path)
+        except OSError as e:
+            return {"error": f"로컬 이미지 분석 실패: {str(e)}"}
+        return self.analyze_skin_from_bytes(payload, os.path.basename(local_image_path), face_cache, return_embedding)
+
+    def analyze_skin_from_bytes(self, payload: bytes, source_name: str = "", face_cache=None, return_embedding: bool = False) -> Dict[str, Any]:
+        result = self.client.call(OP_SKIN, payload, source_name, face_cache, return_embedding)
+        self.model_version = result.get("model_version", self.model_version)
+        return result["skin"]
+
+    def memory_bytes(self) -> int:
+        return 0 # 모델은 모델 서버 프로세스에 있습니다.
+
+
+class RemotePersonalColorAnalyzer:
+    """PersonalColorAnalyzer와 같은 호출 방식으로 모델 서버에 퍼스널 컬러 분석을 위임합니다."""
+    def __init__(self, client: ModelServerClient):
+        self.client = client
+
+    def analysis(self, image, face_cache=None):
+        return self.client.call(OP_PERSONAL_COLOR, _read_image_bytes(image), face_cache=face_cache)["personal_color"]
+
+    def memory_bytes(self) -> int:
+        return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SkinAnalyzer / 퍼스널 컬러 모델 서버")
+    parser.add_argument("--socket", default=os.environ.get("MODEL_SERVER_SOCKET", "/tmp/buildup-models.sock"), help="Unix 소켓 경로")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("MODEL_SERVER_WORKERS", "2")), help="추론 워커 프로세스 수")
+    parser.add_argument("--torch-threads", type=int, default=1, help="워커당 torch 스레드 수")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    from dotenv import load_dotenv
+    load_dotenv()
+    serve(args.socket, args.workers, args.torch_threads)
+
+
+if __name__ == '__main__':
+    main()
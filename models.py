@@ -1,5 +1,5 @@
 from datetime import date # Date 타입은 datetime 모듈의 date를 import 해야 합니다.
-from sqlalchemy import JSON, Column, Date, Integer, String, ForeignKey, DateTime, Text
+from sqlalchemy import CHAR, JSON, Column, Date, Index, Integer, String, ForeignKey, DateTime, Text
 from sqlalchemy.dialects.mysql import ENUM
 from sqlalchemy.sql import func
 from sqlalchemy.ext.declarative import declarative_base
@@ -31,7 +31,11 @@ class User(Base):
 # tb_analysis 모델 (분석 결과 테이블)
 class Analysis(Base):
     __tablename__ = 'tb_analysis'
-    __table_args__ = {'schema': SCHEMA_NAME}
+    # dedup.py의 CONTENT_HASH_MIGRATION과 같은 복합 인덱스 (해시 + 모델 버전으로 재사용할 분석을 찾음)
+    __table_args__ = (
+        Index('idx_tb_analysis_content_hash', 'content_hash', 'analysis_model'),
+        {'schema': SCHEMA_NAME},
+    )
 
     analysis_idx = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(String(50), ForeignKey(f"{SCHEMA_NAME}.tb_user.user_id"), nullable=False)
@@ -41,6 +45,7 @@ class Analysis(Base):
     personal_color = Column(String(50), nullable=False)
     analysis_result = Column(JSON, nullable=False)
     created_at = Column(DateTime, default=func.now(), nullable=False)
+    content_hash = Column(CHAR(64), nullable=True)  # 이미지 SHA-256 (중복 업로드 재사용, dedup.py 참고)
 
     # User 테이블과 관계 설정 (필요시)
     user = relationship("User", back_populates="analyses")
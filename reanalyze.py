@@ -0,0 +1,242 @@
+# reanalyze.py
+# 모델이 바뀌었을 때 tb_analysis에 저장된 과거 분석 전체를 새 모델로 다시 분석하는 배치 작업입니다.
+#
+# - analysis_idx(PK) 순서로 페이지 단위로 읽습니다 (OFFSET 없이 "analysis_idx > 마지막 값").
+# - 다음 페이지 이미지를 S3(또는 로컬 미러)에서 동시에 미리 받아 두는 동안 현재 페이지를 추론합니다.
+# - 피부 분석은 배치 순전파로, 퍼스널 컬러는 이미지별로 수행하고 결과는 페이지 단위 트랜잭션으로 한꺼번에 기록합니다.
+# - 페이지를 커밋할 때마다 체크포인트 파일을 갱신하므로 중단돼도 이어서 실행할 수 있습니다.
+# - 초당 처리 이미지 수 상한, 낮은 CPU 우선순위, 적은 torch 스레드로 실행해 API 요청 처리를 방해하지 않게 합니다.
+#
+# 실행 예:
+#   python -m reanalyze --checkpoint reanalyze.ckpt.json --page-size 32 --max-rate 5
+#   python -m reanalyze --mirror-dir /data/s3-mirror --only-outdated
+
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from database import database
+
+logger = logging.getLogger(__name__)
+
+
+# --- 체크포인트 ---
+def load_checkpoint(path: str) -> Dict[str, Any]:
+    if not os.path.exists(path):
+        return {"last_analysis_idx": 0, "processed": 0, "failed": 0}
+    with open(path, encoding="utf-8") as checkpoint_file:
+        return json.load(checkpoint_file)
+
+
+def save_checkpoint(path: str, checkpoint: Dict[str, Any]):
+    """임시 파일에 쓴 뒤 rename 하여 중간에 죽어도 체크포인트가 깨지지 않게 합니다."""
+    checkpoint["updated_at"] = datetime.datetime.now().isoformat()
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file, ensure_ascii=False, indent=2)
+    os.replace(temp_path, path)
+
+
+# --- 이미지 가져오기 ---
+class ImageFetcher:
+    """스토리지(S3 또는 --mirror-dir 로컬 미러)에서 file_path에 해당하는 이미지 바이트를 가져옵니다."""
+    def __init__(self, concurrency: int, mirror_dir: Optional[str] = None):
+        from storage import LocalStorage, build_storage
+        # 미러는 <mirror_dir>/<객체 키> 구조의 로컬 스토리지로 취급합니다.
+        self.storage = LocalStorage(mirror_dir, max_concurrency=concurrency) if mirror_dir else build_storage(concurrency)
+
+    async def fetch(self, row) -> Tuple[int, Optional[bytes], Optional[str]]:
+        try:
+            payload = await self.storage.get(self.storage.key_from_url(row["file_path"]))
+            return row["analysis_idx"], payload, None
+        except Exception as e:
+            return row["analysis_idx"], None, f"이미지 가져오기 실패: {e}"
+
+    async def fetch_page(self, rows) -> List[Tuple[int, Optional[bytes], Optional[str]]]:
+        return await asyncio.gather(*(self.fetch(row) for row in rows))
+
+    def close(self):
+        self.storage.close()
+
+
+# --- 분석 ---
+def analyze_page(fetched, skin_analyzer, personal_color_analyzer) -> List[Dict[str, Any]]:
+    """
+    한 페이지의 이미지를 분석합니다. 퍼스널 컬러(dlib)를 먼저 돌려 얼굴 좌표를 얻고, 피부 분석은 배치 한 번으로 처리합니다.
+    반환값은 analysis_idx별 {"analysis_idx", "error"} 또는 DB 갱신 값입니다.
+    """
+    from SkinAnalysis.aimodel import FaceBoxCache
+
+    results = []
+    batch_ids, batch_images, batch_caches, batch_tones = [], [], [], []
+    for analysis_idx, payload, error in fetched:
+        if error is not None:
+            results.append({"analysis_idx": analysis_idx, "error": error})
+            continue
+        image_bgr = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image_bgr is None:
+            results.append({"analysis_idx": analysis_idx, "error": "이미지를 디코딩할 수 없습니다."})
+            continue
+        face_cache = FaceBoxCache()
+        try:
+            tone = personal_color_analyzer.analysis(image_bgr, face_cache)
+        except Exception as e:
+            logger.warning(f"analysis_idx={analysis_idx} 퍼스널 컬러 분석 실패: {e}")
+            tone = None
+        batch_ids.append(analysis_idx)
+        batch_images.append(Image.fromarray(cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)))
+        batch_caches.append(face_cache)
+        batch_tones.append(tone)
+
+    if batch_images:
+        skin_results = skin_analyzer.analyze_skin_batch(batch_images, batch_caches)
+        for analysis_idx, tone, skin in zip(batch_ids, batch_tones, skin_results):
+            if "error" in skin:
+                results.append({"analysis_idx": analysis_idx, "error": skin["error"]})
+                continue
+            # upload-and-analyze와 같은 형식으로 저장합니다.
+            skin_analysis_results = {
+                "average_measurements": skin["average_measurements"],
+                "predicted_skin_type": skin["predicted_skin_type"],
+            }
+            results.append({
+                "analysis_idx": analysis_idx,
+                "analysis_model": skin_analyzer.model_version,
+                "skin_tone": skin["predicted_skin_type"],
+                "personal_color": tone if isinstance(tone, str) else "N/A",
+                "analysis_result": json.dumps(skin_analysis_results),
+            })
+    return results
+
+
+async def write_results(results: List[Dict[str, Any]]) -> int:
+    """성공한 결과를 한 트랜잭션으로 기록합니다. 기록한 행 수를 반환합니다."""
+    values = [result for result in results if "error" not in result]
+    if not values:
+        return 0
+    sql_update = """
+    UPDATE tb_analysis
+    SET analysis_model = :analysis_model, skin_tone = :skin_tone,
+        personal_color = :personal_color, analysis_result = :analysis_result
+    WHERE analysis_idx = :analysis_idx
+    """
+    async with database.transaction():
+        await database.execute_many(sql_update, values=values)
+    return len(values)
+
+
+async def fetch_page_rows(last_analysis_idx: int, page_size: int, skip_version: Optional[str], max_analysis_idx: Optional[int]):
+    sql = "SELECT analysis_idx, file_path FROM tb_analysis WHERE analysis_idx > :last_idx"
+    values: Dict[str, Any] = {"last_idx": last_analysis_idx, "page_size": page_size}
+    if skip_version:
+        sql += " AND analysis_model <> :skip_version"
+        values["skip_version"] = skip_version
+    if max_analysis_idx is not None:
+        sql += " AND analysis_idx <= :max_idx"
+        values["max_idx"] = max_analysis_idx
+    sql += " ORDER BY analysis_idx LIMIT :page_size"
+    return await database.fetch_all(sql, values=values)
+
+
+# --- 실행 ---
+async def run(args):
+    from model_registry import build_local_models
+
+    skin_analyzer, personal_color_analyzer = await asyncio.to_thread(build_local_models, True)
+    if skin_analyzer is None or not skin_analyzer.is_ready():
+        raise RuntimeError("SkinAnalyzer를 로드하지 못했습니다. 모델 파일을 확인하세요.")
+    logger.info(f"재분석 모델 버전: {skin_analyzer.model_version}")
+
+    checkpoint = load_checkpoint(args.checkpoint)
+    if checkpoint.get("model_version") not in (None, skin_analyzer.model_version):
+        logger.warning(f"체크포인트의 모델 버전({checkpoint['model_version']})과 현재 모델 버전이 다릅니다. 이어서 진행합니다.")
+    checkpoint["model_version"] = skin_analyzer.model_version
+    logger.info(f"analysis_idx > {checkpoint['last_analysis_idx']} 부터 재분석합니다.")
+
+    fetcher = ImageFetcher(args.concurrency, args.mirror_dir)
+    skip_version = skin_analyzer.model_version if args.only_outdated else None
+
+    prefetch = None
+    await database.connect()
+    try:
+        # 작업 시작 시점의 최대 PK까지만 처리합니다. (작업 중 새로 들어온 분석은 이미 새 모델로 저장됨)
+        max_row = await database.fetch_one("SELECT MAX(analysis_idx) AS max_idx FROM tb_analysis")
+        max_analysis_idx = max_row["max_idx"] if max_row is not None else None
+
+        rows = await fetch_page_rows(checkpoint["last_analysis_idx"], args.page_size, skip_version, max_analysis_idx)
+        prefetch = asyncio.create_task(fetcher.fetch_page(rows)) if rows else None
+        started = time.monotonic()
+        while rows:
+            fetched = await prefetch
+            # 현재 페이지를 추론하는 동안 다음 페이지 이미지를 미리 받습니다.
+            next_rows = await fetch_page_rows(rows[-1]["analysis_idx"], args.page_size, skip_version, max_analysis_idx)
+            prefetch = asyncio.create_task(fetcher.fetch_page(next_rows)) if next_rows else None
+
+            page_started = time.monotonic()
+            results = await asyncio.to_thread(analyze_page, fetched, skin_analyzer, personal_color_analyzer)
+            written = 0 if args.dry_run else await write_results(results)
+            failed = [result for result in results if "error" in result]
+            for result in failed:
+                logger.warning(f"analysis_idx={result['analysis_idx']} 재분석 실패: {result['error']}")
+
+            checkpoint["last_analysis_idx"] = rows[-1]["analysis_idx"]
+            checkpoint["processed"] += written
+            checkpoint["failed"] += len(failed)
+            if not args.dry_run:
+                save_checkpoint(args.checkpoint, checkpoint)
+
+            elapsed_total = time.monotonic() - started
+            logger.info(f"analysis_idx ~{checkpoint['last_analysis_idx']}: 이번 페이지 {written}건 기록, {len(failed)}건 실패 "
+                        f"(누적 {checkpoint['processed']}건, {checkpoint['processed'] / max(elapsed_total, 1e-9):.1f}건/초)")
+
+            # 초당 처리량 상한: 이번 페이지가 허용 시간보다 빨리 끝났으면 남은 시간만큼 쉽니다.
+            if args.max_rate > 0:
+                budget = len(rows) / args.max_rate
+                spent = time.monotonic() - page_started
+                if spent < budget:
+                    await asyncio.sleep(budget - spent)
+            rows = next_rows
+    finally:
+        if prefetch is not None and not prefetch.done():
+            prefetch.cancel()
+        fetcher.close()
+        await database.disconnect()
+    logger.info(f"재분석 완료: 기록 {checkpoint['processed']}건, 실패 {checkpoint['failed']}건")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="tb_analysis의 과거 이미지를 현재 모델로 다시 분석합니다.")
+    parser.add_argument("--checkpoint", default="reanalyze.checkpoint.json", help="진행 상황을 저장/재개할 체크포인트 파일")
+    parser.add_argument("--page-size", type=int, default=32, help="한 번에 읽고 배치 추론할 행 수")
+    parser.add_argument("--concurrency", type=int, default=8, help="이미지 동시 다운로드 수")
+    parser.add_argument("--mirror-dir", default=None, help="S3 대신 사용할 로컬 미러 디렉터리 (<mirror-dir>/<객체 키>)")
+    parser.add_argument("--max-rate", type=float, default=5.0, help="초당 최대 처리 이미지 수 (0이면 제한 없음)")
+    parser.add_argument("--torch-threads", type=int, default=1, help="추론에 사용할 torch 스레드 수")
+    parser.add_argument("--nice", type=int, default=10, help="프로세스 CPU 우선순위를 낮출 정도 (os.nice)")
+    parser.add_argument("--only-outdated", action="store_true", help="이미 현재 모델 버전으로 분석된 행은 건너뜁니다")
+    parser.add_argument("--dry-run", action="store_true", help="분석만 하고 DB와 체크포인트는 갱신하지 않습니다")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    if args.nice > 0 and hasattr(os, "nice"):
+        os.nice(args.nice)
+    import torch
+    torch.set_num_threads(args.torch_threads)
+
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+# admin.py
+# 운영/관리용 엔드포인트 (모델 레지스트리 상태 조회 등)
+# 모든 엔드포인트는 X-Admin-Token 헤더가 ADMIN_TOKEN 환경 변수와 같아야 합니다.
+# ADMIN_TOKEN을 설정하지 않으면 관리용 엔드포인트는 모두 503을 반환합니다.
+
+import asyncio
+import logging
+import os
+import secrets
+from typing import Optional
+from fastapi import APIRouter, Depends, Header, HTTPException
+from fastapi.responses import JSONResponse
+from admission import analysis_admission
+from advice_cache import skin_advice_cache
+from database import database
+from deadlines import stage_snapshot
+from dialogue_context import dialogue_context
+from jobs import analysis_jobs
+from model_registry import SKIN_ANALYZER, SKIN_EMBEDDINGS, STORAGE, registry
+
+logger = logging.getLogger(__name__)
+
+
+
+async def require_admin_token(x_admin_token: Optional[str] = Header(None)):
+    admin_token = os.environ.get("ADMIN_TOKEN")
+    if not admin_token:
+        raise HTTPException(status_code=503, detail="ADMIN_TOKEN이 설정되지 않아 관리용 엔드포인트를 사용할 수 없습니다.")
+    if not x_admin_token:
+        raise HTTPException(status_code=401, detail="X-Admin-Token 헤더가 필요합니다.")
+    if not secrets.compare_digest(x_admin_token.encode(), admin_token.encode()):
+        raise HTTPException(status_code=403, detail="관리자 토큰이 올바르지 않습니다.")
+
+
+router = APIRouter(dependencies=[Depends(require_admin_token)])
+
+# 워커 프로세스의 모델 메모리 사용량과 참조 카운트 조회
+@router.get("/models/memory")
+async def get_model_memory_report():
+    return {"success": True, "report": registry.memory_report()}
+
+
+# 서명된 URL 캐시 상태 (항목 수, 적중/실패 횟수)
+@router.get("/storage/presign-cache")
+async def get_presign_cache_status():
+    storage = registry.get(STORAGE)
+    if storage is None:
+        raise HTTPException(status_code=503, detail="스토리지가 로드되지 않았습니다.")
+    return {"success": True, "pid": os.getpid(), "cache": storage.presign_cache.snapshot()}
+
+
+# 피부 조언 응답 캐시 상태 (메모리/디스크 적중, 합쳐진 동시 요청 수)
+@router.get("/chatbot/advice-cache")
+async def get_advice_cache_status():
+    return {"success": True, "pid": os.getpid(), "cache": skin_advice_cache.snapshot()}
+
+
+# 사용자별 최근 대화 버퍼 상태 (보관 중인 사용자 수, 적중/실패 횟수)
+@router.get("/chatbot/dialogue-context")
+async def get_dialogue_context_status():
+    return {"success": True, "pid": os.getpid(), "buffer": dialogue_context.snapshot()}
+
+
+# 분석 파이프라인 단계별 시간 예산과 실행/초과 횟수 (이 워커 프로세스 기준)
+@router.get("/stages")
+async def get_stage_budgets():
+    return {"success": True, "pid": os.getpid(), "stages": stage_snapshot()}
+
+
+# 분석 입장 제어 상태 (동시 실행 수, 대기열 길이, 거절 횟수)
+@router.get("/admission")
+async def get_admission_status():
+    return {"success": True, "pid": os.getpid(), "analysis": analysis_admission.snapshot(), "jobs": analysis_jobs.snapshot()}
+
+
+# 새 모델 파일로 SkinAnalyzer를 무중단 교체합니다. 로드/warm-up은 백그라운드에서 진행되고 즉시 202를 반환합니다.
+# uvicorn 워커가 여러 개라면 이 요청을 받은 워커만 교체되므로 SKIN_MODEL_WATCH_INTERVAL로 파일 감시를 켜는 것을 권장합니다.
+# 모델 파일은 새 파일에 쓴 뒤 mv(rename)로 교체해야 합니다. mmap으로 쓰는 파일이 그대로(같은 inode)면 409를 반환합니다.
+@router.post("/models/skin-analyzer/reload")
+async def reload_skin_analyzer():
+    try:
+        status, started = registry.reload_skin_analyzer()
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    message = "SkinAnalyzer 재로드를 시작했습니다." if started else "이미 SkinAnalyzer 재로드가 진행 중입니다."
+    return JSONResponse(status_code=202, content={"success": True, "message": message, "status": status})
+
+
+@router.get("/models/skin-analyzer/reload")
+async def get_skin_analyzer_reload_status():
+    analyzer = registry.get(SKIN_ANALYZER)
+    return {
+        "success": True,
+        "current_version": getattr(analyzer, "model_version", None),
+        "status": registry.reload_status(SKIN_ANALYZER),
+    }
+
+
+# 저장된 임베딩과 tb_analysis의 피부 타입(skin_tone)으로 기준 프로필(피부 타입별 평균 임베딩)을 다시 만듭니다.
+@router.post("/embeddings/reference-profiles")
+async def rebuild_reference_profiles():
+    skin_embeddings = registry.get(SKIN_EMBEDDINGS)
+    if skin_embeddings is None:
+        raise HTTPException(status_code=503, detail="피부 임베딩 인덱스가 로드되지 않았습니다.")
+    rows = await database.fetch_all("SELECT analysis_idx, skin_tone FROM tb_analysis WHERE skin_tone IS NOT NULL")
+    labels_by_id = {row["analysis_idx"]: row["skin_tone"] for row in rows}
+    labels = await asyncio.to_thread(skin_embeddings.rebuild_reference_profiles, labels_by_id)
+    logger.info(f"기준 프로필 재생성 완료: {labels}")
+    return {"success": True, "labels": labels}
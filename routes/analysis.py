@@ -1,8 +1,8 @@
 from datetime import datetime
+import asyncio
 import sys
 import tempfile
-from fastapi import APIRouter, Form, HTTPException, UploadFile, File
-import boto3
+from fastapi import APIRouter, Depends, Form, HTTPException, UploadFile, File
 import os
 import logging
 from typing import Annotated
@@ -28,53 +28,33 @@ from schemas import (
     ImageUploadResponse
 )
 # SkinAnalysis 모듈에서 SkinAnalyzer 클래스 임포트 (이 부분이 수정되었습니다!)
-from SkinAnalysis.aimodel import SkinAnalyzer
+from SkinAnalysis.aimodel import FaceBoxCache, SkinAnalyzer
+from admission import admit_analysis
+from upload_stream import spool_upload
+from model_registry import use_personal_color_analyzer, use_storage, use_skin_analyzer, use_skin_embeddings
 
 from dotenv import load_dotenv
 load_dotenv()
 
 router = APIRouter()
 # 이미지 업로드 단
-# 환경 변수에서 자격 증명 가져오기 (권장)
-s3_client = boto3.client(
-    's3',
-    aws_access_key_id=os.environ.get("AWS_ACCESS_KEY_ID"),
-    aws_secret_access_key=os.environ.get("AWS_SECRET_ACCESS_KEY"),
-    region_name=os.environ.get("AWS_REGION")
-)
-
-# 환경 변수에서 S3 버킷 이름 가져오기
-S3_BUCKET_NAME = os.environ.get("S3_BUCKET_NAME")
-
-if not S3_BUCKET_NAME:
-    raise ValueError("S3_BUCKET_NAME 환경 변수가 설정되지 않았습니다.")
+# 스토리지(S3/로컬)와 모델은 model_registry에서 워커당 한 번만 만들어 의존성으로 주입받습니다.
+# 버킷 등 스토리지 설정은 storage.py의 build_storage()가 환경 변수에서 읽습니다.
 
 
 # 로깅 설정 (S3 서버에서도 필요)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# SkinAnalyzer 인스턴스를 전역적으로 생성 (서버 시작 시 한 번만 로드)
-skin_analyzer_instance = None # 초기화 전 None으로 설정
-try:
-    # 모델 파일 경로를 SkinAnalysis 폴더 기준으로 정확하게 설정합니다.
-    # 모델 파일이 'SkinAnalysis' 폴더 안에 있다고 가정합니다.
-    # sys.path.append("SkinAnalysis") 가 설정되어 있다면, 이 경로는 SkinAnalysis 모듈 내부에서 처리됩니다.
-    skin_analyzer_instance = SkinAnalyzer(
-        model_save_path="image_to_measurement_model.pth",
-        target_scaler_save_path="target_measurement_scaler.joblib",
-        skin_type_model_filename="best_skin_type_model_v3_measurements_only.joblib",
-        label_encoder_filename="label_encoder_v3_measurements_only.joblib"
-    )
-    logger.info("SkinAnalyzer 인스턴스 초기화 성공.")
-except Exception as e:
-    logger.error(f"SkinAnalyzer 인스턴스 초기화 실패: {e}. 피부 분석 서비스를 사용할 수 없습니다.", exc_info=True)
-    skin_analyzer_instance = None # 로드 실패 시 None으로 설정
-
-
 # API 엔드포인트: 이미지 업로드 및 분석 통합
-@router.post("/upload-and-analyze", response_model=Dict[str, Any], summary="Upload image, save to S3, and analyze for personal color and skin")
-async def upload_and_analyze_image(file: UploadFile = File(...), description: str = Form(...)):
+@router.post("/upload-and-analyze", response_model=Dict[str, Any], summary="Upload image, save to S3, and analyze for personal color and skin", dependencies=[Depends(admit_analysis)])
+async def upload_and_analyze_image(
+    file: UploadFile = File(...),
+    description: str = Form(...),
+    skin_analyzer_instance: SkinAnalyzer = Depends(use_skin_analyzer),
+    personal_color_analyzer = Depends(use_personal_color_analyzer),
+    storage = Depends(use_storage)
+):
     # 서비스 가용성 확인 (피부 분석 모델 로드 여부)
     if skin_analyzer_instance is None:
         logger.error("SkinAnalyzer instance was not initialized correctly. Skin analysis service is unavailable.")
@@ -83,38 +63,30 @@ async def upload_and_analyze_image(file: UploadFile = File(...), description: st
             detail="Skin analysis service is currently unavailable due to a server configuration issue. Please check server logs."
         )
 
+    upload = None
     try:
-        contents = await file.read()
+        # 본문을 청크 단위로 임시 파일에 받으면서 형식/크기 검사와 해시 계산을 함께 합니다.
+        upload = await spool_upload(file)
+        temp_filepath = upload.path
         # 현재 시간을 ISO 8601 형식으로 생성
         db_timestamp = datetime.now()
 
         # 파일 이름에 사용할 간결한 시간 포맷
         currentTime = db_timestamp.strftime('%y%m%dT%H%M%S')
         # 파일 확장자 추출
-        file_extension = os.path.splitext(file.filename)[1]
+        file_extension = os.path.splitext(file.filename or "")[1] or upload.extension
         # 파일 이름에 UUID와 원본 파일명을 조합하여 고유성 강화
         file_name = f"{currentTime}_{uuid.uuid4()}{file_extension}"
 
         s3_key = f"images/{file_name}"
-        s3_client.put_object(
-            Bucket=S3_BUCKET_NAME,
-            Key=s3_key,
-            Body=contents,
-            ContentType=file.content_type # S3에 Content-Type 메타데이터 추가
-        )
-        s3_url = f"https://{S3_BUCKET_NAME}.s3.amazonaws.com/{s3_key}"
+        s3_url = await storage.put_path(s3_key, temp_filepath, content_type=upload.content_type) # S3에 Content-Type 메타데이터 추가
         logger.info(f"File uploaded to S3: {s3_url}")
 
-        # Personal Color 분석을 위한 로컬 임시 파일 생성
-        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-            temp_file.write(contents)
-            temp_filepath = temp_file.name
-        logger.info(f"Temporary file created for personal color analysis: {temp_filepath}")
-
         # 1. Personal Color Analysis
         analysis_result_tone = None
+        face_cache = FaceBoxCache() # 요청 단위 얼굴 좌표 캐시
         try:
-            analysis_result_tone = personal_color.analysis(temp_filepath)
+            analysis_result_tone = personal_color_analyzer.analysis(temp_filepath, face_cache)
             logger.info(f"Personal color analysis completed. Result: {analysis_result_tone}")
         except Exception as e:
             logging.error(f"Personal color analysis failed: {e}", exc_info=True)
@@ -122,9 +94,8 @@ async def upload_and_analyze_image(file: UploadFile = File(...), description: st
             analysis_result_tone = {"error": "Personal color analysis failed"}
         finally:
             # 임시 파일 반드시 삭제
-            if os.path.exists(temp_filepath):
-                os.unlink(temp_filepath)
-                logger.info(f"Temporary file {temp_filepath} deleted.")
+            upload.cleanup()
+            logger.info(f"Temporary file {temp_filepath} deleted.")
 
         # 2. Skin Analysis (S3 URL 사용) - analysis_result_tone 바로 다음에 위치
         skin_analysis_results = {"average_measurements": {}, "predicted_skin_type": "분석 실패"} # 기본값
@@ -158,30 +129,29 @@ async def upload_and_analyze_image(file: UploadFile = File(...), description: st
             "requester":user_id
         })
 
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error during upload and analyze: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Error occurred during upload and analyze process.")
+    finally:
+        if upload is not None:
+            upload.cleanup()
 
 # 이미지 업로드 API 엔드포인트 정의 (기존 코드 유지)
 @router.post("/upload/image_base64", response_model=ImageUploadResponse)
-async def upload_image(file: Annotated[UploadFile, File()]):
+async def upload_image(file: Annotated[UploadFile, File()], storage = Depends(use_storage)):
+    upload = None
     try:
-        # UploadFile 객체에서 이미지 파일 내용 읽기 (비동기 방식)
-        contents = await file.read()
+        # UploadFile을 청크 단위로 임시 파일에 받기 (형식/크기 검사 포함)
+        upload = await spool_upload(file)
         # 업로드된 파일의 원래 이름 가져오기
         file_name = file.filename
         # S3에 저장될 객체 키 생성 (images/ 폴더 아래 원래 파일 이름으로 저장)
         s3_key = f"images/{file_name}"
 
-        # Boto3 클라이언트를 사용하여 S3에 객체(이미지) 업로드
-        s3_client.put_object(
-            Bucket=S3_BUCKET_NAME,  # 대상 S3 버킷 이름
-            Key=s3_key,             # S3에 저장될 객체 키
-            Body=contents           # 업로드할 이미지 파일 내용 (bytes)
-        )
-
-        # 업로드 성공 시 S3 이미지 URL 생성
-        s3_url = f"https://{S3_BUCKET_NAME}.s3.amazonaws.com/{s3_key}"
+        # 스토리지에 객체(이미지) 업로드. 업로드 성공 시 이미지 URL을 돌려받습니다.
+        s3_url = await storage.put_path(s3_key, upload.path, upload.content_type)
 
         # 성공 응답 반환
         return {
@@ -189,23 +159,49 @@ async def upload_image(file: Annotated[UploadFile, File()]):
             "message": f"이미지 '{file_name}' 업로드 성공",
             "s3_url": s3_url
         }
+    except HTTPException:
+        raise
     except Exception as e:
         # 오류 발생 시 로깅
         logging.error(f"S3 이미지 업로드 오류: {e}")
         # HTTP 예외 발생 (500 Internal Server Error)
         raise HTTPException(status_code=500, detail="이미지 업로드 실패")
+    finally:
+        if upload is not None:
+            upload.cleanup()
 
 
 @router.post("/get/presigned-url", response_model=PresignedUrlResponse)
-async def get_presigned_url(request_data: PresignedUrlRequest):
+async def get_presigned_url(request_data: PresignedUrlRequest, storage = Depends(use_storage)):
     try:
-        presigned_url = s3_client.generate_presigned_url(
-            'get_object',
-            Params={'Bucket': S3_BUCKET_NAME, 'Key': request_data.object_key},
-            ExpiresIn=3600  # URL 유효 시간 (초) - 필요에 따라 조정
+        presigned_url = await storage.presigned_get_url(
+            request_data.object_key,
+            expires_in=3600  # URL 유효 시간 (초) - 필요에 따라 조정
         )
         return {"success": True, "message": "서명된 URL 생성 성공", "presigned_url": presigned_url}
     except Exception as e:
         logging.error(f"서명된 URL 생성 오류: {e}")
         raise HTTPException(status_code=500, detail="서명된 URL 생성 실패")
-    
+
+
+# --- 비슷한 피부 검색 (SKIN_EMBEDDING_DIR 설정 시 사용 가능) ---
+@router.get("/similar/{analysis_idx}")
+async def get_similar_skin(analysis_idx: int, k: int = 10, skin_embeddings = Depends(use_skin_embeddings)):
+    if skin_embeddings is None:
+        raise HTTPException(status_code=503, detail="비슷한 피부 검색 서비스를 사용할 수 없습니다.")
+    k = max(1, min(k, 100))
+    # 검색(행렬곱)과 파일 읽기는 이벤트 루프를 막지 않도록 스레드에서 실행합니다.
+    similar = await asyncio.to_thread(skin_embeddings.similar_to, analysis_idx, k)
+    if similar is None:
+        raise HTTPException(status_code=404, detail="해당 분석의 피부 임베딩이 없습니다.")
+    return {"success": True, "analysis_idx": analysis_idx, "similar": similar}
+
+
+@router.get("/reference-profile/{analysis_idx}")
+async def get_closest_reference_profile(analysis_idx: int, k: int = 1, skin_embeddings = Depends(use_skin_embeddings)):
+    if skin_embeddings is None or skin_embeddings.reference_index is None:
+        raise HTTPException(status_code=503, detail="기준 프로필 검색 서비스를 사용할 수 없습니다.")
+    profiles = await asyncio.to_thread(skin_embeddings.closest_reference, analysis_idx, max(1, k))
+    if profiles is None:
+        raise HTTPException(status_code=404, detail="해당 분석의 피부 임베딩이 없습니다.")
+    return {"success": True, "analysis_idx": analysis_idx, "profiles": profiles}
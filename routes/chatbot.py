@@ -1,9 +1,12 @@
 # chatbot.py
 
 from datetime import datetime
+import asyncio
+import json
 import os
 import logging # 로깅 모듈 추가
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse
 from database import database # 데이터베이스 인스턴스 (경로 확인 필요)
 from schemas import ( # Pydantic 모델 (경로 확인 필요)
     ChatBotRequest,
@@ -13,8 +16,11 @@ from schemas import ( # Pydantic 모델 (경로 확인 필요)
     SkinAdviceRequest, # 피부 조언 요청 시 사용될 수 있음
     SkinAdviceResponse # 피부 조언 응답 시 사용될 수 있음
 )
-import google.generativeai as genai
 from typing import Optional
+from model_registry import use_gemini_model
+from advice_cache import advice_cache_key, skin_advice_cache
+from dialogue_context import dialogue_context
+from tracing import span
 
 # --- 로깅 설정 ---
 # logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -25,56 +31,39 @@ logger = logging.getLogger("uvicorn.error") # FastAPI/Uvicorn의 기본 로거 
 
 
 # --- Gemini API 설정 ---
-# 중요: .env 파일에 GEMINI_API_KEY=여러분의API키 형태로 저장하고,
-# main.py 등 애플리케이션 시작 지점에서 load_dotenv()를 호출해야 합니다.
-gemini_model = None
-GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
-
-if not GEMINI_API_KEY:
-    logger.warning("GEMINI_API_KEY 환경 변수가 .env 파일 또는 시스템에 설정되지 않았습니다. Gemini API 호출이 실패할 수 있습니다.")
-else:
-    try:
-        genai.configure(api_key=GEMINI_API_KEY)
-        # 필요에 따라 안전 설정 조정
-        safety_settings = [
-            {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-            {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-            {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-            {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-        ]
-        gemini_model = genai.GenerativeModel(
-            model_name="gemini-1.5-flash-latest", # 또는 사용 가능한 다른 최신/적합한 모델
-            safety_settings=safety_settings,
-            generation_config=genai.types.GenerationConfig(
-                temperature=0.7, # 답변의 다양성 조절 (0.0 ~ 1.0)
-                # max_output_tokens=800, # 답변 최대 길이 (필요시 설정)
-            )
-        )
-        logger.info("Gemini 모델 (chatbot.py용)이 성공적으로 로드되었습니다.")
-    except Exception as e:
-        logger.error(f"Gemini 모델 (chatbot.py용) 초기화 중 심각한 오류 발생: {e}", exc_info=True)
-        # gemini_model은 None으로 유지되어 API 호출 시 에러를 발생시키도록 합니다.
+# Gemini 모델은 model_registry에서 워커당 한 번만 만들어 의존성(use_gemini_model)으로 주입받습니다.
 
 router = APIRouter()
 
+CHAT_INSERT_SQL = """
+INSERT INTO tb_chatbot(user_id, chatbot_role, chatbot_text, created_at)
+VALUES (:user_id, :chatbot_role, :chatbot_text, :created_at)
+"""
+DEFAULT_ANSWER = "죄송합니다. 현재 답변을 드리기 어렵습니다. 잠시 후 다시 시도해주세요." # 기본 오류 메시지
+QUOTA_ANSWER = "현재 많은 사용자가 서비스를 이용 중입니다. 잠시 후 다시 시도해주시면 감사하겠습니다."
+
+
+async def save_chat_message(user_id: str, chatbot_role: str, chatbot_text: str, created_at):
+    chatbot_idx = await database.execute(CHAT_INSERT_SQL, values={
+        "user_id": user_id,
+        "chatbot_role": chatbot_role,
+        "chatbot_text": chatbot_text,
+        "created_at": created_at,
+    })
+    # 저장에 성공한 메시지만 최근 대화 버퍼에도 반영합니다. (write-through)
+    dialogue_context.append(user_id, chatbot_role, chatbot_text, chatbot_idx)
+
 async def get_recent_dialogue_history(user_id: str, limit: int = 5) -> str:
     """
     특정 사용자의 최근 대화 기록을 가져와 Gemini 프롬프트용으로 포맷팅합니다.
-    """
-    history_query = """
-    SELECT chatbot_role, chatbot_text
-    FROM tb_chatbot
-    WHERE user_id = :user_id
-    ORDER BY created_at DESC
-    LIMIT :limit
+    사용자별 최근 대화 버퍼(dialogue_context)에서 읽고, 버퍼에 없을 때만 DB를 조회합니다.
     """
     try:
-        records = await database.fetch_all(history_query, {"user_id": user_id, "limit": limit})
+        records = await dialogue_context.recent(user_id, limit)
         formatted_history = ""
-        if records:
-            for record in reversed(records): # 시간 순서대로 (오래된 메시지가 먼저)
-                role_display = "사용자" if record["chatbot_role"] in ["나", "user"] else "챗봇"
-                formatted_history += f"{role_display}: {record['chatbot_text']}\n"
+        for chatbot_role, chatbot_text in records: # 시간 순서대로 (오래된 메시지가 먼저)
+            role_display = "사용자" if chatbot_role in ["나", "user"] else "챗봇"
+            formatted_history += f"{role_display}: {chatbot_text}\n"
         return formatted_history
     except Exception as e:
         logger.error(f"대화 기록 조회 중 오류 발생 (user_id: {user_id}): {e}", exc_info=True)
@@ -169,29 +158,51 @@ def create_chatbot_prompt(user_input: str, dialogue_history: str = "") -> str:
 #         """
 #     return prompt
 
-@router.post("/dialogue", response_model=ChatBotResponse)
-async def dialogue_handler(request_data: ChatBotRequest):
-    logger.info(f"대화 요청 받음: 사용자 ID {request_data.user_id}, 메시지: {request_data.chatbot_text}")
-
-    # 1. 사용자 메시지를 DB에 저장
-    user_insert_sql = """
-    INSERT INTO tb_chatbot(user_id, chatbot_role, chatbot_text, created_at)
-    VALUES (:user_id, :chatbot_role, :chatbot_text, :created_at)
-    """
+async def _save_user_message(request_data: ChatBotRequest):
     try:
-        await database.execute(user_insert_sql, values={
-            "user_id": request_data.user_id,
-            "chatbot_role": request_data.chatbot_role,
-            "chatbot_text": request_data.chatbot_text,
-            "created_at": request_data.created_at, # 프론트에서 생성한 시간 (ISO 문자열)
-        })
+        # created_at: 프론트에서 생성한 시간 (ISO 문자열)
+        await save_chat_message(request_data.user_id, request_data.chatbot_role, request_data.chatbot_text, request_data.created_at)
         logger.info(f"사용자 메시지 저장 성공 (사용자 ID: {request_data.user_id})")
     except Exception as e:
         logger.error(f"사용자 메시지 저장 중 데이터베이스 오류 발생: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="사용자 메시지를 데이터베이스에 저장하는데 실패했습니다.")
 
+
+def _skin_advice_prompt(advice_request: SkinAdviceRequest) -> str:
+    # 공백 차이만 있는 피부 타입은 같은 프롬프트(같은 캐시 키)가 되도록 정규화합니다.
+    skin_type = " ".join(advice_request.predicted_skin_type.split())
+    return create_gemini_prompt(
+        user_input=f"{skin_type} 피부에 맞는 기초 화장품 추천", # 사용자의 요청을 명시적으로 구성
+        skin_type=skin_type,
+    )
+
+
+def _skin_advice_cache_key(gemini_model, prompt: str) -> str:
+    return advice_cache_key(getattr(gemini_model, "model_name", ""), prompt)
+
+
+async def _generate_skin_advice(gemini_model, prompt: str) -> str:
+    logger.info(f"Gemini API 요청 프롬프트 (일부): {prompt[:100]}...")
+    with span("gemini.generate"):
+        response = await gemini_model.generate_content_async(prompt)
+
+    if not response or not hasattr(response, "text") or not response.text:
+        logger.warning("Gemini API로부터 유효한 응답을 받지 못했습니다.")
+        raise HTTPException(status_code=500, detail="AI 모델 응답이 유효하지 않습니다.")
+
+    logger.info(f"Gemini API 피부 조언 응답 성공 (일부): {response.text[:200]}...")
+    return response.text
+
+
+@router.post("/dialogue", response_model=ChatBotResponse)
+async def dialogue_handler(request_data: ChatBotRequest, gemini_model = Depends(use_gemini_model)):
+    logger.info(f"대화 요청 받음: 사용자 ID {request_data.user_id}, 메시지: {request_data.chatbot_text}")
+
+    # 1. 사용자 메시지를 DB에 저장
+    await _save_user_message(request_data)
+
     # 2. 챗봇 답변 생성
-    chatbot_answer_text = "죄송합니다. 현재 답변을 드리기 어렵습니다. 잠시 후 다시 시도해주세요." # 기본 오류 메시지
+    chatbot_answer_text = DEFAULT_ANSWER
 
     if not gemini_model:
         logger.error("Gemini 모델이 로드되지 않아 지능적인 답변을 생성할 수 없습니다.")
@@ -227,7 +238,8 @@ async def dialogue_handler(request_data: ChatBotRequest):
             prompt = create_chatbot_prompt(user_input, dialogue_history=dialogue_history)
             
             logger.info(f"Gemini API 요청 프롬프트 (일부): {prompt[:300]}...")
-            response = await gemini_model.generate_content_async(prompt)
+            with span("gemini.generate"):
+                response = await gemini_model.generate_content_async(prompt)
 
             if not response.candidates or not response.candidates[0].content.parts:
                 logger.warning("Gemini API로부터 유효한 응답(candidates)을 받지 못했습니다.")
@@ -238,23 +250,14 @@ async def dialogue_handler(request_data: ChatBotRequest):
         except Exception as e:
             logger.error(f"Gemini API 호출 또는 응답 처리 중 오류 발생: {e}", exc_info=True)
             if "quota" in str(e).lower():
-                 chatbot_answer_text = "현재 많은 사용자가 서비스를 이용 중입니다. 잠시 후 다시 시도해주시면 감사하겠습니다."
+                 chatbot_answer_text = QUOTA_ANSWER
             # 다른 특정 오류에 대한 처리 추가 가능
 
     # 3. 챗봇의 답변을 DB에 저장
     # (오류 발생 시에도 chatbot_answer_text는 기본 오류 메시지 또는 특정 오류 메시지를 가짐)
     response_timestamp = datetime.now() # 답변 생성 및 저장 시점의 시간
-    chatbot_insert_sql = """
-    INSERT INTO tb_chatbot(user_id, chatbot_role, chatbot_text, created_at)
-    VALUES (:user_id, :chatbot_role, :chatbot_text, :created_at)
-    """
     try:
-        await database.execute(chatbot_insert_sql, values={
-            "user_id": request_data.user_id,
-            "chatbot_role": "챗봇",
-            "chatbot_text": chatbot_answer_text,
-            "created_at": response_timestamp,
-        })
+        await save_chat_message(request_data.user_id, "챗봇", chatbot_answer_text, response_timestamp)
         logger.info(f"챗봇 답변 저장 성공 (사용자 ID: {request_data.user_id})")
     except Exception as e:
         logger.error(f"챗봇 답변 저장 중 데이터베이스 오류 발생: {e}", exc_info=True)
@@ -272,7 +275,7 @@ async def dialogue_handler(request_data: ChatBotRequest):
 # 이 엔드포인트는 React의 SkinAnalysisResult 페이지에서 피부 분석 결과를 바탕으로
 # 상세한 화장품 추천을 받을 때 사용합니다.
 @router.post("/skin_advice", response_model=SkinAdviceResponse)
-async def skin_advice_handler(advice_request: SkinAdviceRequest):
+async def skin_advice_handler(advice_request: SkinAdviceRequest, gemini_model = Depends(use_gemini_model)):
     logger.info(
         f"피부 조언 요청 받음: 사용자 ID {advice_request.user_id}, "
         f"피부 타입 {advice_request.predicted_skin_type}, "
@@ -285,29 +288,21 @@ async def skin_advice_handler(advice_request: SkinAdviceRequest):
             status_code=503, detail="AI 모델을 현재 사용할 수 없습니다. 관리자에게 문의하세요."
         )
 
-    prompt = create_gemini_prompt(
-        user_input=f"{advice_request.predicted_skin_type} 피부에 맞는 기초 화장품 추천", # 사용자의 요청을 명시적으로 구성
-        skin_type=advice_request.predicted_skin_type,
-    )
+    prompt = _skin_advice_prompt(advice_request)
 
     advice_text: str = "죄송합니다. 현재 맞춤형 피부 조언을 드리기 어렵습니다."
     try:
-        logger.info(f"Gemini API 요청 프롬프트 (일부): {prompt[:100]}...")
-        response = await gemini_model.generate_content_async(prompt)
-
-        if not response or not hasattr(response, "text") or not response.text:
-            logger.warning("Gemini API로부터 유효한 응답을 받지 못했습니다.")
-            raise HTTPException(status_code=500, detail="AI 모델 응답이 유효하지 않습니다.")
-
-        advice_text = response.text
-        logger.info(f"Gemini API 피부 조언 응답 성공 (일부): {advice_text[:200]}...")
+        # 같은 프롬프트의 조언은 캐시에서, 동시에 들어온 같은 요청은 한 번의 Gemini 호출 결과를 함께 받습니다.
+        advice_text = await skin_advice_cache.get_or_create(
+            _skin_advice_cache_key(gemini_model, prompt), lambda: _generate_skin_advice(gemini_model, prompt)
+        )
     except HTTPException as http_exc:
         logger.error(f"HTTP 예외 발생: {http_exc.detail}")
         raise
     except Exception as e:
         logger.error(f"Gemini API 호출 중 오류 발생: {str(e)}", exc_info=True)
         if "quota" in str(e).lower():
-            advice_text = "현재 많은 사용자가 서비스를 이용 중입니다. 잠시 후 다시 시도해주시면 감사하겠습니다."
+            advice_text = QUOTA_ANSWER
         else:
             raise HTTPException(
                 status_code=500, detail="AI 모델 호출 중 문제가 발생했습니다."
@@ -321,6 +316,174 @@ async def skin_advice_handler(advice_request: SkinAdviceRequest):
     )
 
 
+# --- 스트리밍(Server-Sent Events) 엔드포인트 ---
+# 답변 전체를 기다리지 않고 Gemini 스트리밍 모드로 받은 조각을 도착하는 대로 보냅니다.
+# 이벤트: delta {"text"} (조각, 여러 번) -> done {완성된 응답, 일반 엔드포인트와 같은 필드} 또는 error {"detail"}
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+
+def _sse_response(event_stream) -> StreamingResponse:
+    return StreamingResponse(
+        event_stream,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def stream_gemini_text(gemini_model, prompt: str):
+    """Gemini 응답 텍스트 조각을 도착하는 대로 내보냅니다."""
+    with span("gemini.stream"):
+        response = await gemini_model.generate_content_async(prompt, stream=True)
+        async for chunk in response:
+            try:
+                text = chunk.text
+            except ValueError:
+                # 안전 필터 등으로 parts가 없는 조각은 건너뜁니다.
+                continue
+            if text:
+                yield text
+
+
+# 스트림이 닫힌 뒤에도 끝까지 실행되어야 하는 챗봇 답변 저장 작업 (GC되지 않도록 참조를 보관)
+_background_saves = set()
+
+
+async def _save_chatbot_answer(user_id: str, chatbot_text: str, created_at):
+    try:
+        await save_chat_message(user_id, "챗봇", chatbot_text, created_at)
+        logger.info(f"챗봇 답변 저장 성공 (사용자 ID: {user_id})")
+    except Exception as e:
+        logger.error(f"챗봇 답변 저장 중 데이터베이스 오류 발생: {e}", exc_info=True)
+
+
+def _save_chatbot_answer_in_background(user_id: str, chatbot_text: str, created_at) -> asyncio.Task:
+    task = asyncio.create_task(_save_chatbot_answer(user_id, chatbot_text, created_at))
+    _background_saves.add(task)
+    task.add_done_callback(_background_saves.discard)
+    return task
+
+
+@router.post("/dialogue/stream")
+async def dialogue_stream_handler(request_data: ChatBotRequest, gemini_model = Depends(use_gemini_model)):
+    logger.info(f"스트리밍 대화 요청 받음: 사용자 ID {request_data.user_id}, 메시지: {request_data.chatbot_text}")
+    await _save_user_message(request_data)
+    dialogue_history = await get_recent_dialogue_history(request_data.user_id)
+    prompt = create_chatbot_prompt(request_data.chatbot_text or "", dialogue_history=dialogue_history)
+
+    async def event_stream():
+        chunks = []
+        chatbot_answer_text = DEFAULT_ANSWER
+        saved = None
+        try:
+            if not gemini_model:
+                logger.error("Gemini 모델이 로드되지 않아 지능적인 답변을 생성할 수 없습니다.")
+                yield _sse("delta", {"text": chatbot_answer_text})
+            else:
+                try:
+                    async for text in stream_gemini_text(gemini_model, prompt):
+                        chunks.append(text)
+                        yield _sse("delta", {"text": text})
+                except Exception as e:
+                    logger.error(f"Gemini 스트리밍 호출 중 오류 발생: {e}", exc_info=True)
+                    if not chunks:
+                        chatbot_answer_text = QUOTA_ANSWER if "quota" in str(e).lower() else DEFAULT_ANSWER
+                        yield _sse("delta", {"text": chatbot_answer_text})
+                if chunks:
+                    chatbot_answer_text = "".join(chunks)
+                else:
+                    logger.warning("Gemini API로부터 유효한 스트리밍 응답을 받지 못했습니다.")
+
+            # 스트림이 끝난 뒤 완성된 답변을 한 번만 DB에 저장
+            response_timestamp = datetime.now()
+            saved = _save_chatbot_answer_in_background(request_data.user_id, chatbot_answer_text, response_timestamp)
+            await asyncio.shield(saved)
+        finally:
+            if saved is None and chunks:
+                # 클라이언트 연결이 끊겨 스트림이 중간에 닫힌 경우(GeneratorExit/CancelledError)에도
+                # 사용자가 본 만큼을 기록합니다. 닫히는 중에는 기다릴 수 없으므로 별도 작업으로 저장합니다.
+                _save_chatbot_answer_in_background(request_data.user_id, "".join(chunks), datetime.now())
+        yield _sse("done", ChatBotResponse(
+            user_id=request_data.user_id,
+            chatbot_role="챗봇",
+            chatbot_text=chatbot_answer_text,
+            created_at=response_timestamp,
+        ).model_dump(mode="json"))
+
+    return _sse_response(event_stream())
+
+
+@router.post("/skin_advice/stream")
+async def skin_advice_stream_handler(advice_request: SkinAdviceRequest, gemini_model = Depends(use_gemini_model)):
+    logger.info(
+        f"스트리밍 피부 조언 요청 받음: 사용자 ID {advice_request.user_id}, "
+        f"피부 타입 {advice_request.predicted_skin_type}"
+    )
+    if not gemini_model:
+        logger.error("Gemini 모델이 로드되지 않아 피부 조언을 생성할 수 없습니다.")
+        raise HTTPException(
+            status_code=503, detail="AI 모델을 현재 사용할 수 없습니다. 관리자에게 문의하세요."
+        )
+    prompt = _skin_advice_prompt(advice_request)
+    cache_key = _skin_advice_cache_key(gemini_model, prompt)
+
+    async def event_stream():
+        chunks = []
+        # 캐시에 있거나 같은 요청이 이미 Gemini를 호출 중이면 그 결과를 한 번에 보냅니다.
+        cached = await skin_advice_cache.get(cache_key)
+        pending = skin_advice_cache.inflight(cache_key) if cached is None else None
+        if pending is not None:
+            try:
+                cached = await asyncio.shield(pending)
+            except Exception as e:
+                logger.warning(f"함께 기다리던 피부 조언 호출이 실패했습니다: {e}")
+        if cached:
+            chunks.append(cached)
+            yield _sse("delta", {"text": cached})
+        else:
+            # Gemini 스트림은 요청과 분리된 작업에서 받아 큐로 넘깁니다.
+            # 이 요청의 연결이 끊겨도 작업은 끝까지 받아 캐시하고, 함께 기다리던 요청에 결과를 줍니다.
+            queue: asyncio.Queue = asyncio.Queue()
+
+            async def receive_advice() -> str:
+                parts = []
+                try:
+                    async for text in stream_gemini_text(gemini_model, prompt):
+                        parts.append(text)
+                        queue.put_nowait(text)
+                finally:
+                    queue.put_nowait(None)
+                # 끝까지 받은 조언만 캐시합니다. (빈 응답은 캐시하지 않음)
+                return "".join(parts)
+
+            task = skin_advice_cache.start(cache_key, receive_advice)
+            while (text := await queue.get()) is not None:
+                chunks.append(text)
+                yield _sse("delta", {"text": text})
+            try:
+                await asyncio.shield(task)
+            except Exception as e:
+                logger.error(f"Gemini 스트리밍 호출 중 오류 발생: {str(e)}", exc_info=True)
+                if not chunks:
+                    if "quota" in str(e).lower():
+                        chunks.append(QUOTA_ANSWER)
+                        yield _sse("delta", {"text": QUOTA_ANSWER})
+                    else:
+                        yield _sse("error", {"detail": "AI 모델 호출 중 문제가 발생했습니다."})
+                        return
+        if not chunks:
+            logger.warning("Gemini API로부터 유효한 응답을 받지 못했습니다.")
+            yield _sse("error", {"detail": "AI 모델 응답이 유효하지 않습니다."})
+            return
+        yield _sse("done", SkinAdviceResponse(
+            user_id=advice_request.user_id,
+            advice="".join(chunks),
+            created_at=datetime.now(),
+        ).model_dump(mode="json"))
+
+    return _sse_response(event_stream())
+
+
 # --- 대화 기록 조회 엔드포인트 ---
 @router.get("/dialogue/history/{user_id}", response_model=DialogueHistoryResponse)
 async def get_dialogue_history(user_id: str):
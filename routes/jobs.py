@@ -0,0 +1,44 @@
+# jobs.py
+# 비동기 분석 작업 상태 조회 엔드포인트 (폴링 / Server-Sent Events)
+
+import json
+import logging
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
+from jobs import analysis_jobs
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+
+def _get_job_or_404(job_id: str):
+    job = analysis_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="작업을 찾을 수 없습니다. (만료되었거나 다른 서버에서 생성된 작업)")
+    return job
+
+
+# 작업 상태 폴링. 끝난 작업은 result(성공) 또는 error(실패)를 포함합니다.
+@router.get("/{job_id}")
+async def get_job(job_id: str):
+    return {"success": True, "job": _get_job_or_404(job_id).to_dict()}
+
+
+# 작업 상태 구독 (text/event-stream). 상태가 바뀔 때마다 status 이벤트를 보내고, 작업이 끝나면 스트림을 닫습니다.
+@router.get("/{job_id}/events")
+async def stream_job_events(job_id: str):
+    _get_job_or_404(job_id)
+
+    async def event_stream():
+        async for state in analysis_jobs.events(job_id):
+            if state is None:
+                yield ": keepalive\n\n" # 프록시(ngrok 등)가 유휴 연결을 끊지 않도록 주석 줄을 보냅니다.
+                continue
+            yield f"event: status\ndata: {json.dumps(state, ensure_ascii=False)}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
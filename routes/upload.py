@@ -1,18 +1,22 @@
+import asyncio
 from datetime import datetime
 import json
 import sys
 import tempfile
-from fastapi import APIRouter, Form, HTTPException, UploadFile, File
-import boto3
+from fastapi import APIRouter, Depends, Form, HTTPException, Query, Request, UploadFile, File
 import os
 import logging
 from typing import Annotated
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 from database import database  # database.py에서 인스턴스를 가져오기
-from fastapi.responses import JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
 import httpx # 현재 코드에서는 직접 사용되지 않지만, 기존에 포함되어 있었으므로 유지합니다.
 import uuid
 import pandas as pd
+import numpy as np
+from collections import Counter
+from PIL import Image
 
 # sys.path.append 부분은 Poetry를 사용한다면 제거하는 것이 좋습니다.
 # Poetry는 pyproject.toml에 정의된 경로를 자동으로 관리합니다.
@@ -24,60 +28,56 @@ sys.path.append(os.path.abspath("SkinAnalysis"))
 # 응답 및 요청 모델 정의 (FastAPI Pydantic) 임포트
 from ShowMeTheColor.src.personal_color_analysis import personal_color
 from schemas import (
+    AnalyzeObjectRequest,
+    DirectUploadRequest,
+    DirectUploadResponse,
+    PresignedUrlBatchRequest,
+    PresignedUrlBatchResponse,
     PresignedUrlRequest,
     PresignedUrlResponse,
     ImageUploadResponse
 )
 # SkinAnalysis 모듈에서 SkinAnalyzer 클래스 임포트
-from SkinAnalysis.aimodel import SkinAnalyzer
+from SkinAnalysis.aimodel import FaceBoxCache, SkinAnalyzer
+from admission import admit_analysis, analysis_admission
+from upload_stream import ALLOWED_IMAGE_TYPES, MAX_UPLOAD_BYTES, sniff_image_type, spool_stream, spool_upload
+from storage import LocalStorage
+from dedup import (
+    content_locks, content_object_key, dedup_lock_key, file_sha256, find_existing_analysis, record_reused_analysis
+)
+from deadlines import StageTimeout, run_stage, run_thread_stage, timed_out_marker
+from derivatives import derivative_urls, derivative_urls_many, sign_derivatives, store_derivatives
+from tracing import span, traced
+from jobs import analysis_jobs
+from model_registry import (
+    PERSONAL_COLOR, SKIN_ANALYZER, SKIN_EMBEDDINGS, STORAGE, registry,
+    use_personal_color_analyzer, use_storage, use_skin_analyzer, use_skin_embeddings
+)
 
 from dotenv import load_dotenv
 load_dotenv()
 
 router = APIRouter()
+# 로컬 스토리지(STORAGE_BACKEND=local) 파일 다운로드. main.py가 LOCAL_STORAGE_BASE_URL 경로에 등록합니다.
+local_files_router = APIRouter()
 # 이미지 업로드 단
-# 환경 변수에서 자격 증명 가져오기 (권장)
-s3_client = boto3.client(
-    's3',
-    aws_access_key_id=os.environ.get("AWS_ACCESS_KEY_ID"),
-    aws_secret_access_key=os.environ.get("AWS_SECRET_ACCESS_KEY"),
-    region_name=os.environ.get("AWS_REGION")
-)
-
-# 환경 변수에서 S3 버킷 이름 가져오기
-S3_BUCKET_NAME = os.environ.get("S3_BUCKET_NAME")
-
-if not S3_BUCKET_NAME:
-    raise ValueError("S3_BUCKET_NAME 환경 변수가 설정되지 않았습니다.")
+# 스토리지(S3/로컬)와 모델은 model_registry에서 워커당 한 번만 만들어 의존성으로 주입받습니다.
+# 버킷 등 스토리지 설정은 storage.py의 build_storage()가 환경 변수에서 읽습니다.
 
 
 # 로깅 설정 (S3 서버에서도 필요)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# SkinAnalyzer 인스턴스를 전역적으로 생성 (서버 시작 시 한 번만 로드)
-skin_analyzer_instance = None # 초기화 전 None으로 설정
-try:
-    # 모델 파일 경로를 SkinAnalysis 폴더 기준으로 정확하게 설정합니다.
-    # 모델 파일이 'SkinAnalysis' 폴더 안에 있다고 가정합니다.
-    # sys.path.append("SkinAnalysis") 가 설정되어 있다면, 이 경로는 SkinAnalysis 모듈 내부에서 처리됩니다.
-    skin_analyzer_instance = SkinAnalyzer(
-        model_save_path="image_to_measurement_model.pth",
-        target_scaler_save_path="target_measurement_scaler.joblib",
-        skin_type_model_filename="best_skin_type_model_v3_measurements_only.joblib",
-        label_encoder_filename="label_encoder_v3_measurements_only.joblib"
-    )
-    logger.info("SkinAnalyzer 인스턴스 초기화 성공.")
-except Exception as e:
-    logger.error(f"SkinAnalyzer 인스턴스 초기화 실패: {e}. 피부 분석 서비스를 사용할 수 없습니다.", exc_info=True)
-    skin_analyzer_instance = None # 로드 실패 시 None으로 설정
-
-
 # API 엔드포인트: 이미지 업로드 및 분석 통합
-@router.post("/upload-and-analyze")
+@router.post("/upload-and-analyze", dependencies=[Depends(admit_analysis)])
 async def upload_and_analyze(
     file: UploadFile = File(...),  # 업로드된 파일
-    user_id: str = Form(...)  # 사용자 ID 필드 추가
+    user_id: str = Form(...),  # 사용자 ID 필드 추가
+    skin_analyzer_instance: SkinAnalyzer = Depends(use_skin_analyzer),
+    personal_color_analyzer = Depends(use_personal_color_analyzer),
+    storage = Depends(use_storage),
+    skin_embeddings = Depends(use_skin_embeddings)
 ):
     
     if not skin_analyzer_instance:
@@ -86,147 +86,766 @@ async def upload_and_analyze(
         # 디버그용 출력
     print(f"User ID: {user_id}")
 
-    # 현재 시간 가져오기 및 포맷팅
-    timestamp = datetime.now().strftime("%Y.%m.%d.%H.%M.%S")
+    upload = None
 
-    original_filename = file.filename  # 업로드된 파일명 (ex: "selfie.jpg")
-    extension = os.path.splitext(original_filename)[1]  # ".jpg"
+    try:
+        # 본문을 청크 단위로 임시 파일에 받으면서 형식/크기 검사와 해시 계산을 함께 합니다.
+        upload = await spool_upload(file)
+        temp_filepath = upload.path
+        logger.info(f"Temporary file created for analysis: {temp_filepath} ({upload.size} bytes, sha256={upload.sha256})")
 
-    temp_filepath = None 
+        response_content = await _analyze_upload_deduplicated(
+            temp_filepath, upload.content_type, upload.extension, upload.sha256, user_id,
+            skin_analyzer_instance, personal_color_analyzer, storage, skin_embeddings
+        )
+        print("백엔드에서 실제 응답할 내용:", response_content) # 디버깅 로그 추가
+        
+        return JSONResponse(content=response_content) # 변수를 사용하여 응답
 
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error during upload and analyze: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail="Error occurred during upload and analyze process.")
+    finally:
+        if upload is not None:
+            upload.cleanup()
+            logger.info(f"Temporary file {upload.path} deleted.")
+
+
+# API 엔드포인트: 업로드 후 작업 ID를 바로 반환하고 분석은 작업 워커가 수행 (프록시 타임아웃 회피용)
+# 결과는 GET /jobs/{job_id} 폴링 또는 GET /jobs/{job_id}/events (SSE)로 받습니다.
+@router.post("/upload-and-analyze/jobs", status_code=202)
+async def submit_upload_and_analyze_job(
+    file: UploadFile = File(...),
+    user_id: str = Form(...),
+    storage = Depends(use_storage)
+):
+    upload = None
     try:
-        contents = await file.read()
+        upload = await spool_upload(file)
+        job = await analysis_jobs.submit("upload_and_analyze", {
+            "temp_filepath": upload.path,
+            "content_type": upload.content_type,
+            "extension": upload.extension,
+            "content_hash": upload.sha256,
+            "user_id": user_id,
+        })
+    except BaseException:
+        # 큐에 들어가지 못한 업로드만 여기서 지웁니다. (들어간 작업의 임시 파일은 작업이 끝날 때 정리)
+        if upload is not None:
+            upload.cleanup()
+        raise
+    logger.info(f"Analysis job {job.id} queued for user {user_id} ({upload.size} bytes)")
+    return {
+        "success": True,
+        "message": "분석 작업이 등록되었습니다.",
+        "job_id": job.id,
+        "status": job.status,
+        "status_url": f"/jobs/{job.id}",
+        "events_url": f"/jobs/{job.id}/events",
+    }
 
-        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-            temp_file.write(contents)
-            temp_filepath = temp_file.name
-        logger.info(f"Temporary file created for analysis: {temp_filepath}")
 
-        analysis_result_tone = None
-        skin_analysis_results = {"average_measurements": {}, "predicted_skin_type": "분석 실패"}
+async def _run_upload_and_analyze_job(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """작업 워커에서 실행됩니다. 요청 의존성 대신 레지스트리에서 직접 모델을 빌려 씁니다."""
+    skin_analyzer_instance = registry.acquire(SKIN_ANALYZER)
+    personal_color_analyzer = registry.acquire(PERSONAL_COLOR)
+    storage = registry.acquire(STORAGE)
+    skin_embeddings = registry.acquire(SKIN_EMBEDDINGS)
+    try:
+        if not skin_analyzer_instance:
+            raise HTTPException(status_code=500, detail="Skin analysis service is not available. Please check server logs.")
+        # 동기 분석 요청과 같은 분석 자리를 써서, 두 경로를 합친 동시 분석 수가 ANALYSIS_MAX_CONCURRENT를 넘지 않게 합니다.
+        # 이미 큐에 들어온 작업이므로 거절하지 않고 자리가 날 때까지 기다립니다.
+        async with analysis_admission.slot(wait=True):
+            return await _analyze_upload_deduplicated(
+                payload["temp_filepath"], payload["content_type"], payload["extension"], payload["content_hash"], payload["user_id"],
+                skin_analyzer_instance, personal_color_analyzer, storage, skin_embeddings
+            )
+    finally:
+        for obj in (skin_analyzer_instance, personal_color_analyzer, storage, skin_embeddings):
+            registry.release(obj)
+
+
+def _cleanup_upload_and_analyze_job(payload: Dict[str, Any]):
+    if os.path.exists(payload["temp_filepath"]):
+        os.unlink(payload["temp_filepath"])
+
+
+analysis_jobs.register_handler("upload_and_analyze", _run_upload_and_analyze_job, _cleanup_upload_and_analyze_job)
+
+
+# API 엔드포인트: 단계별 결과를 끝나는 순서대로 흘려보내는 upload-and-analyze
+# 이벤트: personal_color, skin_measurements, skin_type, stored, result(최종, analysis_idx 포함) / 실패 시 error
+# format=ndjson(기본, 한 줄에 {"event", "data"} 하나) 또는 format=sse(text/event-stream)
+@router.post("/upload-and-analyze/stream")
+async def upload_and_analyze_stream(
+    file: UploadFile = File(...),
+    user_id: str = Form(...),
+    format: str = Query("ndjson", pattern="^(ndjson|sse)$")
+):
+    # 형식/크기 오류는 스트림을 열기 전에 일반 HTTP 오류로 돌려줍니다.
+    upload = await spool_upload(file)
+    if format == "sse":
+        media_type, encode = "text/event-stream", _encode_sse_event
+    else:
+        media_type, encode = "application/x-ndjson", _encode_ndjson_event
+    return StreamingResponse(
+        _stream_analysis_events(upload, user_id, encode),
+        media_type=media_type,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(upload.cleanup), # 스트림이 시작되기 전에 연결이 끊긴 경우 대비
+    )
+
+
+def _encode_ndjson_event(event: str, data: Dict[str, Any]) -> str:
+    return json.dumps({"event": event, "data": data}, ensure_ascii=False) + "\n"
 
-        # 1. Personal Color Analysis (로컬 임시 파일 사용)
-        try:
-            analysis_result_tone = personal_color.analysis(temp_filepath)
-            logger.info(f"Personal color analysis completed. Result: {analysis_result_tone}")
-        except Exception as e:
-            logging.error(f"Personal color analysis failed: {e}", exc_info=True)
-            analysis_result_tone = {"error": "Personal color analysis failed"}
-        
-        # 2. Skin Analysis (로컬 임시 파일 사용)
-        try:
-            skin_analysis_raw_results = skin_analyzer_instance.analyze_skin_from_local_path(temp_filepath)
 
-            if "error" in skin_analysis_raw_results:
-                logger.error(f"로컬 이미지 피부 분석 중 오류 발생: {skin_analysis_raw_results['error']}")
-                skin_analysis_results["predicted_skin_type"] = f"피부 분석 오류: {skin_analysis_raw_results['error']}"
+def _encode_sse_event(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def _stream_analysis_events(upload, user_id: str, encode):
+    """
+    응답 본문 생성기. 스트리밍 응답은 핸들러가 반환된 뒤에 만들어지므로
+    입장 제어와 모델 참조는 요청 의존성 대신 여기서 직접 잡습니다.
+    """
+    try:
+        async with analysis_admission.slot():
+            async for event, data in _analysis_stage_events(upload, user_id):
+                yield encode(event, data)
+    except HTTPException as e:
+        yield encode("error", {"status_code": e.status_code, "detail": e.detail})
+    except Exception as e:
+        logging.error(f"Error during streaming upload and analyze: {e}", exc_info=True)
+        yield encode("error", {"status_code": 500, "detail": "Error occurred during upload and analyze process."})
+    finally:
+        upload.cleanup()
+
+
+async def _analysis_stage_events(upload, user_id: str):
+    skin_analyzer_instance = registry.acquire(SKIN_ANALYZER)
+    personal_color_analyzer = registry.acquire(PERSONAL_COLOR)
+    storage = registry.acquire(STORAGE)
+    skin_embeddings = registry.acquire(SKIN_EMBEDDINGS)
+    pending: Dict[asyncio.Future, str] = {}
+    try:
+        if not skin_analyzer_instance:
+            raise HTTPException(status_code=500, detail="Skin analysis service is not available. Please check server logs.")
+        # 버전을 아직 모르면(모델 서버의 첫 응답 전) None이고, 이때는 재사용하지 않습니다.
+        model_version = getattr(skin_analyzer_instance, "model_version", None)
+        async with content_locks.hold(dedup_lock_key(upload.sha256, user_id)):
+            existing = await find_existing_analysis(upload.sha256, model_version, user_id)
+            if existing is not None:
+                # 이미 분석된 이미지는 저장된 결과를 같은 순서의 이벤트로 바로 보냅니다.
+                response_content = await record_reused_analysis(existing, user_id, upload.sha256, skin_embeddings)
+                yield "personal_color", {"personal_color_tone": response_content["personal_color_tone"]}
+                yield "skin_measurements", {"average_measurements": response_content["skin_analysis"].get("average_measurements", {})}
+                yield "skin_type", {"predicted_skin_type": response_content["skin_analysis"].get("predicted_skin_type")}
+                response_content["derivatives"] = await derivative_urls(storage, response_content["s3_url"])
+                yield "stored", {"s3_url": response_content["s3_url"], "derivatives": response_content["derivatives"]}
+                yield "result", response_content
+                return
+
+            s3_key = content_object_key(upload.sha256, upload.extension)
+            s3_url = storage.url_for(s3_key)
+            timed_out: List[str] = []
+            pending[asyncio.create_task(_within_budget(
+                run_stage("storage", _put_if_absent(storage, s3_key, upload.path, upload.content_type)), timed_out,
+                timed_out_marker("storage")
+            ))] = "stored"
+            image, derivatives_upload = await _start_derivatives(upload.path, storage, s3_key, timed_out)
+            face_cache = await _prepare_face_cache(upload.path, skin_analyzer_instance, personal_color_analyzer, timed_out)
+            pending[asyncio.create_task(_within_budget(run_thread_stage(
+                "dominant_color", _run_personal_color_analysis, personal_color_analyzer, upload.path, face_cache
+            ), timed_out, timed_out_marker("dominant_color")))] = "personal_color"
+            pending[asyncio.create_task(_within_budget(run_thread_stage(
+                "skin_inference", _run_skin_analysis, skin_analyzer_instance, upload.path, face_cache,
+                skin_embeddings is not None, image
+            ), timed_out, _skin_timed_out_result()))] = "skin"
+
+            analysis_result_tone = skin_analysis_results = skin_embedding = None
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    stage = pending.pop(task)
+                    if stage == "personal_color":
+                        analysis_result_tone = task.result()
+                        yield "personal_color", {"personal_color_tone": analysis_result_tone}
+                    elif stage == "skin":
+                        # 피부 타입 분류는 측정값이 나온 직후 바로 끝나므로 두 이벤트가 연달아 나갑니다.
+                        skin_analysis_results, skin_embedding = task.result()
+                        yield "skin_measurements", {"average_measurements": skin_analysis_results["average_measurements"]}
+                        yield "skin_type", {"predicted_skin_type": skin_analysis_results["predicted_skin_type"]}
+                    elif task.exception() is not None:
+                        logger.error(f"S3 upload failed: {task.exception()}", exc_info=task.exception())
+                        raise HTTPException(status_code=500, detail="An error occurred while uploading the image to S3. Please try again.")
+                    elif task.result() is not None:
+                        derivatives = {}
+                        yield "stored", task.result() # 저장 시간 초과 표시
+                    else:
+                        logger.info(f"Image uploaded to S3: {s3_url}")
+                        derivatives = await _signed_derivatives(storage, derivatives_upload)
+                        yield "stored", {"s3_url": s3_url, "derivatives": derivatives}
+
+            if "storage" in timed_out:
+                response_content = _analysis_response(user_id, None, analysis_result_tone, skin_analysis_results, None, timed_out)
             else:
-                skin_analysis_results["average_measurements"] = skin_analysis_raw_results.get("average_measurements", {})
-                skin_analysis_results["predicted_skin_type"] = skin_analysis_raw_results.get("predicted_skin_type", "분석 성공")
-            logger.info(f"Skin analysis completed. Predicted Skin Type: {skin_analysis_results['predicted_skin_type']}.")
+                response_content = await _record_analysis(
+                    user_id, s3_url, skin_analyzer_instance, analysis_result_tone, skin_analysis_results, skin_embedding,
+                    skin_embeddings, upload.sha256, timed_out
+                )
+            response_content["derivatives"] = derivatives
+            yield "result", response_content
+    finally:
+        # 클라이언트가 연결을 끊으면 남은 단계는 취소합니다. (스레드에서 도는 추론은 끝날 때까지 실행됨)
+        for task in pending:
+            task.cancel()
+        for obj in (skin_analyzer_instance, personal_color_analyzer, storage, skin_embeddings):
+            registry.release(obj)
 
-        except (ValueError, RuntimeError) as e:
-            logger.error(f"Skin analysis using local file failed for {temp_filepath}: {e}", exc_info=True)
-            skin_analysis_results["predicted_skin_type"] = f"피부 분석 실패: {str(e)}"
-        except Exception as e:
-            logger.error(f"Unexpected error during skin analysis for {temp_filepath}: {e}", exc_info=True)
-            skin_analysis_results["predicted_skin_type"] = "피부 분석 중 예상치 못한 오류 발생"
-        
-        # 파일 이름 및 예상 S3 URL 생성
-        file_name = f"{timestamp}_{user_id}{extension}"
-        s3_key = f"images/{file_name}"
-        s3_url = f"https://{S3_BUCKET_NAME}.s3.amazonaws.com/{s3_key}"
 
-        # 데이터베이스에 결과 삽입
-        try:
-            sql_insert = """
-            INSERT INTO tb_analysis (user_id, analysis_model, file_path, skin_tone, personal_color, analysis_result, created_at)
-            VALUES (:user_id, :analysis_model, :file_path, :skin_tone, :personal_color, :analysis_result, :created_at)
-            """
-            await database.execute(
-                sql_insert,
-                values={
-                    "user_id": user_id,
-                    "analysis_model": "SkinAnalyzer v2",
-                    "file_path": s3_url,
-                    "skin_tone": skin_analysis_results.get("predicted_skin_type", "Unknown"),
-                    "personal_color": (
-                        analysis_result_tone.get("tone", "N/A")
-                        if isinstance(analysis_result_tone, dict)
-                        else analysis_result_tone if isinstance(analysis_result_tone, str)
-                        else "N/A"
-                    ),
-                    # JSON 직렬화
-                    "analysis_result": json.dumps(skin_analysis_results),
-                    "created_at": datetime.now(),
-                }
-            )
-            logger.info("Database insert successful for analysis results.")
-        except Exception as db_error:
-            logger.error(f"Database insert failed: {db_error}", exc_info=True)
-            raise HTTPException(
-                status_code=500,
-                detail="An error occurred while saving analysis results to the database. Please try again."
-            )
+# API 엔드포인트: 한 사람의 이미지 여러 장을 한 번에 분석 (사진 한 장의 측정 잡음을 줄이기 위한 용도)
+# 이미지별 결과와 함께 측정값 중앙값 기반의 종합 결과를 반환하고, 이미지마다 tb_analysis 행을 한 트랜잭션으로 기록합니다.
+MAX_BATCH_IMAGES = int(os.environ.get("MAX_BATCH_IMAGES", "8"))
 
-        # S3에 이미지 업로드
-        try:
-            s3_client.put_object(
-                Bucket=S3_BUCKET_NAME,
-                Key=s3_key,
-                Body=contents
-            )
-            logger.info(f"Image '{file_name}' uploaded to S3: {s3_url}")
-        except Exception as s3_error:
-            logger.error(f"S3 upload failed: {s3_error}", exc_info=True)
-            raise HTTPException(
-                status_code=500,
-                detail="An error occurred while uploading the image to S3. Please try again."
+
+@router.post("/upload-and-analyze/batch", dependencies=[Depends(admit_analysis)])
+async def upload_and_analyze_batch(
+    files: List[UploadFile] = File(...),
+    user_id: str = Form(...),
+    skin_analyzer_instance: SkinAnalyzer = Depends(use_skin_analyzer),
+    personal_color_analyzer = Depends(use_personal_color_analyzer),
+    storage = Depends(use_storage),
+    skin_embeddings = Depends(use_skin_embeddings)
+):
+    if not skin_analyzer_instance:
+        raise HTTPException(status_code=500, detail="Skin analysis service is not available. Please check server logs.")
+    if len(files) > MAX_BATCH_IMAGES:
+        raise HTTPException(status_code=400, detail=f"한 번에 최대 {MAX_BATCH_IMAGES}장까지 분석할 수 있습니다.")
+
+    uploads = []
+    try:
+        # multipart 본문은 순서대로 파싱되어 있으므로 임시 파일로 옮기는 작업만 동시에 진행합니다.
+        spooled = await asyncio.gather(*(spool_upload(file) for file in files), return_exceptions=True)
+        uploads = [upload for upload in spooled if not isinstance(upload, BaseException)]
+        for index, upload in enumerate(spooled):
+            if isinstance(upload, HTTPException):
+                raise HTTPException(status_code=upload.status_code, detail=f"{index + 1}번째 이미지: {upload.detail}")
+            if isinstance(upload, BaseException):
+                raise upload
+
+        # 단건 업로드와 같이, 현재 모델 버전으로 이미 분석된 이미지(user-041 중복 제거)는 저장된 결과를 재사용합니다.
+        # 이미지별 잠금(content_locks)은 잡지 않습니다. 여러 키를 한 요청이 잡으면 순서에 따라 교착될 수 있고,
+        # 동시에 같은 이미지가 들어와 두 번 분석되더라도 결과는 같습니다.
+        model_version = getattr(skin_analyzer_instance, "model_version", None)
+        existing_rows = await asyncio.gather(*(
+            find_existing_analysis(upload.sha256, model_version, user_id) for upload in uploads
+        ))
+        reused = {index: row for index, row in enumerate(existing_rows) if row is not None}
+        fresh = [index for index in range(len(uploads)) if index not in reused]
+
+        # 디코딩을 이미지별로 동시에 수행한 뒤, 얼굴 검출을 하고, 피부 분석은 한 번의 배치 순전파로,
+        # 퍼스널 컬러는 이미지별 스레드로 동시에 실행합니다.
+        images = dict(zip(fresh, await asyncio.gather(
+            *(asyncio.to_thread(_decode_rgb, uploads[index].path) for index in fresh), return_exceptions=True
+        )))
+        decoded = [index for index in fresh if not isinstance(images[index], BaseException)]
+
+        # 저장은 분석과 무관하므로 디코딩된 이미지의 객체 업로드를 분석과 동시에 진행합니다.
+        # 디코딩에 실패한 이미지는 어떤 행도 가리키지 않으므로 올리지 않습니다.
+        s3_keys = {index: content_object_key(uploads[index].sha256, uploads[index].extension) for index in decoded}
+        s3_uploads = [
+            asyncio.create_task(_put_if_absent(storage, s3_keys[index], uploads[index].path, uploads[index].content_type))
+            for index in decoded
+        ]
+
+        face_caches = dict(zip(decoded, await asyncio.gather(*(
+            _prepare_face_cache(uploads[index].path, skin_analyzer_instance, personal_color_analyzer, []) for index in decoded
+        ))))
+        tones, skin_results = await asyncio.gather(
+            asyncio.gather(*(
+                asyncio.to_thread(_run_personal_color_analysis, personal_color_analyzer, uploads[index].path, face_caches[index])
+                for index in decoded
+            )),
+            asyncio.to_thread(
+                _run_skin_batch, skin_analyzer_instance, [uploads[index].path for index in decoded],
+                [images[index] for index in decoded], [face_caches[index] for index in decoded], skin_embeddings is not None
             )
-        
-        current_analysis_time = datetime.now() # 응답에 포함될 생성 시간
-        # --- 여기가 수정될 부분 ---
-        response_content = {
+        )
+
+        derivatives = await asyncio.gather(*(
+            store_derivatives(storage, s3_keys[index], images[index]) for index in decoded
+        ))
+        derivatives = await asyncio.gather(*(sign_derivatives(storage, keys) for keys in derivatives))
+        upload_errors = await asyncio.gather(*s3_uploads, return_exceptions=True)
+        for error in upload_errors:
+            if isinstance(error, BaseException):
+                logger.error(f"S3 upload failed: {error}", exc_info=error)
+                raise HTTPException(status_code=500, detail="An error occurred while uploading the image to S3. Please try again.")
+
+        per_image: List[Dict[str, Any]] = [
+            {"index": index, "filename": files[index].filename, "error": "이미지를 디코딩할 수 없습니다."}
+            for index in fresh if isinstance(images[index], BaseException)
+        ]
+        rows, embeddings = [], []
+        created_at = datetime.now()
+        for index, tone, (skin_analysis_results, skin_embedding), image_derivatives in zip(decoded, tones, skin_results, derivatives):
+            s3_url = storage.url_for(s3_keys[index])
+            rows.append({
+                "user_id": user_id,
+                "analysis_model": model_version or "SkinAnalyzer",
+                "file_path": s3_url,
+                "skin_tone": skin_analysis_results.get("predicted_skin_type", "Unknown"),
+                "personal_color": _personal_color_label(tone),
+                "analysis_result": json.dumps(skin_analysis_results),
+                "created_at": created_at,
+                "content_hash": _reusable_content_hash(uploads[index].sha256, tone, skin_analysis_results),
+            })
+            embeddings.append(skin_embedding)
+            per_image.append({
+                "index": index,
+                "filename": files[index].filename,
+                "s3_url": s3_url,
+                "personal_color_tone": tone,
+                "skin_analysis": skin_analysis_results,
+                "derivatives": image_derivatives,
+            })
+
+        analysis_ids = await _insert_analysis_rows(rows)
+        for item, analysis_idx in zip((item for item in per_image if "error" not in item), analysis_ids):
+            item["analysis_idx"] = analysis_idx
+        if skin_embeddings is not None:
+            for analysis_idx, skin_embedding in zip(analysis_ids, embeddings):
+                if skin_embedding is None:
+                    continue
+                try:
+                    await asyncio.to_thread(skin_embeddings.add, analysis_idx, skin_embedding)
+                except Exception as e:
+                    logger.error(f"피부 임베딩 저장 실패 (analysis_idx={analysis_idx}): {e}", exc_info=True)
+
+        # 재사용한 이미지도 이미지별 결과와 종합 결과에 포함합니다.
+        aggregate_tones = list(tones)
+        aggregate_results = [result for result, _ in skin_results]
+        reused_derivatives = await derivative_urls_many(storage, [row["file_path"] for row in reused.values()])
+        for (index, row), image_derivatives in zip(reused.items(), reused_derivatives):
+            response_content = await record_reused_analysis(row, user_id, uploads[index].sha256, skin_embeddings)
+            aggregate_tones.append(response_content["personal_color_tone"])
+            aggregate_results.append(response_content["skin_analysis"])
+            per_image.append({
+                "index": index,
+                "filename": files[index].filename,
+                "s3_url": response_content["s3_url"],
+                "personal_color_tone": response_content["personal_color_tone"],
+                "skin_analysis": response_content["skin_analysis"],
+                "derivatives": image_derivatives,
+                "analysis_idx": response_content["analysis_idx"],
+                "deduplicated": True,
+            })
+
+        per_image.sort(key=lambda item: item["index"])
+        return JSONResponse(content={
             "success": True,
-            "message": "Image uploaded and analyzed successfully.",
-            "s3_url": s3_url,
-            "created_at": current_analysis_time.isoformat(), # ISO 형식으로 변환
-            "personal_color_tone": analysis_result_tone,
-            "skin_analysis": skin_analysis_results,
-            "user_id": user_id
-        }
-        print("백엔드에서 실제 응답할 내용:", response_content) # 디버깅 로그 추가
-        
-        return JSONResponse(content=response_content) # 변수를 사용하여 응답
+            "message": "Images uploaded and analyzed successfully.",
+            "user_id": user_id,
+            "created_at": created_at.isoformat(),
+            "images": per_image,
+            "aggregate": _aggregate_person(skin_analyzer_instance, aggregate_tones, aggregate_results),
+        })
 
+    except HTTPException:
+        raise
     except Exception as e:
-        logging.error(f"Error during upload and analyze: {e}", exc_info=True)
+        logging.error(f"Error during batch upload and analyze: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Error occurred during upload and analyze process.")
     finally:
-        if temp_filepath and os.path.exists(temp_filepath):
-            os.unlink(temp_filepath)
-            logger.info(f"Temporary file {temp_filepath} deleted.")
+        for upload in uploads:
+            upload.cleanup()
+
+
+def _decode_rgb(image_path: str) -> Image.Image:
+    with Image.open(image_path) as image:
+        return image.convert('RGB')
+
+
+@traced("inference.skin_batch")
+def _run_skin_batch(skin_analyzer_instance, image_paths: List[str], images: List[Image.Image], face_caches, return_embedding: bool):
+    """이미지 순서대로 _run_skin_analysis와 같은 (결과, 임베딩) 목록을 반환합니다."""
+    if not images:
+        return []
+    if not hasattr(skin_analyzer_instance, "analyze_skin_batch"):
+        # 모델 서버(RemoteSkinAnalyzer)는 배치 API가 없어 이미지별로 요청합니다.
+        return [_run_skin_analysis(skin_analyzer_instance, path, cache, return_embedding) for path, cache in zip(image_paths, face_caches)]
+    try:
+        raw_results = skin_analyzer_instance.analyze_skin_batch(images, face_caches, return_embedding=return_embedding)
+    except Exception as e:
+        logger.error(f"Batch skin analysis failed: {e}", exc_info=True)
+        return [({"average_measurements": {}, "predicted_skin_type": "피부 분석 중 예상치 못한 오류 발생"}, None) for _ in images]
+
+    results = []
+    for raw in raw_results:
+        if "error" in raw:
+            results.append(({"average_measurements": {}, "predicted_skin_type": f"피부 분석 오류: {raw['error']}"}, None))
+            continue
+        results.append((
+            {"average_measurements": raw["average_measurements"], "predicted_skin_type": raw["predicted_skin_type"]},
+            raw.get("embedding")
+        ))
+    return results
+
+
+def _personal_color_label(analysis_result_tone) -> str:
+    if isinstance(analysis_result_tone, dict):
+        return analysis_result_tone.get("tone", "N/A")
+    return analysis_result_tone if isinstance(analysis_result_tone, str) else "N/A"
+
+
+def _aggregate_person(skin_analyzer_instance, tones, skin_analysis_list) -> Dict[str, Any]:
+    """
+    여러 장의 결과를 한 사람의 결과로 합칩니다. 측정값은 이상치에 강한 중앙값을 쓰고, 피부 타입은 중앙값으로 다시 분류합니다.
+    퍼스널 컬러는 가장 많이 나온 톤입니다.
+    """
+    measured = [result["average_measurements"] for result in skin_analysis_list if result.get("average_measurements")]
+    labels = [_personal_color_label(tone) for tone in tones]
+    labels = [label for label in labels if label != "N/A"]
+    aggregate: Dict[str, Any] = {
+        "image_count": len(measured),
+        "personal_color_tone": Counter(labels).most_common(1)[0][0] if labels else None,
+        "skin_analysis": {"average_measurements": {}, "predicted_skin_type": "분석 실패"},
+    }
+    if not measured:
+        return aggregate
+
+    columns = list(measured[0].keys())
+    median = np.round(np.median(np.array([[result[col] for col in columns] for result in measured]), axis=0), 2)
+    aggregate["skin_analysis"]["average_measurements"] = {col: float(value) for col, value in zip(columns, median)}
+    try:
+        if list(getattr(skin_analyzer_instance, "SELECTED_MEASUREMENT_COLS", [])) != columns:
+            raise RuntimeError("분류기에 넘길 측정값 열 순서를 확인할 수 없습니다.")
+        aggregate["skin_analysis"]["predicted_skin_type"] = skin_analyzer_instance.classify_measurements(median)[0]
+    except Exception as e:
+        # 분류기를 쓸 수 없으면(모델 서버 등) 이미지별 피부 타입의 최빈값으로 대신합니다.
+        logger.info(f"Median measurements could not be classified directly ({e}); using the most common skin type.")
+        skin_types = [result["predicted_skin_type"] for result in skin_analysis_list if result.get("average_measurements")]
+        aggregate["skin_analysis"]["predicted_skin_type"] = Counter(skin_types).most_common(1)[0][0]
+    return aggregate
+
+
+async def _insert_analysis_rows(rows: List[Dict[str, Any]]) -> List[int]:
+    """
+    여러 분석 행을 한 트랜잭션 안에서 행마다 INSERT하고 analysis_idx 목록을 반환합니다.
+    (다중 행 INSERT의 첫 ID로 나머지를 계산하면 auto_increment_increment > 1인 서버에서 틀리므로 행마다 ID를 받습니다.)
+    """
+    if not rows:
+        return []
+    columns = ["user_id", "analysis_model", "file_path", "skin_tone", "personal_color", "analysis_result", "created_at", "content_hash"]
+    sql_insert = f"INSERT INTO tb_analysis ({', '.join(columns)}) VALUES ({', '.join(f':{column}' for column in columns)})"
+    try:
+        async with database.transaction():
+            analysis_ids = [await database.execute(sql_insert, values={column: row[column] for column in columns}) for row in rows]
+    except Exception as db_error:
+        logger.error(f"Database insert failed: {db_error}", exc_info=True)
+        raise HTTPException(
+            status_code=500,
+            detail="An error occurred while saving analysis results to the database. Please try again."
+        )
+    logger.info(f"Database insert successful for {len(rows)} analysis results.")
+    return analysis_ids
+
+
+async def _analyze_upload_deduplicated(temp_filepath: str, content_type: str, extension: str, content_hash: str, user_id: str,
+                                      skin_analyzer_instance, personal_color_analyzer, storage, skin_embeddings) -> Dict[str, Any]:
+    """
+    같은 내용(content_hash)의 분석이 현재 모델 버전으로 이미 있으면 재사용하고, 없을 때만 업로드 + 분석합니다.
+    객체 키는 내용 주소이므로 같은 바이트는 스토리지에 한 번만 저장됩니다.
+    """
+    # 버전을 아직 모르면(모델 서버의 첫 응답 전) None이고, 이때는 재사용하지 않습니다.
+    model_version = getattr(skin_analyzer_instance, "model_version", None)
+    async with content_locks.hold(dedup_lock_key(content_hash, user_id)):
+        existing = await find_existing_analysis(content_hash, model_version, user_id)
+        if existing is not None:
+            response_content = await record_reused_analysis(existing, user_id, content_hash, skin_embeddings)
+            response_content["derivatives"] = await derivative_urls(storage, response_content["s3_url"])
+            return response_content
+
+        s3_key = content_object_key(content_hash, extension)
+        s3_url = storage.url_for(s3_key)
+        # S3 업로드는 분석과 무관하므로 바로 시작해 두고 분석과 겹쳐서 진행합니다.
+        s3_upload = asyncio.create_task(_put_if_absent(storage, s3_key, temp_filepath, content_type))
+        timed_out: List[str] = []
+        image, derivatives_upload = await _start_derivatives(temp_filepath, storage, s3_key, timed_out)
+        response_content = await _analyze_and_record(
+            temp_filepath, user_id, s3_url, skin_analyzer_instance, personal_color_analyzer, skin_embeddings,
+            s3_upload, content_hash, image, timed_out
+        )
+        response_content["derivatives"] = await _signed_derivatives(storage, derivatives_upload)
+        return response_content
+
+
+async def _start_derivatives(temp_filepath: str, storage, original_key: str, timed_out: List[str]):
+    """
+    원본을 한 번 디코딩해 썸네일/미리보기 저장을 시작합니다. 디코딩한 이미지는 피부 분석도 재사용합니다.
+    반환값: (PIL 이미지, 파생 이미지 저장 작업). 디코딩에 실패하면 (None, None)이고 분석은 파일 경로로 진행합니다.
+    """
+    try:
+        image = await run_thread_stage("decode", _decode_rgb, temp_filepath)
+    except StageTimeout:
+        timed_out.append("decode")
+        return None, None
+    except Exception as e:
+        logger.warning(f"Decoding {temp_filepath} for derivatives failed: {e}")
+        return None, None
+    return image, asyncio.create_task(store_derivatives(storage, original_key, image))
+
+
+async def _signed_derivatives(storage, derivatives_upload) -> Dict[str, str]:
+    """_start_derivatives의 저장 작업이 실제로 저장한 파생 이미지만 서명된 URL로 반환합니다."""
+    if derivatives_upload is None:
+        return {}
+    return await sign_derivatives(storage, await derivatives_upload)
+
+
+async def _put_if_absent(storage, key: str, path: str, content_type: str):
+    # 예전 모델 버전으로 분석했던 같은 이미지는 이미 저장돼 있으므로 다시 올리지 않습니다.
+    if not await storage.exists(key):
+        await storage.put_path(key, path, content_type)
+
+
+async def _analyze_and_record(temp_filepath: str, user_id: str, s3_url: str, skin_analyzer_instance, personal_color_analyzer,
+                              skin_embeddings, s3_upload=None, content_hash: Optional[str] = None, image=None,
+                              timed_out: Optional[List[str]] = None) -> Dict[str, Any]:
+    """
+    임시 파일로 퍼스널 컬러/피부 분석을 동시에 수행하고 tb_analysis에 기록한 뒤 응답 dict를 만듭니다.
+    s3_upload: 진행 중인 스토리지 업로드 작업 (이미 스토리지에 있는 객체를 분석할 때는 None)
+    content_hash: 이미지 SHA-256 (중복 업로드 재사용용으로 함께 기록)
+    image: 파생 이미지를 만들며 이미 디코딩한 PIL 이미지 (피부 분석이 재사용)
+    timed_out: 시간 예산(deadlines.py)을 넘긴 단계 이름을 모으는 목록. 응답의 "timed_out"으로 나갑니다.
+    """
+    timed_out = timed_out if timed_out is not None else []
+    face_cache = await _prepare_face_cache(temp_filepath, skin_analyzer_instance, personal_color_analyzer, timed_out)
+
+    # 1. Personal Color Analysis / 2. Skin Analysis 를 이벤트 루프 밖(스레드)에서 동시에 실행
+    (analysis_result_tone, (skin_analysis_results, skin_embedding)), s3_error = await _gather_analysis_and_upload(
+        run_thread_stage("dominant_color", _run_personal_color_analysis, personal_color_analyzer, temp_filepath, face_cache),
+        run_thread_stage(
+            "skin_inference", _run_skin_analysis, skin_analyzer_instance, temp_filepath, face_cache,
+            skin_embeddings is not None, image
+        ),
+        s3_upload, timed_out
+    )
+
+    # S3 업로드가 실패하면 존재하지 않는 파일을 가리키는 행이 생기지 않도록 DB에 기록하지 않습니다.
+    if s3_error is not None:
+        logger.error(f"S3 upload failed: {s3_error}", exc_info=s3_error)
+        raise HTTPException(
+            status_code=500,
+            detail="An error occurred while uploading the image to S3. Please try again."
+        )
+    if "storage" in timed_out:
+        # 저장이 끝나지 않은 이미지를 가리키는 행은 만들지 않고, 분석 결과만 부분 응답으로 돌려줍니다.
+        return _analysis_response(user_id, None, analysis_result_tone, skin_analysis_results, None, timed_out)
+    if s3_upload is not None:
+        logger.info(f"Image uploaded to S3: {s3_url}")
+
+    return await _record_analysis(
+        user_id, s3_url, skin_analyzer_instance, analysis_result_tone, skin_analysis_results, skin_embedding,
+        skin_embeddings, content_hash, timed_out
+    )
+
+
+async def _prepare_face_cache(temp_filepath: str, skin_analyzer_instance, personal_color_analyzer,
+                              timed_out: List[str]) -> FaceBoxCache:
+    # 퍼스널 컬러 분석에서 찾은 얼굴 좌표를 피부 분석(얼굴 크롭)이 재사용하도록 요청 단위로 보관
+    face_cache = FaceBoxCache()
+    # 두 분석을 동시에 돌리므로, 피부 분석이 얼굴 크롭을 쓰는 경우에는 얼굴 검출만 먼저 한 번 수행해 좌표를 공유합니다.
+    if getattr(skin_analyzer_instance, "face_crop", False) and hasattr(personal_color_analyzer, "detect_face_box"):
+        try:
+            face_cache.store(await run_thread_stage(
+                "face_detection", traced("inference.face_detection")(personal_color_analyzer.detect_face_box), temp_filepath
+            ))
+        except StageTimeout:
+            # 피부 분석은 전체 이미지로 진행합니다. (퍼스널 컬러는 자체 검출을 dominant_color 예산 안에서 다시 시도)
+            timed_out.append("face_detection")
+            face_cache.store(None)
+        except Exception as e:
+            logger.warning(f"Face detection before analysis failed: {e}")
+    return face_cache
+
+
+async def _record_analysis(user_id: str, s3_url: str, skin_analyzer_instance, analysis_result_tone, skin_analysis_results,
+                           skin_embedding, skin_embeddings, content_hash: Optional[str],
+                           timed_out: Optional[List[str]] = None) -> Dict[str, Any]:
+    """분석 결과를 tb_analysis에 기록하고 임베딩을 저장한 뒤 응답 dict를 만듭니다."""
+    timed_out = timed_out if timed_out is not None else []
+    content_hash = _reusable_content_hash(content_hash, analysis_result_tone, skin_analysis_results)
+    # 데이터베이스에 결과 삽입 (모든 결과가 모인 뒤 한 번만)
+    try:
+        sql_insert = """
+        INSERT INTO tb_analysis (user_id, analysis_model, file_path, skin_tone, personal_color, analysis_result, created_at, content_hash)
+        VALUES (:user_id, :analysis_model, :file_path, :skin_tone, :personal_color, :analysis_result, :created_at, :content_hash)
+        """
+        # DB 기록은 취소하지 않습니다. (지연은 database.py의 드라이버 타임아웃으로 제한)
+        analysis_idx = await database.execute(
+            sql_insert,
+            values={
+                "user_id": user_id,
+                # 요청을 처리한 인스턴스의 모델 버전 (hot-swap 이후에는 새 버전이 기록됨)
+                "analysis_model": getattr(skin_analyzer_instance, "model_version", None) or "SkinAnalyzer",
+                "file_path": s3_url,
+                "skin_tone": skin_analysis_results.get("predicted_skin_type", "Unknown"),
+                "personal_color": _personal_color_label(analysis_result_tone),
+                # JSON 직렬화
+                "analysis_result": json.dumps(skin_analysis_results),
+                "created_at": datetime.now(),
+                "content_hash": content_hash,
+            }
+        )
+        logger.info("Database insert successful for analysis results.")
+    except Exception as db_error:
+        logger.error(f"Database insert failed: {db_error}", exc_info=True)
+        raise HTTPException(
+            status_code=500,
+            detail="An error occurred while saving analysis results to the database. Please try again."
+        )
+
+    # "비슷한 피부" 검색용 임베딩 저장 (실패해도 분석 결과 응답에는 영향 없음)
+    if skin_embeddings is not None and skin_embedding is not None and analysis_idx:
+        try:
+            await asyncio.to_thread(skin_embeddings.add, analysis_idx, skin_embedding)
+        except Exception as e:
+            logger.error(f"피부 임베딩 저장 실패 (analysis_idx={analysis_idx}): {e}", exc_info=True)
+
+    return _analysis_response(user_id, s3_url, analysis_result_tone, skin_analysis_results, analysis_idx, timed_out)
+
+
+def _reusable_content_hash(content_hash: Optional[str], analysis_result_tone, skin_analysis_results) -> Optional[str]:
+    """
+    두 분석이 모두 성공한 경우에만 content_hash를 기록합니다.
+    실패/시간 초과 결과에 해시를 남기면 같은 이미지의 이후 업로드가 그 실패를 계속 재사용(dedup)하게 됩니다.
+    """
+    if _personal_color_label(analysis_result_tone) == "N/A":
+        return None
+    if not skin_analysis_results.get("average_measurements") or skin_analysis_results.get("timed_out"):
+        return None
+    return content_hash
+
+
+def _analysis_response(user_id: str, s3_url: Optional[str], analysis_result_tone, skin_analysis_results,
+                       analysis_idx: Optional[int], timed_out: List[str]) -> Dict[str, Any]:
+    current_analysis_time = datetime.now() # 응답에 포함될 생성 시간
+    response_content = {
+        "success": True,
+        "message": "Image uploaded and analyzed successfully." if not timed_out
+                   else f"Partial results: stages timed out ({', '.join(timed_out)}).",
+        "s3_url": s3_url,
+        "created_at": current_analysis_time.isoformat(), # ISO 형식으로 변환
+        "personal_color_tone": analysis_result_tone,
+        "skin_analysis": skin_analysis_results,
+        "user_id": user_id,
+        "analysis_idx": analysis_idx,
+        "timed_out": timed_out,
+    }
+    return response_content
+
+
+def _skin_timed_out_result():
+    return {"average_measurements": {}, "predicted_skin_type": "분석 시간 초과", **timed_out_marker("skin_inference")}, None
+
+
+async def _within_budget(stage_call, timed_out: List[str], fallback=None):
+    """
+    run_stage / run_thread_stage 호출이 예산 안에 끝나면 결과를,
+    넘기면 timed_out에 단계를 기록하고 fallback을 반환합니다.
+    """
+    try:
+        return await stage_call
+    except StageTimeout as e:
+        timed_out.append(e.stage)
+        return fallback
+
+
+async def _gather_analysis_and_upload(personal_color_job, skin_job, s3_upload, timed_out: List[str]):
+    """
+    두 분석과 S3 업로드를 함께 기다립니다. 분석 함수는 예외를 스스로 처리하므로 결과만,
+    S3 업로드는 (None 또는 발생한 예외)를 돌려줍니다.
+    각 단계는 시간 예산 안에서만 기다리고, 넘긴 단계는 timed_out 표시 결과로 대신합니다.
+    """
+    analysis_results = await asyncio.gather(
+        _within_budget(personal_color_job, timed_out, timed_out_marker("dominant_color")),
+        _within_budget(skin_job, timed_out, _skin_timed_out_result()),
+    )
+    try:
+        if s3_upload is not None:
+            await _within_budget(run_stage("storage", s3_upload), timed_out)
+        s3_error = None
+    except Exception as e:
+        s3_error = e
+    return analysis_results, s3_error
+
+
+@traced("inference.personal_color")
+def _run_personal_color_analysis(personal_color_analyzer, image_path: str, face_cache):
+    try:
+        analysis_result_tone = personal_color_analyzer.analysis(image_path, face_cache)
+        logger.info(f"Personal color analysis completed. Result: {analysis_result_tone}")
+        return analysis_result_tone
+    except Exception as e:
+        logging.error(f"Personal color analysis failed: {e}", exc_info=True)
+        return {"error": "Personal color analysis failed"}
+
+
+@traced("inference.skin")
+def _run_skin_analysis(skin_analyzer_instance, image_path: str, face_cache, return_embedding: bool, image=None):
+    """
+    (응답/DB에 쓸 피부 분석 결과, 임베딩 또는 None)을 반환합니다.
+    image: 이미 디코딩한 RGB PIL 이미지가 있으면 파일을 다시 읽지 않고 사용합니다. (로컬 분석기만)
+    """
+    skin_analysis_results = {"average_measurements": {}, "predicted_skin_type": "분석 실패"}
+    skin_embedding = None
+    try:
+        if image is not None and hasattr(skin_analyzer_instance, "analyze_skin_from_image"):
+            skin_analysis_raw_results = skin_analyzer_instance.analyze_skin_from_image(
+                image, os.path.basename(image_path), face_cache, return_embedding=return_embedding
+            )
+        else:
+            skin_analysis_raw_results = skin_analyzer_instance.analyze_skin_from_local_path(
+                image_path, face_cache, return_embedding=return_embedding
+            )
+        # 임베딩(ndarray)은 JSON으로 응답/저장하지 않으므로 결과에서 분리합니다.
+        skin_embedding = skin_analysis_raw_results.pop("embedding", None)
+
+        if "error" in skin_analysis_raw_results:
+            logger.error(f"로컬 이미지 피부 분석 중 오류 발생: {skin_analysis_raw_results['error']}")
+            skin_analysis_results["predicted_skin_type"] = f"피부 분석 오류: {skin_analysis_raw_results['error']}"
+        else:
+            skin_analysis_results["average_measurements"] = skin_analysis_raw_results.get("average_measurements", {})
+            skin_analysis_results["predicted_skin_type"] = skin_analysis_raw_results.get("predicted_skin_type", "분석 성공")
+        logger.info(f"Skin analysis completed. Predicted Skin Type: {skin_analysis_results['predicted_skin_type']}.")
+
+    except (ValueError, RuntimeError) as e:
+        logger.error(f"Skin analysis using local file failed for {image_path}: {e}", exc_info=True)
+        skin_analysis_results["predicted_skin_type"] = f"피부 분석 실패: {str(e)}"
+    except Exception as e:
+        logger.error(f"Unexpected error during skin analysis for {image_path}: {e}", exc_info=True)
+        skin_analysis_results["predicted_skin_type"] = "피부 분석 중 예상치 못한 오류 발생"
+    return skin_analysis_results, skin_embedding
 
 # 이미지 업로드 API 엔드포인트 정의 (기존 코드 유지)
 @router.post("/upload/image_base64", response_model=ImageUploadResponse)
-async def upload_image(file: Annotated[UploadFile, File()]):
+async def upload_image(file: Annotated[UploadFile, File()], storage = Depends(use_storage)):
+    upload = None
     try:
-        # UploadFile 객체에서 이미지 파일 내용 읽기 (비동기 방식)
-        contents = await file.read()
+        # UploadFile을 청크 단위로 임시 파일에 받기 (형식/크기 검사 포함)
+        upload = await spool_upload(file)
         # 업로드된 파일의 원래 이름 가져오기
         file_name = file.filename
         # S3에 저장될 객체 키 생성 (images/ 폴더 아래 원래 파일 이름으로 저장)
         s3_key = f"images/{file_name}"
 
-        # Boto3 클라이언트를 사용하여 S3에 객체(이미지) 업로드
-        s3_client.put_object(
-            Bucket=S3_BUCKET_NAME,  # 대상 S3 버킷 이름
-            Key=s3_key,             # S3에 저장될 객체 키
-            Body=contents           # 업로드할 이미지 파일 내용 (bytes)
-        )
-
-        # 업로드 성공 시 S3 이미지 URL 생성
-        s3_url = f"https://{S3_BUCKET_NAME}.s3.amazonaws.com/{s3_key}"
+        # 스토리지에 객체(이미지) 업로드. 큰 파일은 멀티파트로 올라가며, 성공 시 이미지 URL을 돌려받습니다.
+        s3_url = await storage.put_path(s3_key, upload.path, upload.content_type)
 
         # 성공 응답 반환
         current_upload_time = datetime.now()
@@ -238,33 +857,195 @@ async def upload_image(file: Annotated[UploadFile, File()]):
         # user_id, personal_color_tone, skin_analysis 등은 이 엔드포인트에서 제공하지 않으므로 제거
     })
     
+    except HTTPException:
+        raise
     except Exception as e:
         # 오류 발생 시 로깅
         logging.error(f"S3 이미지 업로드 오류: {e}")
         # HTTP 예외 발생 (500 Internal Server Error)
         raise HTTPException(status_code=500, detail="이미지 업로드 실패")
+    finally:
+        if upload is not None:
+            upload.cleanup()
 
 
 @router.post("/get/presigned-url", response_model=PresignedUrlResponse)
-async def get_presigned_url(request_data: PresignedUrlRequest):
+async def get_presigned_url(request_data: PresignedUrlRequest, storage = Depends(use_storage)):
     try:
-        presigned_url = s3_client.generate_presigned_url(
-            'get_object',
-            Params={'Bucket': S3_BUCKET_NAME, 'Key': request_data.object_key},
-            ExpiresIn=3600  # URL 유효 시간 (초) - 필요에 따라 조정
+        presigned_url = await storage.presigned_get_url(
+            request_data.object_key,
+            expires_in=3600  # URL 유효 시간 (초) - 필요에 따라 조정
         )
         return {"success": True, "message": "서명된 URL 생성 성공", "presigned_url": presigned_url}
     except Exception as e:
         logging.error(f"서명된 URL 생성 오류: {e}")
         raise HTTPException(status_code=500, detail="서명된 URL 생성 실패")
     
+# 여러 객체 키를 한 번에 서명 (이력 화면에서 이미지 수만큼 요청하지 않도록)
+# 같은 키는 만료 직전까지 캐시된 URL을 돌려줍니다. (storage.PresignedUrlCache)
+@router.post("/get/presigned-urls", response_model=PresignedUrlBatchResponse)
+async def get_presigned_urls(request_data: PresignedUrlBatchRequest, storage = Depends(use_storage)):
+    try:
+        presigned_urls = await storage.presigned_get_urls(request_data.object_keys, expires_in=request_data.expires_in)
+        return {"success": True, "message": "서명된 URL 생성 성공", "presigned_urls": presigned_urls}
+    except Exception as e:
+        logging.error(f"서명된 URL 일괄 생성 오류: {e}")
+        raise HTTPException(status_code=500, detail="서명된 URL 생성 실패")
+
+
+# --- 직접 업로드 흐름 ---
+# 1) /direct-upload/presign 으로 새 객체 키와 서명된 업로드 URL을 받고
+# 2) 클라이언트가 이미지를 스토리지에 직접 올린 뒤 (API 서버는 바이트를 중계하지 않음)
+# 3) /analyze-object 로 객체 키를 보내면 서버가 스토리지에서 받아 분석하고 tb_analysis에 기록합니다.
+DIRECT_UPLOAD_EXPIRES_IN = 900
+
+
+def _direct_upload_prefix(user_id: str) -> str:
+    return f"uploads/{user_id}/"
+
+
+@router.post("/direct-upload/presign", response_model=DirectUploadResponse)
+async def presign_direct_upload(request_data: DirectUploadRequest, storage = Depends(use_storage)):
+    extension = ALLOWED_IMAGE_TYPES.get(request_data.content_type)
+    if extension is None:
+        raise HTTPException(status_code=415, detail="지원하지 않는 파일 형식입니다. JPEG, PNG, WEBP, BMP 이미지만 업로드할 수 있습니다.")
+    if not request_data.user_id or "/" in request_data.user_id:
+        raise HTTPException(status_code=400, detail="잘못된 사용자 ID입니다.")
+
+    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+    object_key = f"{_direct_upload_prefix(request_data.user_id)}{timestamp}_{uuid.uuid4().hex}{extension}"
+    try:
+        upload = await storage.presigned_upload(
+            object_key, request_data.content_type, MAX_UPLOAD_BYTES,
+            expires_in=DIRECT_UPLOAD_EXPIRES_IN, method=request_data.method
+        )
+    except Exception as e:
+        logging.error(f"직접 업로드 URL 생성 오류: {e}")
+        raise HTTPException(status_code=500, detail="업로드 URL 생성 실패")
+    return {
+        "success": True, "message": "업로드 URL 생성 성공", "object_key": object_key,
+        "method": upload["method"], "upload_url": upload["url"], "fields": upload["fields"], "headers": upload["headers"],
+        "max_bytes": MAX_UPLOAD_BYTES, "expires_in": DIRECT_UPLOAD_EXPIRES_IN,
+    }
+
+
+@router.put("/direct-upload/local/{object_key:path}")
+async def receive_local_direct_upload(
+    object_key: str,
+    request: Request,
+    expires: int = Query(...),
+    max_bytes: int = Query(...),
+    signature: str = Query(...),
+    storage = Depends(use_storage)
+):
+    """로컬 스토리지 백엔드에서 S3 presigned PUT 역할을 대신하는 수신 엔드포인트입니다."""
+    if not isinstance(storage, LocalStorage):
+        raise HTTPException(status_code=404, detail="Not Found")
+    content_type = request.headers.get("content-type", "")
+    if not storage.verify_upload_signature(object_key, content_type, max_bytes, expires, signature):
+        raise HTTPException(status_code=403, detail="업로드 서명이 올바르지 않거나 만료되었습니다.")
+
+    upload = None
+    try:
+        upload = await spool_stream(request.stream(), max_bytes)
+        if upload.content_type != content_type:
+            raise HTTPException(status_code=415, detail="Content-Type과 실제 파일 형식이 다릅니다.")
+        await storage.put_path(object_key, upload.path, upload.content_type)
+    finally:
+        if upload is not None:
+            upload.cleanup()
+    return {"success": True, "message": "업로드 성공", "object_key": object_key}
+
+
+@local_files_router.get("/{object_key:path}")
+async def serve_local_file(
+    object_key: str,
+    expires: int = Query(...),
+    signature: str = Query(...),
+    storage = Depends(use_storage)
+):
+    """로컬 스토리지 백엔드에서 S3 presigned GET 역할을 대신합니다. 서명이 맞고 만료 전인 요청만 파일을 내려줍니다."""
+    if not isinstance(storage, LocalStorage):
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not storage.verify_download_signature(object_key, expires, signature):
+        raise HTTPException(status_code=403, detail="다운로드 서명이 올바르지 않거나 만료되었습니다.")
+    try:
+        path = storage.local_path(object_key)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not await asyncio.to_thread(os.path.isfile, path):
+        raise HTTPException(status_code=404, detail="Not Found")
+    return FileResponse(path)
+
+
+@router.post("/analyze-object", dependencies=[Depends(admit_analysis)])
+async def analyze_object(
+    request_data: AnalyzeObjectRequest,
+    skin_analyzer_instance: SkinAnalyzer = Depends(use_skin_analyzer),
+    personal_color_analyzer = Depends(use_personal_color_analyzer),
+    storage = Depends(use_storage),
+    skin_embeddings = Depends(use_skin_embeddings)
+):
+    """직접 업로드로 스토리지에 올라간 객체를 받아 분석하고 tb_analysis에 기록합니다."""
+    object_key = request_data.object_key
+    # 다른 사용자의 객체나 임의의 키를 분석/기록하지 못하도록 presign에서 발급한 경로만 허용합니다.
+    if not object_key.startswith(_direct_upload_prefix(request_data.user_id)) or ".." in object_key:
+        raise HTTPException(status_code=403, detail="분석할 수 없는 객체 키입니다.")
+
+    temp_file = tempfile.NamedTemporaryFile(delete=False)
+    temp_file.close()
+    temp_filepath = temp_file.name
+    try:
+        try:
+            await storage.download_to_path(object_key, temp_filepath, MAX_UPLOAD_BYTES)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="업로드된 이미지를 찾을 수 없습니다. 업로드가 끝났는지 확인해 주세요.")
+        except ValueError:
+            raise HTTPException(status_code=413, detail=f"업로드 파일은 {MAX_UPLOAD_BYTES // (1024 * 1024)}MB를 넘을 수 없습니다.")
+        # 클라이언트가 올린 파일은 서버를 거치지 않았으므로 여기서 형식을 검사합니다.
+        with open(temp_filepath, "rb") as downloaded:
+            if sniff_image_type(downloaded.read(16)) is None:
+                raise HTTPException(status_code=415, detail="지원하지 않는 파일 형식입니다. JPEG, PNG, WEBP, BMP 이미지만 업로드할 수 있습니다.")
+
+        # 직접 업로드는 클라이언트가 키를 받은 뒤 올리므로 객체 키는 그대로 두고, 분석 결과만 내용 해시로 재사용합니다.
+        content_hash = await asyncio.to_thread(file_sha256, temp_filepath)
+        object_url = storage.url_for(object_key)
+        # 버전을 아직 모르면(모델 서버의 첫 응답 전) None이고, 이때는 재사용하지 않습니다.
+        model_version = getattr(skin_analyzer_instance, "model_version", None)
+        async with content_locks.hold(dedup_lock_key(content_hash, request_data.user_id)):
+            existing = await find_existing_analysis(content_hash, model_version, request_data.user_id)
+            if existing is not None:
+                response_content = await record_reused_analysis(existing, request_data.user_id, content_hash, skin_embeddings)
+                response_content["derivatives"] = await derivative_urls(storage, response_content["s3_url"])
+                # 재사용한 행은 기존 객체를 가리키므로 방금 올라온 중복 객체는 지웁니다.
+                if existing["file_path"] != object_url:
+                    await storage.delete(object_key)
+            else:
+                timed_out: List[str] = []
+                image, derivatives_upload = await _start_derivatives(temp_filepath, storage, object_key, timed_out)
+                response_content = await _analyze_and_record(
+                    temp_filepath, request_data.user_id, object_url,
+                    skin_analyzer_instance, personal_color_analyzer, skin_embeddings, content_hash=content_hash, image=image,
+                    timed_out=timed_out
+                )
+                response_content["derivatives"] = await _signed_derivatives(storage, derivatives_upload)
+        return JSONResponse(content=response_content)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error during analyze-object ({object_key}): {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail="Error occurred during analyze process.")
+    finally:
+        if os.path.exists(temp_filepath):
+            os.unlink(temp_filepath)
+
+
 @router.post("/analysis-history", response_model=PresignedUrlResponse)
-async def get_analysis_history(request_data: PresignedUrlRequest):
+async def get_analysis_history(request_data: PresignedUrlRequest, storage = Depends(use_storage)):
     try:
-        presigned_url = s3_client.generate_presigned_url(
-            'get_object',
-            Params={'Bucket': S3_BUCKET_NAME, 'Key': request_data.object_key},
-            ExpiresIn=3600  # URL 유효 시간 (초) - 필요에 따라 조정
+        presigned_url = await storage.presigned_get_url(
+            request_data.object_key,
+            expires_in=3600  # URL 유효 시간 (초) - 필요에 따라 조정
         )
         return {"success": True, "message": "서명된 URL 생성 성공", "presigned_url": presigned_url}
     except Exception as e:
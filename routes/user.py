@@ -1,8 +1,10 @@
 import logging
 import argon2
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Depends, HTTPException
 #from routes.user import router as user_router  # routes 폴더에서 user.py의 router 가져오기
 from database import database  # database.py에서 인스턴스를 가져오기
+from derivatives import derivative_urls_many
+from model_registry import use_storage
 from sqlalchemy import text
 from argon2 import PasswordHasher
 from argon2 import exceptions
@@ -160,7 +162,7 @@ async def checkpw(check_data: CheckIDRequest):
 
 
 @router.post("/get/past-analysis", response_model=PastAnalysisResponse)
-async def get_past_analysis(request_data: PastAnalysisRequest):
+async def get_past_analysis(request_data: PastAnalysisRequest, storage = Depends(use_storage)):
     user_id = request_data.user_id
 
     check_sql = """
@@ -176,6 +178,10 @@ async def get_past_analysis(request_data: PastAnalysisRequest):
 
         # JSON serializable 형태로 변환
         results_list = [dict(row) for row in results]
+        # 목록 화면은 원본 대신 썸네일/미리보기를 쓰도록 저장된 파생 이미지의 서명된 URL을 함께 내려줍니다.
+        derivatives = await derivative_urls_many(storage, [row.get("file_path") for row in results_list])
+        for row, row_derivatives in zip(results_list, derivatives):
+            row["derivatives"] = row_derivatives
 
         return PastAnalysisResponse(
             success=True,
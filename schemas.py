@@ -117,6 +117,40 @@ class PresignedUrlResponse(BaseModel):
     message: str
     presigned_url: str = None
 
+# 여러 객체의 서명된 URL 한 번에 요청 (이력 화면 등)
+class PresignedUrlBatchRequest(BaseModel):
+    object_keys: List[str] = Field(..., max_length=200)
+    expires_in: int = Field(3600, ge=60, le=7 * 24 * 3600)
+
+# 여러 객체의 서명된 URL 응답 모델 (객체 키 -> URL)
+class PresignedUrlBatchResponse(BaseModel):
+    success: bool
+    message: str
+    presigned_urls: dict = None
+
+# 직접 업로드(presigned PUT/POST) 요청 모델
+class DirectUploadRequest(BaseModel):
+    user_id: str
+    content_type: str # image/jpeg, image/png, image/webp, image/bmp
+    method: Literal["POST", "PUT"] = "POST" # POST는 S3 정책으로 크기 상한까지 검사합니다.
+
+# 직접 업로드 응답 모델: 클라이언트는 method/upload_url로 파일을 올린 뒤 object_key로 분석을 요청합니다.
+class DirectUploadResponse(BaseModel):
+    success: bool
+    message: str
+    object_key: str = None
+    method: str = None
+    upload_url: str = None
+    fields: Optional[dict] = None # POST 폼에 함께 보낼 필드
+    headers: Optional[dict] = None # PUT 요청에 붙일 헤더
+    max_bytes: int = None
+    expires_in: int = None
+
+# 스토리지에 이미 올라간 객체 분석 요청 모델
+class AnalyzeObjectRequest(BaseModel):
+    user_id: str
+    object_key: str
+
 # 이미지 업로드 API 요청 모델 
 class ImageUploadRequest(BaseModel):
     user_id: str
@@ -0,0 +1,431 @@
+# storage.py
+# 업로드 이미지를 저장하는 객체 스토리지 계층입니다.
+#
+# - 라우터는 async 메서드(put/get/presigned_get_url 등)만 사용하고, 동기 boto3 호출은 전용 스레드 풀에서 실행하여
+#   이벤트 루프를 막지 않습니다.
+# - S3Storage: 워커당 클라이언트 하나를 만들고 연결 풀 크기/타임아웃/재시도와 멀티파트 임계값을 조정합니다.
+# - LocalStorage: 로컬 디스크에 저장합니다. 오프라인 부하 테스트나 단일 서버 배포에서 사용합니다.
+#
+# 환경 변수:
+#   STORAGE_BACKEND=s3|local (기본 s3)
+#   S3_BUCKET_NAME, AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_REGION       (s3)
+#   STORAGE_MAX_CONNECTIONS, STORAGE_MULTIPART_THRESHOLD_MB, STORAGE_MULTIPART_CHUNK_MB (s3)
+#   LOCAL_STORAGE_DIR, LOCAL_STORAGE_BASE_URL, LOCAL_STORAGE_SECRET             (local)
+#   PRESIGN_CACHE_SIZE, PRESIGN_CACHE_REFRESH_MARGIN                           (서명된 URL 캐시)
+import asyncio
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import time
+import shutil
+import tempfile
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
+from urllib.parse import urlencode
+from urllib.parse import urlparse
+
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+PRESIGN_CACHE_SIZE = int(os.environ.get("PRESIGN_CACHE_SIZE", "10000"))
+PRESIGN_CACHE_REFRESH_MARGIN = float(os.environ.get("PRESIGN_CACHE_REFRESH_MARGIN", "300"))
+
+
+class PresignedUrlCache:
+    """
+    (객체 키, 유효 시간)별로 서명된 URL을 만료 직전까지 재사용하는 LRU 캐시입니다.
+    같은 이력 화면을 다시 열어도 서명을 새로 만들지 않고, URL이 그대로이므로 클라이언트의 이미지 캐시도 맞습니다.
+    이벤트 루프에서만 접근하므로 잠금은 두지 않습니다.
+    """
+    def __init__(self, max_entries: int = PRESIGN_CACHE_SIZE, refresh_margin: float = PRESIGN_CACHE_REFRESH_MARGIN):
+        self.max_entries = max_entries
+        self.refresh_margin = refresh_margin
+        self._entries: "OrderedDict[Tuple[str, int], Tuple[str, float]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str, expires_in: int) -> Optional[str]:
+        entry = self._entries.get((key, expires_in))
+        if entry is not None:
+            url, expires_at = entry
+            # 남은 유효 시간이 짧으면 새로 서명합니다. (유효 시간이 짧은 URL은 절반이 지나면 갱신)
+            if expires_at - time.time() > min(self.refresh_margin, expires_in / 2):
+                self._entries.move_to_end((key, expires_in))
+                self.hits += 1
+                return url
+            del self._entries[(key, expires_in)]
+        self.misses += 1
+        return None
+
+    def put(self, key: str, expires_in: int, url: str, signed_at: float):
+        if self.max_entries <= 0:
+            return
+        self._entries[(key, expires_in)] = (url, signed_at + expires_in)
+        self._entries.move_to_end((key, expires_in))
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"entries": len(self._entries), "max_entries": self.max_entries, "hits": self.hits, "misses": self.misses}
+
+
+class ObjectStorage(ABC):
+    """스토리지 백엔드 공통 인터페이스. 동기 구현(_put 등)을 전용 스레드 풀에서 실행합니다."""
+    def __init__(self, max_concurrency: int = 16):
+        self.max_concurrency = max_concurrency
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="storage")
+        # 스레드 풀이 가득 찼을 때 요청이 풀 안에서 무한정 쌓이지 않도록 동시 요청 수를 제한합니다.
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.presign_cache = PresignedUrlCache()
+
+    async def _run(self, func, *args):
+        # 구간 이름은 동기 구현 이름에서 정합니다. (_put_path -> storage.put_path, 풀 대기 시간 포함)
+        with span(f"storage.{func.__name__.lstrip('_')}"):
+            async with self._semaphore:
+                return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    # --- 공개 async API ---
+    async def put(self, key: str, data: bytes, content_type: Optional[str] = None) -> str:
+        """바이트를 저장하고 객체 URL을 반환합니다."""
+        await self._run(self._put, key, data, content_type)
+        return self.url_for(key)
+
+    async def put_file(self, key: str, fileobj: BinaryIO, content_type: Optional[str] = None) -> str:
+        """파일 객체를 스트리밍으로 저장합니다. (큰 파일은 S3에서 멀티파트 업로드)"""
+        await self._run(self._put_file, key, fileobj, content_type)
+        return self.url_for(key)
+
+    async def put_path(self, key: str, path: str, content_type: Optional[str] = None) -> str:
+        """로컬 파일을 열어 put_file과 같은 방식(청크/멀티파트)으로 저장합니다."""
+        await self._run(self._put_path, key, path, content_type)
+        return self.url_for(key)
+
+    async def get(self, key: str) -> bytes:
+        return await self._run(self._get, key)
+
+    async def delete(self, key: str):
+        await self._run(self._delete, key)
+
+    async def exists(self, key: str) -> bool:
+        return await self._run(self._exists, key)
+
+    async def presigned_get_url(self, key: str, expires_in: int = 3600) -> str:
+        return (await self.presigned_get_urls([key], expires_in))[key]
+
+    async def presigned_get_urls(self, keys: List[str], expires_in: int = 3600) -> Dict[str, str]:
+        """
+        여러 키를 한 번에 서명합니다. 캐시에 유효한 URL이 있으면 재사용하고,
+        나머지는 스레드 풀을 한 번만 거쳐 함께 서명합니다. (S3 서명은 네트워크 없이 로컬에서 계산됨)
+        """
+        urls: Dict[str, str] = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            cached = self.presign_cache.get(key, expires_in)
+            if cached is not None:
+                urls[key] = cached
+            else:
+                missing.append(key)
+        if missing:
+            signed_at = time.time()
+            signed = await self._run(self._presigned_get_urls, missing, expires_in)
+            for key, url in zip(missing, signed):
+                self.presign_cache.put(key, expires_in, url, signed_at)
+                urls[key] = url
+        return urls
+
+    async def presigned_upload(self, key: str, content_type: str, max_bytes: int, expires_in: int = 900,
+                               method: str = "POST") -> Dict[str, Any]:
+        """
+        클라이언트가 API 서버를 거치지 않고 스토리지에 직접 올릴 수 있는 서명된 업로드 정보를 만듭니다.
+        반환값: {"method", "url", "fields"(POST 폼 필드), "headers"(PUT 요청 헤더)}
+        """
+        return await self._run(self._presigned_upload, key, content_type, max_bytes, expires_in, method.upper())
+
+    async def download_to_path(self, key: str, path: str, max_bytes: Optional[int] = None) -> int:
+        """
+        객체를 로컬 파일로 받습니다. 객체가 없으면 FileNotFoundError, max_bytes를 넘으면 ValueError.
+        반환값은 받은 바이트 수입니다.
+        """
+        return await self._run(self._download_to_path, key, path, max_bytes)
+
+    @abstractmethod
+    def url_for(self, key: str) -> str:
+        ...
+
+    def key_from_url(self, url: str) -> str:
+        """tb_analysis.file_path 등에 저장된 URL에서 객체 키를 꺼냅니다."""
+        return urlparse(url).path.lstrip("/")
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    def _presigned_get_urls(self, keys: List[str], expires_in: int) -> List[str]:
+        return [self._presigned_get_url(key, expires_in) for key in keys]
+
+    def _put_path(self, key: str, path: str, content_type: Optional[str]):
+        with open(path, "rb") as fileobj:
+            self._put_file(key, fileobj, content_type)
+
+    # --- 백엔드별 동기 구현 ---
+    @abstractmethod
+    def _put(self, key: str, data: bytes, content_type: Optional[str]):
+        ...
+
+    @abstractmethod
+    def _put_file(self, key: str, fileobj: BinaryIO, content_type: Optional[str]):
+        ...
+
+    @abstractmethod
+    def _get(self, key: str) -> bytes:
+        ...
+
+    @abstractmethod
+    def _delete(self, key: str):
+        ...
+
+    @abstractmethod
+    def _exists(self, key: str) -> bool:
+        ...
+
+    @abstractmethod
+    def _presigned_get_url(self, key: str, expires_in: int) -> str:
+        ...
+
+    @abstractmethod
+    def _presigned_upload(self, key: str, content_type: str, max_bytes: int, expires_in: int, method: str) -> Dict[str, Any]:
+        ...
+
+    @abstractmethod
+    def _download_to_path(self, key: str, path: str, max_bytes: Optional[int]) -> int:
+        ...
+
+
+class S3Storage(ObjectStorage):
+    def __init__(self, bucket: str, region: Optional[str] = None, max_concurrency: int = 16,
+                 multipart_threshold: int = 8 * 1024 * 1024, multipart_chunksize: int = 8 * 1024 * 1024,
+                 connect_timeout: float = 5.0, read_timeout: float = 30.0):
+        super().__init__(max_concurrency)
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+        from botocore.config import Config
+
+        self.bucket = bucket
+        self.client = boto3.client(
+            's3',
+            aws_access_key_id=os.environ.get("AWS_ACCESS_KEY_ID"),
+            aws_secret_access_key=os.environ.get("AWS_SECRET_ACCESS_KEY"),
+            region_name=region,
+            config=Config(
+                # 스레드 풀 크기만큼 연결을 재사용할 수 있게 합니다 (boto3 기본값은 10).
+                max_pool_connections=max_concurrency,
+                connect_timeout=connect_timeout,
+                read_timeout=read_timeout,
+                retries={"max_attempts": 3, "mode": "adaptive"},
+            )
+        )
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_chunksize,
+            max_concurrency=max(1, max_concurrency // 4), # 멀티파트 한 건이 풀 전체를 차지하지 않도록
+            use_threads=True,
+        )
+
+    def url_for(self, key: str) -> str:
+        return f"https://{self.bucket}.s3.amazonaws.com/{key}"
+
+    def _put(self, key, data, content_type):
+        extra = {"ContentType": content_type} if content_type else {}
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data, **extra)
+
+    def _put_file(self, key, fileobj, content_type):
+        extra = {"ContentType": content_type} if content_type else None
+        self.client.upload_fileobj(fileobj, self.bucket, key, ExtraArgs=extra, Config=self.transfer_config)
+
+    def _get(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+
+    def _delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def _exists(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+    def _presigned_get_url(self, key, expires_in):
+        return self.client.generate_presigned_url('get_object', Params={'Bucket': self.bucket, 'Key': key}, ExpiresIn=expires_in)
+
+    def _presigned_upload(self, key, content_type, max_bytes, expires_in, method):
+        if method == "PUT":
+            url = self.client.generate_presigned_url(
+                'put_object', Params={'Bucket': self.bucket, 'Key': key, 'ContentType': content_type},
+                ExpiresIn=expires_in, HttpMethod="PUT"
+            )
+            return {"method": "PUT", "url": url, "fields": None, "headers": {"Content-Type": content_type}}
+        # POST 정책에는 크기 상한을 넣을 수 있어, 너무 큰 파일은 S3가 직접 거절합니다.
+        post = self.client.generate_presigned_post(
+            Bucket=self.bucket, Key=key,
+            Fields={"Content-Type": content_type},
+            Conditions=[{"Content-Type": content_type}, ["content-length-range", 1, max_bytes]],
+            ExpiresIn=expires_in
+        )
+        return {"method": "POST", "url": post["url"], "fields": post["fields"], "headers": None}
+
+    def _download_to_path(self, key, path, max_bytes):
+        from botocore.exceptions import ClientError
+        try:
+            size = self.client.head_object(Bucket=self.bucket, Key=key)["ContentLength"]
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                raise FileNotFoundError(key)
+            raise
+        if max_bytes is not None and size > max_bytes:
+            raise ValueError(f"객체 크기({size} bytes)가 상한({max_bytes} bytes)을 넘습니다.")
+        self.client.download_file(self.bucket, key, path, Config=self.transfer_config)
+        return size
+
+
+class LocalStorage(ObjectStorage):
+    """
+    <root>/<key> 경로에 저장합니다. URL은 <base_url>/<key> 이며, main.py가 base_url 경로에 등록한 라우트가
+    서명(presigned_get_url로 발급, 만료 시각 포함)을 확인한 뒤 파일을 내려줍니다. S3처럼 서명 없는 URL로는 읽을 수 없습니다.
+    """
+    def __init__(self, root: str, base_url: str = "/files", max_concurrency: int = 16,
+                 upload_url: str = "/images/direct-upload/local", secret: Optional[str] = None):
+        super().__init__(max_concurrency)
+        self.root = os.path.abspath(root)
+        self.base_url = base_url.rstrip("/")
+        # 직접 업로드(presigned_upload)용 API 경로와 서명 키.
+        # 키를 지정하지 않으면 프로세스마다 달라지므로 워커가 여러 개면 LOCAL_STORAGE_SECRET을 설정해야 합니다.
+        self.upload_url = upload_url.rstrip("/")
+        self._secret = (secret or secrets.token_hex(32)).encode()
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        path = os.path.abspath(os.path.join(self.root, key))
+        # "../" 등으로 루트 밖을 가리키는 키는 거부합니다.
+        if os.path.commonpath([self.root, path]) != self.root:
+            raise ValueError(f"잘못된 객체 키입니다: {key}")
+        return path
+
+    def url_for(self, key: str) -> str:
+        return f"{self.base_url}/{key}"
+
+    def key_from_url(self, url: str) -> str:
+        if url.startswith(self.base_url + "/"):
+            return url[len(self.base_url) + 1:]
+        # S3 URL이 저장된 행을 로컬 미러에서 읽는 경우
+        return super().key_from_url(url)
+
+    def _write_atomic(self, key: str, write):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 같은 디렉터리의 임시 파일에 쓰고 rename 하여, 읽는 쪽이 쓰다 만 파일을 보지 않게 합니다.
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".upload-")
+        try:
+            with os.fdopen(fd, "wb") as out:
+                write(out)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+
+    def _put(self, key, data, content_type):
+        self._write_atomic(key, lambda out: out.write(data))
+
+    def _put_file(self, key, fileobj, content_type):
+        self._write_atomic(key, lambda out: shutil.copyfileobj(fileobj, out, 1024 * 1024))
+
+    def _get(self, key):
+        with open(self._path(key), "rb") as stored:
+            return stored.read()
+
+    def _delete(self, key):
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _exists(self, key):
+        return os.path.exists(self._path(key))
+
+    def local_path(self, key: str) -> str:
+        return self._path(key)
+
+    def _download_signature(self, key: str, expires: int) -> str:
+        message = f"GET\n{key}\n{expires}".encode()
+        return hmac.new(self._secret, message, hashlib.sha256).hexdigest()
+
+    def verify_download_signature(self, key: str, expires: int, signature: str) -> bool:
+        if expires < time.time():
+            return False
+        return hmac.compare_digest(self._download_signature(key, expires), signature)
+
+    def _presigned_get_url(self, key, expires_in):
+        self._path(key) # 잘못된 키는 서명하기 전에 거절
+        expires = int(time.time()) + expires_in
+        query = urlencode({"expires": expires, "signature": self._download_signature(key, expires)})
+        return f"{self.url_for(key)}?{query}"
+
+    def _upload_signature(self, key: str, content_type: str, max_bytes: int, expires: int) -> str:
+        message = f"{key}\n{content_type}\n{max_bytes}\n{expires}".encode()
+        return hmac.new(self._secret, message, hashlib.sha256).hexdigest()
+
+    def verify_upload_signature(self, key: str, content_type: str, max_bytes: int, expires: int, signature: str) -> bool:
+        if expires < time.time():
+            return False
+        return hmac.compare_digest(self._upload_signature(key, content_type, max_bytes, expires), signature)
+
+    def _presigned_upload(self, key, content_type, max_bytes, expires_in, method):
+        # 로컬 스토리지는 API 서버의 PUT 엔드포인트로 받습니다. (POST 폼 업로드는 지원하지 않음)
+        self._path(key) # 잘못된 키는 서명하기 전에 거절
+        expires = int(time.time()) + expires_in
+        query = urlencode({
+            "expires": expires, "max_bytes": max_bytes,
+            "signature": self._upload_signature(key, content_type, max_bytes, expires),
+        })
+        return {"method": "PUT", "url": f"{self.upload_url}/{key}?{query}", "fields": None, "headers": {"Content-Type": content_type}}
+
+    def _download_to_path(self, key, path, max_bytes):
+        source = self._path(key)
+        size = os.path.getsize(source) # 없으면 FileNotFoundError
+        if max_bytes is not None and size > max_bytes:
+            raise ValueError(f"객체 크기({size} bytes)가 상한({max_bytes} bytes)을 넘습니다.")
+        shutil.copyfile(source, path)
+        return size
+
+
+def build_storage(max_concurrency: Optional[int] = None) -> ObjectStorage:
+    """환경 변수로 백엔드를 선택해 스토리지를 만듭니다. 설정이 잘못되면 예외를 발생시킵니다."""
+    backend = os.environ.get("STORAGE_BACKEND", "s3").lower()
+    max_concurrency = max_concurrency or int(os.environ.get("STORAGE_MAX_CONNECTIONS", "16"))
+    if backend == "local":
+        root = os.environ.get("LOCAL_STORAGE_DIR", "local_storage")
+        storage = LocalStorage(root, os.environ.get("LOCAL_STORAGE_BASE_URL", "/files"), max_concurrency=max_concurrency,
+                               secret=os.environ.get("LOCAL_STORAGE_SECRET"))
+        logger.info(f"로컬 스토리지 사용: {storage.root}")
+        return storage
+    if backend == "s3":
+        bucket = os.environ.get("S3_BUCKET_NAME")
+        if not bucket:
+            raise ValueError("S3_BUCKET_NAME 환경 변수가 설정되지 않았습니다.")
+        mb = 1024 * 1024
+        return S3Storage(
+            bucket,
+            region=os.environ.get("AWS_REGION"),
+            max_concurrency=max_concurrency,
+            multipart_threshold=int(float(os.environ.get("STORAGE_MULTIPART_THRESHOLD_MB", "8")) * mb),
+            multipart_chunksize=int(float(os.environ.get("STORAGE_MULTIPART_CHUNK_MB", "8")) * mb),
+        )
+    raise ValueError(f"알 수 없는 STORAGE_BACKEND 값입니다: {backend} (s3 또는 local)")
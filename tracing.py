@@ -0,0 +1,220 @@
+# tracing.py
+# 요청 단위 추적입니다. 느린 요청이 어디서 시간을 썼는지(라우트, DB, 스토리지, 모델 추론, Gemini) 봅니다.
+#
+# - TracingMiddleware가 요청마다 Trace를 만들어 contextvar에 넣고, span()/traced()가 그 Trace에 구간을 기록합니다.
+#   (asyncio.create_task / asyncio.to_thread는 contextvar를 복사하므로 하위 작업과 스레드의 구간도 같은 Trace에 모입니다.)
+# - 응답 헤더 Server-Timing에 구간 이름별 합계를 넣습니다. 브라우저 개발자 도구의 Timing 탭에서 바로 보입니다.
+#   스트리밍 응답은 헤더를 먼저 보내므로 그 시점까지의 구간만 들어갑니다.
+# - 요청이 끝나면 "request" 로거로 JSON 한 줄을 남깁니다.
+# - TRACE_SAMPLE_RATE 비율의 요청(그리고 TRACE_SLOW_MS보다 느린 요청)은 구간 전체를 TRACE_EXPORT_PATH(JSON Lines)에 씁니다.
+#   기본값은 둘 다 0이라 파일을 쓰지 않습니다. 파일이 TRACE_EXPORT_MAX_BYTES를 넘으면 <경로>.1로 옮기고 새로 씁니다.
+# - route.<엔드포인트> 구간은 요청 시작부터 응답 헤더를 보내기 직전까지입니다. (Server-Timing에 들어가도록)
+# - 동시에 실행된 구간(gather)은 겹치므로 구간 합계가 전체 시간보다 클 수 있습니다.
+import asyncio
+import functools
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+request_logger = logging.getLogger("request")
+
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "0"))
+TRACE_SLOW_MS = float(os.environ.get("TRACE_SLOW_MS", "0")) # 0 이하면 느린 요청 강제 저장을 하지 않음
+TRACE_EXPORT_PATH = os.environ.get("TRACE_EXPORT_PATH", "traces.jsonl")
+TRACE_EXPORT_MAX_BYTES = int(os.environ.get("TRACE_EXPORT_MAX_BYTES", str(50 * 1024 * 1024)))
+SERVER_TIMING_ENABLED = os.environ.get("SERVER_TIMING_ENABLED", "1") not in ("0", "false", "False")
+
+
+class Trace:
+    def __init__(self, method: str, path: str):
+        self.trace_id = uuid.uuid4().hex
+        self.method = method
+        self.path = path
+        self.started = time.perf_counter()
+        self.spans: List[Dict[str, Any]] = []
+        self._lock = threading.Lock() # 스레드(to_thread)에서도 구간을 추가하므로
+
+    def add(self, name: str, started: float, duration: float, error: Optional[str] = None):
+        span = {
+            "name": name,
+            "start_ms": round((started - self.started) * 1000, 2),
+            "duration_ms": round(duration * 1000, 2),
+            "thread": threading.current_thread().name,
+        }
+        if error:
+            span["error"] = error
+        with self._lock:
+            self.spans.append(span)
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.started) * 1000
+
+    def span_list(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return list(self.spans)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """구간 이름 -> {count, total_ms}"""
+        totals: Dict[str, Dict[str, float]] = {}
+        for span in self.span_list():
+            entry = totals.setdefault(span["name"], {"count": 0, "total_ms": 0.0})
+            entry["count"] += 1
+            entry["total_ms"] = round(entry["total_ms"] + span["duration_ms"], 2)
+        return totals
+
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+@contextmanager
+def span(name: str):
+    """현재 요청의 Trace에 구간을 기록합니다. 요청 밖(시작 시 로딩, 백필 CLI 등)에서는 아무것도 하지 않습니다."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        trace.add(name, started, time.perf_counter() - started, type(e).__name__)
+        raise
+    trace.add(name, started, time.perf_counter() - started)
+
+
+def traced(name: str):
+    """함수 호출 전체를 구간으로 기록하는 데코레이터 (동기/async 모두)"""
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def server_timing_header(trace: Trace) -> str:
+    entries = [f'{name};dur={entry["total_ms"]};desc="x{entry["count"]}"' for name, entry in trace.summary().items()]
+    entries.append(f"total;dur={trace.elapsed_ms():.2f}")
+    return ", ".join(entries)
+
+
+class TraceExporter:
+    """
+    샘플링된 Trace를 JSON Lines 파일에 덧붙입니다. 파일 쓰기는 응답을 보낸 뒤 스레드에서 합니다.
+    파일이 max_bytes를 넘으면 <path>.1로 옮기고(이전 .1은 덮어씀) 새 파일에 씁니다. (0 이하면 옮기지 않음)
+    """
+    def __init__(self, path: str = TRACE_EXPORT_PATH, sample_rate: float = TRACE_SAMPLE_RATE, slow_ms: float = TRACE_SLOW_MS,
+                 max_bytes: int = TRACE_EXPORT_MAX_BYTES):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def should_export(self, duration_ms: float) -> bool:
+        if self.slow_ms > 0 and duration_ms >= self.slow_ms:
+            return True
+        return random.random() < self.sample_rate
+
+    def _write(self, line: str):
+        with self._lock:
+            if self.max_bytes > 0 and os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+                os.replace(self.path, f"{self.path}.1")
+            with open(self.path, "a", encoding="utf-8") as target:
+                target.write(line + "\n")
+
+    async def export(self, record: Dict[str, Any]):
+        try:
+            await asyncio.to_thread(self._write, json.dumps(record, ensure_ascii=False))
+        except Exception as e:
+            logger.warning(f"trace 저장 실패 ({self.path}): {e}")
+
+
+trace_exporter = TraceExporter()
+
+
+class TracingMiddleware:
+    """
+    요청마다 Trace를 시작하고 Server-Timing 헤더, 요청 로그 한 줄, 샘플링된 trace 저장을 처리합니다.
+    가장 바깥 미들웨어로 등록해야 다른 미들웨어가 보낸 응답(413 등)도 기록됩니다.
+    """
+    def __init__(self, app, exporter: TraceExporter = trace_exporter):
+        self.app = app
+        self.exporter = exporter
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trace = Trace(scope["method"], scope["path"])
+        token = _current_trace.set(trace)
+        status_code = 500
+        route_started = time.perf_counter()
+        route = None
+
+        def finish_route() -> str:
+            # 라우터가 scope에 넣어 둔 엔드포인트로 라우트 이름을 정합니다. (매칭되지 않았으면 경로)
+            nonlocal route
+            if route is None:
+                endpoint = scope.get("endpoint")
+                route = getattr(endpoint, "__name__", None) or scope["path"]
+                trace.add(f"route.{route}", route_started, time.perf_counter() - route_started)
+            return route
+
+        async def send_with_timing(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                # 헤더를 만들기 전에 route 구간을 닫아야 Server-Timing에 들어갑니다.
+                finish_route()
+                if SERVER_TIMING_ENABLED:
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", server_timing_header(trace).encode("latin-1")))
+                    headers.append((b"x-trace-id", trace.trace_id.encode()))
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            # 응답을 보내지 못하고 끝난 경우(예외)에는 여기서 route 구간을 닫습니다.
+            finish_route()
+            _current_trace.reset(token)
+            await self._finish(trace, route, status_code)
+
+    async def _finish(self, trace: Trace, route: str, status_code: int):
+        duration_ms = round(trace.elapsed_ms(), 2)
+        record = {
+            "trace_id": trace.trace_id,
+            "method": trace.method,
+            "path": trace.path,
+            "route": route,
+            "status": status_code,
+            "duration_ms": duration_ms,
+            "spans": trace.summary(),
+        }
+        request_logger.info(json.dumps(record, ensure_ascii=False))
+        if self.exporter is not None and self.exporter.should_export(duration_ms):
+            record["spans"] = trace.span_list()
+            await self.exporter.export(record)
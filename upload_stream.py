@@ -0,0 +1,187 @@
+# upload_stream.py
+# 업로드 파일을 메모리에 통째로 올리지 않고 청크 단위로 처리하는 도우미입니다.
+#
+# - 첫 청크의 매직 넘버로 이미지 형식을 판별해, 이미지가 아니면 나머지를 읽기 전에 415로 거절합니다.
+# - 읽는 동안 크기를 세어 상한(MAX_UPLOAD_MB)을 넘는 순간 413으로 거절합니다.
+# - 읽는 동안 SHA-256 해시를 계산하고, 분석용 임시 파일에 바로 씁니다. 요청당 메모리에는 청크 버퍼 하나만 남습니다.
+# - UploadSizeLimitMiddleware는 Content-Length가 상한을 넘는 요청을 본문 파싱 전에 413으로 돌려보냅니다.
+#   Content-Length가 없는 chunked 요청은 받은 바이트를 세어 상한을 넘는 순간 끊고 413을 보냅니다.
+#   요청 상한은 파일 한 개 기준이고, 여러 파일을 받는 경로(max_files)는 그 파일 수만큼 늘립니다.
+#   파일별 상한은 spool_upload가 따로 검사합니다.
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from typing import AsyncIterator, Dict, Optional
+
+from fastapi import HTTPException, UploadFile
+
+logger = logging.getLogger(__name__)
+
+MAX_UPLOAD_BYTES = int(float(os.environ.get("MAX_UPLOAD_MB", "15")) * 1024 * 1024)
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# multipart 경계/폼 필드 등 파일 외 부분에 허용하는 여유분
+_MULTIPART_OVERHEAD = 64 * 1024
+
+# (시그니처 검사 함수, content type, 확장자)
+_IMAGE_SIGNATURES = [
+    (lambda head: head.startswith(b"\xff\xd8\xff"), "image/jpeg", ".jpg"),
+    (lambda head: head.startswith(b"\x89PNG\r\n\x1a\n"), "image/png", ".png"),
+    (lambda head: head[:4] == b"RIFF" and head[8:12] == b"WEBP", "image/webp", ".webp"),
+    (lambda head: head.startswith(b"BM"), "image/bmp", ".bmp"),
+]
+
+
+# 직접 업로드(presigned) 요청에서 허용하는 content type -> 확장자
+ALLOWED_IMAGE_TYPES = {content_type: extension for _, content_type, extension in _IMAGE_SIGNATURES}
+
+
+def sniff_image_type(head: bytes):
+    """파일 앞부분으로 이미지 형식을 판별해 (content_type, 확장자)를 반환합니다. 지원하지 않는 형식이면 None."""
+    for matches, content_type, extension in _IMAGE_SIGNATURES:
+        if matches(head):
+            return content_type, extension
+    return None
+
+
+class SpooledUpload:
+    """디스크 임시 파일로 받아 둔 업로드. 분석기에는 path를, 스토리지에는 put_path(path)를 넘깁니다."""
+    def __init__(self, path: str, size: int, sha256: str, content_type: str, extension: str):
+        self.path = path
+        self.size = size
+        self.sha256 = sha256
+        self.content_type = content_type
+        self.extension = extension
+
+    def read_bytes(self) -> bytes:
+        with open(self.path, "rb") as spooled:
+            return spooled.read()
+
+    def cleanup(self):
+        if self.path and os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+async def spool_upload(file: UploadFile, max_bytes: int = MAX_UPLOAD_BYTES, chunk_size: int = UPLOAD_CHUNK_SIZE) -> SpooledUpload:
+    """
+    UploadFile을 청크 단위로 읽어 임시 파일에 씁니다.
+    이미지가 아니면 415, max_bytes를 넘으면 413 HTTPException을 발생시키고 임시 파일은 지웁니다.
+    """
+    async def chunks():
+        while True:
+            chunk = await file.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    return await spool_stream(chunks(), max_bytes)
+
+
+async def spool_stream(chunks: AsyncIterator[bytes], max_bytes: int = MAX_UPLOAD_BYTES) -> SpooledUpload:
+    """바이트 청크 스트림(예: Request.stream())을 spool_upload와 같은 검사를 거쳐 임시 파일에 씁니다."""
+    digest = hashlib.sha256()
+    size = 0
+    sniffed = None
+    temp_file = await asyncio.to_thread(tempfile.NamedTemporaryFile, delete=False)
+    try:
+        async for chunk in chunks:
+            if not chunk:
+                continue
+            if sniffed is None:
+                sniffed = sniff_image_type(chunk[:16])
+                if sniffed is None:
+                    raise HTTPException(status_code=415, detail="지원하지 않는 파일 형식입니다. JPEG, PNG, WEBP, BMP 이미지만 업로드할 수 있습니다.")
+            size += len(chunk)
+            if size > max_bytes:
+                raise HTTPException(status_code=413, detail=f"업로드 파일은 {max_bytes // (1024 * 1024)}MB를 넘을 수 없습니다.")
+            digest.update(chunk)
+            await asyncio.to_thread(temp_file.write, chunk)
+        if sniffed is None:
+            raise HTTPException(status_code=400, detail="빈 파일은 업로드할 수 없습니다.")
+        await asyncio.to_thread(temp_file.close)
+    except BaseException:
+        temp_file.close()
+        os.unlink(temp_file.name)
+        raise
+
+    content_type, extension = sniffed
+    return SpooledUpload(temp_file.name, size, digest.hexdigest(), content_type, extension)
+
+
+class _RequestTooLarge(Exception):
+    pass
+
+
+class UploadSizeLimitMiddleware:
+    """
+    multipart 업로드 요청의 크기를 제한합니다.
+    - Content-Length가 상한을 넘으면 본문을 읽기 전에 413을 반환합니다.
+    - Content-Length가 없는(chunked) 요청은 받은 본문 바이트를 세다가 상한을 넘는 순간 읽기를 멈추고 413을 반환합니다.
+      (multipart 파서가 나머지를 임시 파일로 받아 두기 전에 끊습니다.)
+    """
+    def __init__(self, app, max_bytes: int = MAX_UPLOAD_BYTES, max_files: Optional[Dict[str, int]] = None):
+        """max_files: 여러 파일을 받는 경로 -> 최대 파일 수 (예: 배치 분석)"""
+        self.app = app
+        self.max_request_bytes = max_bytes + _MULTIPART_OVERHEAD
+        self.route_max_request_bytes = {
+            path: count * (max_bytes + _MULTIPART_OVERHEAD) for path, count in (max_files or {}).items()
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in ("POST", "PUT"):
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        if not headers.get(b"content-type", b"").startswith(b"multipart/form-data"):
+            await self.app(scope, receive, send)
+            return
+        max_request_bytes = self.route_max_request_bytes.get(scope["path"], self.max_request_bytes)
+        content_length = headers.get(b"content-length")
+        if content_length and content_length.isdigit() and int(content_length) > max_request_bytes:
+            logger.warning(f"업로드 크기 초과로 거절: {scope['path']} ({int(content_length)} bytes)")
+            await self._reject(send)
+            return
+
+        received = 0
+        too_large = False
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received, too_large
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > max_request_bytes:
+                    too_large = True
+                    raise _RequestTooLarge()
+            return message
+
+        async def guarded_send(message):
+            nonlocal response_started
+            if too_large:
+                # 본문 파싱 실패로 앱이 만든 응답(400/500 등) 대신 413을 보냅니다.
+                if message["type"] == "http.response.start" and not response_started:
+                    response_started = True
+                    await self._reject(send)
+                return
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except _RequestTooLarge:
+            pass
+        if too_large:
+            logger.warning(f"업로드 크기 초과로 거절: {scope['path']} (chunked, {received} bytes 이상)")
+            if not response_started:
+                await self._reject(send)
+
+    async def _reject(self, send):
+        body = json.dumps({"detail": "업로드 파일이 너무 큽니다."}, ensure_ascii=False).encode()
+        await send({"type": "http.response.start", "status": 413,
+                    "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()),
+                                (b"connection", b"close")]})
+        await send({"type": "http.response.body", "body": body})